@@ -3,9 +3,9 @@ from datetime import datetime, time
 from collections import deque
 from itertools import chain
 from math import sqrt, floor, ceil
-import numpy as np
 
 from flyerbots.strategy import Strategy
+from flyerbots.replay import ReplayStreaming
 from flyerbots.indicator import *
 from flyerbots.utils import dotdict, stop_watch
 
@@ -34,18 +34,6 @@ def ceiling(price, q=50):
 
 class elephant:
 
-    def __init__(self):
-        # 200万まで配列で確保
-        self.allboard = np.zeros(2000000)
-
-    def board_update(self, board):
-        # 板上書き
-        self.mid_price = int(board['mid_price'])
-        for b in board['bids']:
-            self.allboard[min(int(b['price']),2000000-1)] = b['size']
-        for b in board['asks']:
-            self.allboard[min(int(b['price']),2000000-1)] = b['size']
-
     def find_target_price(self, position_size):
         # ask_depth = np.sum(self.allboard[self.mid_price+1:self.mid_price+3000])
         # bid_depth = np.sum(self.allboard[self.mid_price-3000:self.mid_price:])
@@ -59,17 +47,7 @@ class elephant:
         #     sig.append((2, 3.0, 0.01))
         # else:
         #     sig.append((2, 3.0, 0.00))
-        self.bids = []
-        target = self.mid_price
-        for id,d,b,size in sig:
-            depth = 0
-            while True:
-                target -= 1
-                bid = self.allboard[target]
-                depth += bid
-                if (d>0 and depth>d) or (b>0 and bid>=b):
-                    break
-            self.bids.append(('L'+str(id), target+1, size, depth))
+        self.bids = self.place_orders(self.book.bids, 'L', sig)
 
         # 板厚・ポジションに合わせて売り指値決定
         sig = []
@@ -80,17 +58,7 @@ class elephant:
         #     sig.append((2, 3.0, 0.01))
         # else:
         #     sig.append((2, 3.0, 0.00))
-        self.asks = []
-        target = self.mid_price
-        for id,d,a,size in sig:
-            depth = 0
-            while True:
-                target += 1
-                ask = self.allboard[target]
-                depth += ask
-                if (d>0 and depth>d) or (ask>=a):
-                    break
-            self.asks.append(('S'+str(id), target-1, size, depth))
+        self.asks = self.place_orders(self.book.asks, 'S', sig)
 
         # # 指値位置表示
         for a in reversed(self.asks):
@@ -99,11 +67,28 @@ class elephant:
         for b in self.bids:
             logger.info('{0} {1} {2} {3}'.format(*b))
 
+    def place_orders(self, side, prefix, sig):
+        # 累積サイズがdを超える(またはサイズがb以上の)価格帯の1円内側に置く. 次の指値はその外側から数える
+        orders = []
+        lo = 0
+        for id,d,b,size in sig:
+            i = side.find(d, b, lo)
+            if i is None:
+                # 板が薄い場合は最も遠い価格帯
+                i = len(side) - 1
+                if i < lo:
+                    break
+            depth = side.cumulative(i) - side.cumulative(lo-1)
+            orders.append((prefix+str(id), int(side.price(i)) - side.sign, size, depth))
+            lo = i + 1
+        return orders
+
     def setup(self, strategy):
-        # APIで板初期化
-        self.board_update(strategy.fetch_order_book())
         # 板ストリーム購読開始
-        self.ep = strategy.streaming.get_endpoint(strategy.settings.symbol, ['board'])
+        self.book = strategy.streaming.get_order_book(strategy.settings.symbol)
+        # APIで板初期化(記録データ再生時はスナップショットを待つ)
+        if not strategy.streaming.offline:
+            self.book.snapshot(strategy.fetch_order_book())
 
     def loop(self, ticker, ohlcv, strategy, **other):
 
@@ -116,10 +101,9 @@ class elephant:
                 coffee_break = True
                 break
 
-        # 板更新
-        boards = self.ep.get_boards()
-        for b in boards:
-            self.board_update(b)
+        # 板未取得
+        if not self.book.synced:
+            return
 
         # エントリー
         if not coffee_break:
@@ -127,7 +111,9 @@ class elephant:
             delay = ohlcv.distribution_delay[-1]
 
             # 指値位置計算
-            self.find_target_price(strategy.position_size)
+            with self.book.lock:
+                self.mid_price = int(self.book.mid_price)
+                self.find_target_price(strategy.position_size)
 
             # ポジション価格帯
             restrict_range = {}
@@ -162,9 +148,15 @@ class elephant:
 
 if __name__ == "__main__":
     import settings
+    import argparse
     import logging
     import logging.config
 
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--replay", dest='replay', type=str, default=None, help='capture directory')
+    parser.add_argument("--speed", dest='speed', type=float, default=1.0)
+    args = parser.parse_args()
+
     logging.config.dictConfig(settings.loggingConf('elephant.log'))
     logger = logging.getLogger("elephant")
 
@@ -175,4 +167,4 @@ if __name__ == "__main__":
     strategy.settings.disable_rich_ohlcv = True
     strategy.settings.max_ohlcv_size = 10*3
     strategy.risk.max_position_size = 0.02
-    strategy.start()
+    strategy.start(ReplayStreaming(args.replay, args.speed) if args.replay else None)
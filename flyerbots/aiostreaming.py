@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio版ストリーミング
+
+JSON-RPC WebSocket(wss://ws.lightstream.bitflyer.com/json-rpc)をイベントループ上で受信する.
+Endpointは従来のメソッドに加えて *_async 版を持ち、複数の商品やタイマーを
+スレッドを増やさずに1つのイベントループで待てる.
+
+    streaming = AsyncStreaming()
+    ep = streaming.get_endpoint('FX_BTC_JPY', ['ticker', 'executions'])
+    streaming.start()
+    while True:
+        await ep.wait_any_async(['executions'])
+        executions = ep.get_executions()
+"""
+import json
+import asyncio
+import threading
+import websockets
+from .streaming import Streaming, lightning_channel, lightning_channels
+
+class AsyncStreaming(Streaming):
+
+    def __init__(self, url='wss://ws.lightstream.bitflyer.com/json-rpc'):
+        super().__init__()
+        self.transport = 'jsonrpc'
+        self.ws_url = url
+        self.loop = None
+        self.task = None
+
+    def ws_subscribe(self, channel):
+        asyncio.ensure_future(self.ws.send(json.dumps({'method': 'subscribe', 'params': {'channel': channel}})))
+
+    def ws_disconnect(self):
+        if self.ws is not None:
+            asyncio.ensure_future(self.ws.close())
+
+    subscribe = ws_subscribe
+    disconnect = ws_disconnect
+
+    async def run_loop(self):
+        while self.running:
+            try:
+                async with websockets.connect(self.ws_url, max_size=None) as ws:
+                    self.ws = ws
+                    self.ws_on_open()
+                    async for frame in ws:
+                        self.ws_on_message(frame)
+            except websockets.ConnectionClosed as e:
+                self.logger.info(e)
+            except Exception as e:
+                self.logger.exception(e)
+            self.ws_on_close()
+            self.ws = None
+            if self.running:
+                await asyncio.sleep(self.reconnect_delay())
+
+    def start(self):
+        """実行中のイベントループで受信を開始する"""
+        self.logger.info('Start Streaming (asyncio)')
+        self.running = True
+        self.loop = asyncio.get_event_loop()
+        for ep in self.endpoints:
+            ep.bind(self.loop)
+        self.task = asyncio.ensure_future(self.run_loop())
+
+    def stop(self):
+        if self.running:
+            self.logger.info('Stop Streaming')
+            self.running = False
+            self.disconnect()
+            for ep in self.endpoints:
+                ep.shutdown()
+
+    async def wait_closed(self):
+        if self.task is not None:
+            await self.task
+
+    class Endpoint(Streaming.Endpoint):
+
+        def __init__(self, logger):
+            super().__init__(logger)
+            self.loop = None
+            self.loop_thread = None
+            # チャンネル毎の待機中のFuture(待つ呼び出し毎に1つ)
+            self.async_waiting = {}
+
+        def bind(self, loop):
+            self.loop = loop
+            self.loop_thread = threading.get_ident()
+
+        def wake(self, channels):
+            """channelsを待っているFutureを完了する(イベントループのスレッドで呼ぶ)"""
+            for channel in channels:
+                for future in self.async_waiting.get(channel, ()):
+                    if not future.done():
+                        future.set_result(True)
+
+        def notify(self, channel):
+            super().notify(channel)
+            if self.async_waiting.get(channel):
+                if threading.get_ident() == self.loop_thread:
+                    self.wake([channel])
+                else:
+                    self.loop.call_soon_threadsafe(self.wake, [channel])
+
+        def shutdown(self):
+            super().shutdown()
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.wake, list(self.async_waiting.keys()))
+
+        async def wait_channels_async(self, channels, timeout=None):
+            if self.loop is None:
+                self.bind(asyncio.get_event_loop())
+            while True:
+                # 先に登録してから確認する(確認後・登録前に来たデータで起こされないのを防ぐ)
+                future = self.loop.create_future()
+                for channel in channels:
+                    self.async_waiting.setdefault(channel, set()).add(future)
+                try:
+                    available = 0
+                    if self.suspend_count == 0:
+                        for channel in channels:
+                            available = available + self.available(channel)
+                    if available or self.closed:
+                        return True
+                    try:
+                        await asyncio.wait_for(future, timeout)
+                    except asyncio.TimeoutError:
+                        return False
+                finally:
+                    # 自分のFutureだけ外す
+                    for channel in channels:
+                        waiting = self.async_waiting.get(channel)
+                        if waiting is not None:
+                            waiting.discard(future)
+                            if not waiting:
+                                del self.async_waiting[channel]
+
+        async def wait_any_async(self, topics=[], timeout=None, product_id=None):
+            channels = lightning_channels(product_id or self.product_id, topics)
+            if len(channels)==0:
+                channels = list(self.buffers.keys())
+            return await self.wait_channels_async(channels, timeout)
+
+        async def get_ticker_async(self, timeout=None, product_id=None):
+            await self.wait_channels_async([lightning_channel(product_id or self.product_id, 'ticker')], timeout)
+            return self.get_ticker(product_id=product_id)
+
+        async def get_tickers_async(self, timeout=None, product_id=None):
+            await self.wait_channels_async([lightning_channel(product_id or self.product_id, 'ticker')], timeout)
+            return self.get_tickers(product_id=product_id)
+
+        async def get_executions_async(self, timeout=None, product_id=None, chained=True, columns=False):
+            await self.wait_channels_async([lightning_channel(product_id or self.product_id, 'executions')], timeout)
+            return self.get_executions(product_id=product_id, chained=chained, columns=columns)
+
+        async def get_boards_async(self, timeout=None, product_id=None):
+            await self.wait_channels_async([lightning_channel(product_id or self.product_id, 'board')], timeout)
+            return self.get_boards(product_id=product_id)
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+    from time import time
+    from .utils import time_ns
+    from .wsserver import StandInServer
+
+    parser = argparse.ArgumentParser(description="thread vs asyncio streaming client")
+    parser.add_argument("--messages", dest='messages', type=int, default=20000)
+    parser.add_argument("--interval", dest='interval', type=float, default=0, help='seconds between messages (0: flood)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    channel = 'lightning_ticker_FX_BTC_JPY'
+    server = StandInServer().start()
+
+    def messages():
+        for i in range(args.messages):
+            yield channel, {'ltp':1000000.0+i, 'sent_ns':time_ns()}
+
+    def report(name, latency, elapsed):
+        latency.sort()
+        n = len(latency)
+        print('{0:<8} {1} messages {2:.0f} msg/s latency p50 {3:.3f}ms p99 {4:.3f}ms max {5:.3f}ms'.format(
+            name, n, n / elapsed, latency[n//2] / 1e6, latency[int(n*0.99)] / 1e6, latency[-1] / 1e6))
+
+    def bench(streaming):
+        latency = []
+        done = threading.Event()
+        def on_data(channel, data):
+            latency.append(time_ns() - data['sent_ns'])
+            if len(latency) >= args.messages:
+                done.set()
+        streaming.subscribe_channel(channel, on_data)
+        return latency, done
+
+    # スレッド版(websocket-client)
+    streaming = Streaming()
+    streaming.transport = 'jsonrpc'
+    streaming.ws_url = server.url
+    latency, done = bench(streaming)
+    streaming.start()
+    server.wait_for_subscribers([channel])
+    start = time()
+    server.run(server.broadcast_many(messages(), args.interval))
+    done.wait()
+    report('thread', latency, time() - start)
+    streaming.stop()
+    server.wait_for_subscribers([channel], count=0)
+
+    # asyncio版
+    async def async_main():
+        streaming = AsyncStreaming(server.url)
+        latency, done = bench(streaming)
+        ep = streaming.get_endpoint('FX_BTC_JPY', ['ticker'])
+        streaming.start()
+        while not server.subscribers(channel):
+            await asyncio.sleep(0.01)
+        start = time()
+        server.run(server.broadcast_many(messages(), args.interval))
+        received = 0
+        while received < args.messages:
+            await ep.wait_any_async(['ticker'])
+            received += len(ep.get_tickers())
+        report('asyncio', latency, time() - start)
+        streaming.stop()
+        await streaming.wait_closed()
+
+    asyncio.get_event_loop().run_until_complete(async_main())
+    server.stop()
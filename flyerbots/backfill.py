@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+約定履歴の欠落検出と補完
+
+約定IDは全商品で共通の連番なので、同じ商品の約定IDが連続しているとは限らない.
+そのため欠落は再接続の前後で判定する(切断前の最後のIDと再接続後の最初のIDの間).
+欠落した範囲はREST API(getexecutions)を before/after でページングして取得し、
+受信した約定より前に順番通り配信する. 再接続で重複した約定は捨てる.
+"""
+import threading
+import logging
+from .executions import ExecutionColumns
+from .utils import dotdict, time_ns
+
+def execution_id(data, i):
+    return data.id[i] if isinstance(data, ExecutionColumns) else data[i]['id']
+
+class ExecutionBackfill:
+
+    def __init__(self, channel, fetch, deliver, count=500, max_pages=20):
+        """
+        fetch(product_code, before, after, count) -> 約定のリスト(新しい順)
+        deliver(data) -> 後段(Endpoint等)への配信
+        """
+        self.logger = logging.getLogger(__name__)
+        self.channel = channel
+        self.product_code = channel[len('lightning_executions_'):]
+        self.fetch = fetch
+        self.deliver = deliver
+        self.count = count
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        self.last_id = None
+        self.check = False
+        self.filling = False
+        self.held = []
+        self.columns = False
+        self.stats = dotdict(gaps=0, backfilled=0, duplicates=0, unfilled=0)
+
+    def reconnected(self):
+        """再接続後の最初の約定で欠落を確認する"""
+        with self.lock:
+            self.check = True
+
+    def put(self, data):
+        with self.lock:
+            if self.filling:
+                # 補完中は受信した約定を保留して補完した約定の後に配信する
+                self.held.append(data)
+                return
+            data = self.drop_duplicates(data)
+            if data is None:
+                return
+            first_id = execution_id(data, 0)
+            if self.check and self.last_id is not None and first_id > self.last_id + 1:
+                self.stats.gaps += 1
+                self.filling = True
+                self.held.append(data)
+                t = threading.Thread(target=self.fill, args=(self.last_id, first_id))
+                t.daemon = True
+                t.start()
+                self.check = False
+                return
+            self.check = False
+            self.last_id = execution_id(data, -1)
+        self.deliver(data)
+
+    def drop_duplicates(self, data):
+        if self.last_id is None:
+            return data
+        ids = data.id if isinstance(data, ExecutionColumns) else [e['id'] for e in data]
+        start = 0
+        while start < len(ids) and ids[start] <= self.last_id:
+            start += 1
+        if start:
+            self.stats.duplicates += start
+            if start == len(ids):
+                return None
+            data = data.tail(start) if isinstance(data, ExecutionColumns) else data[start:]
+        return data
+
+    def fetch_range(self, after, before):
+        """after < id < before の約定を古い順で返す"""
+        executions = []
+        for _ in range(self.max_pages):
+            page = self.fetch(self.product_code, before, after, self.count)
+            executions.extend(e for e in page if after < e['id'] < before)
+            if len(page) < self.count:
+                return executions, True
+            before = min(e['id'] for e in page)
+        return executions, False
+
+    def fill(self, after, before):
+        executions = []
+        try:
+            executions, complete = self.fetch_range(after, before)
+            if not complete:
+                self.stats.unfilled += 1
+                self.logger.warning('BACKFILL: {0} gap {1}-{2} too large, filled {3} executions'.format(
+                    self.channel, after, before, len(executions)))
+        except Exception as e:
+            self.stats.unfilled += 1
+            self.logger.warning('BACKFILL: {0} gap {1}-{2} '.format(self.channel, after, before) + type(e).__name__ + ": {0}".format(e))
+        executions.sort(key=lambda e: e['id'])
+        if len(executions):
+            self.stats.backfilled += len(executions)
+            self.logger.info('BACKFILL: {0} {1} executions {2}-{3}'.format(self.channel, len(executions), after, before))
+            executions[-1]['receved_at'] = time_ns()
+            executions[-1]['bucket_size'] = len(executions)
+            self.last_id = executions[-1]['id']
+            self.deliver(ExecutionColumns.from_dicts(executions) if self.columns else executions)
+        # 保留していた約定を配信し、なくなったら通常の配信に戻す
+        while True:
+            with self.lock:
+                held = []
+                for data in self.held:
+                    data = self.drop_duplicates(data)
+                    if data is not None:
+                        held.append(data)
+                        self.last_id = execution_id(data, -1)
+                self.held = []
+                if len(held) == 0:
+                    self.filling = False
+                    break
+            for data in held:
+                self.deliver(data)
@@ -76,7 +76,7 @@ class Exchange:
             health = 'very busy'
         return health, mean_time, self.api_token
 
-    def start(self):
+    def start(self, offline=False):
         self.logger.info('Start Exchange')
         self.running = True
 
@@ -104,7 +104,7 @@ class Exchange:
         self.inter_check_order_status = self.__restapi_check_order_status
 
         # プライベートAPI有効判定
-        self.private_api_enabled = len(self.apiKey)>0 and len(self.secret)>0
+        self.private_api_enabled = len(self.apiKey)>0 and len(self.secret)>0 and not offline
 
         # スレッドプール作成
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=9)
@@ -131,6 +131,10 @@ class Exchange:
             # self.inter_fetch_board_state = self.__lightning_fetch_board_state
             # self.inter_check_order_status = self.__lightning_check_order_status
 
+        # オフライン(記録データ再生)時は取引所に接続しない
+        if offline:
+            return
+
         # マーケット一覧表示
         self.exchange.load_markets()
         for k, v in self.exchange.markets.items():
@@ -306,6 +310,15 @@ class Exchange:
         return dotdict(self.exchange.public_get_getboard(
                     params={'product_code': self.exchange.market_id(symbol)}))
 
+    def fetch_executions(self, product_code, before=None, after=None, count=500):
+        """約定履歴取得(新しい順, after < id < before)"""
+        params = {'product_code': product_code, 'count': count}
+        if before is not None:
+            params['before'] = before
+        if after is not None:
+            params['after'] = after
+        return self.exchange.public_get_getexecutions(params=params)
+
     def wait_for_completion(self):
 
         # 新規注文拒否解除
@@ -376,34 +389,30 @@ class Exchange:
                     o = my_orders.get(e['sell_child_order_acceptance_id'], None)
                     self.order_exec(o,e)
 
-    def check_order_open_and_cancel(self, boards):
-        if len(boards):
+    def check_order_open_and_cancel(self, book):
+        with book.lock:
+            seq, self.board_seq = self.board_seq, book.seq
             my_orders = self.om.get_open_orders()
-            if len(my_orders):
-                for board in boards:
-                    bids = {b['price']:b['size'] for b in board['bids']}
-                    asks = {b['price']:b['size'] for b in board['asks']}
-                    for o in my_orders.values():
-                        size = None
-                        if o['side'] == 'buy':
-                            size = bids.get(o['price'], None)
-                        elif o['side'] == 'sell':
-                            size = asks.get(o['price'], None)
-                        if size is not None:
-                            if self.om.open_or_cancel(o, size):
-                                self.logger.info("UPDATE: {myid} {status} {side} {price} {filled}/{amount} {average_price} {id}".format(**o))
-
-    def start_monitoring(self, endpoint):
+            for o in my_orders.values():
+                # 前回の確認以降に差分で更新された価格帯だけ見る
+                side = book.side(o['side'])
+                if side.updated_since(o['price'], seq):
+                    if self.om.open_or_cancel(o, side.size_at(o['price'])):
+                        self.logger.info("UPDATE: {myid} {status} {side} {price} {filled}/{amount} {average_price} {id}".format(**o))
+
+    def start_monitoring(self, endpoint, book=None):
 
         def monitoring_main(ep):
             self.logger.info('Start Monitoring')
+            self.board_seq = 0
             while self.running and not ep.closed:
                 try:
                     ep.wait_any()
                     executions = ep.get_executions()
                     self.check_order_execution(executions)
                     boards = ep.get_boards()
-                    self.check_order_open_and_cancel(boards)
+                    if len(boards) and book is not None:
+                        self.check_order_open_and_cancel(book)
                 except Exception as e:
                     self.logger.warning(type(e).__name__ + ": {0}".format(e))
             self.logger.info('Stop Monitoring')
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+約定履歴の列形式
+
+lightning_executions_* のJSON-RPCフレームを約定毎のdictを作らずに列(array)へ直接展開する.
+"""
+import re
+from array import array
+from .utils import parse_exec_date_ns
+
+SIDE_CODE = {'BUY':1, 'SELL':-1, '':0}
+SIDE_NAME = {1:'BUY', -1:'SELL', 0:''}
+
+EXECUTIONS_FRAME = '"channel":"lightning_executions_'
+CHANNEL_PATTERN = re.compile(r'"channel":"([^"]+)"')
+
+class ExecutionColumns:
+    """約定履歴(列形式)
+
+    price/size/side(1:BUY -1:SELL 0:板寄せ)/id/exec_ns(エポックナノ秒)/
+    buy_child_order_acceptance_id/sell_child_order_acceptance_id
+    イテレートすると従来通りの約定dictを順に返す.
+    """
+
+    __slots__ = ('id', 'side', 'price', 'size', 'exec_ns', 'exec_date',
+        'buy_child_order_acceptance_id', 'sell_child_order_acceptance_id', 'receved_at')
+
+    def __init__(self):
+        self.id = array('q')
+        self.side = array('b')
+        self.price = array('d')
+        self.size = array('d')
+        self.exec_ns = array('q')
+        self.exec_date = []
+        self.buy_child_order_acceptance_id = []
+        self.sell_child_order_acceptance_id = []
+        self.receved_at = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def append(self, id, side, price, size, exec_date, buy_id, sell_id):
+        self.id.append(id)
+        self.side.append(SIDE_CODE.get(side, 0))
+        self.price.append(price)
+        self.size.append(size)
+        self.exec_ns.append(parse_exec_date_ns(exec_date))
+        self.exec_date.append(exec_date)
+        self.buy_child_order_acceptance_id.append(buy_id)
+        self.sell_child_order_acceptance_id.append(sell_id)
+
+    def extend(self, other):
+        self.id.extend(other.id)
+        self.side.extend(other.side)
+        self.price.extend(other.price)
+        self.size.extend(other.size)
+        self.exec_ns.extend(other.exec_ns)
+        self.exec_date.extend(other.exec_date)
+        self.buy_child_order_acceptance_id.extend(other.buy_child_order_acceptance_id)
+        self.sell_child_order_acceptance_id.extend(other.sell_child_order_acceptance_id)
+        self.receved_at = other.receved_at
+
+    def tail(self, start):
+        """start番目以降の約定を返す"""
+        cols = ExecutionColumns()
+        for name in ExecutionColumns.__slots__[:-1]:
+            setattr(cols, name, getattr(self, name)[start:])
+        cols.receved_at = self.receved_at
+        return cols
+
+    def row(self, i):
+        e = {}
+        e['id'] = self.id[i]
+        e['side'] = SIDE_NAME[self.side[i]]
+        e['price'] = self.price[i]
+        e['size'] = self.size[i]
+        e['exec_date'] = self.exec_date[i]
+        e['buy_child_order_acceptance_id'] = self.buy_child_order_acceptance_id[i]
+        e['sell_child_order_acceptance_id'] = self.sell_child_order_acceptance_id[i]
+        return e
+
+    def __getitem__(self, i):
+        n = len(self.id)
+        if i < 0:
+            i += n
+        e = self.row(i)
+        # 最終要素には受信情報を付加する(従来のon_dataと同じ)
+        if i == n - 1 and self.receved_at is not None:
+            e['receved_at'] = self.receved_at
+            e['bucket_size'] = n
+        return e
+
+    def __iter__(self):
+        n = len(self.id)
+        for i in range(n):
+            yield self[i]
+
+    @classmethod
+    def from_dicts(cls, executions):
+        cols = cls()
+        cols.id = array('q', [e['id'] for e in executions])
+        cols.side = array('b', [SIDE_CODE.get(e['side'], 0) for e in executions])
+        cols.price = array('d', [e['price'] for e in executions])
+        cols.size = array('d', [e['size'] for e in executions])
+        cols.exec_date = [e['exec_date'] for e in executions]
+        cols.exec_ns = array('q', [parse_exec_date_ns(d) for d in cols.exec_date])
+        cols.buy_child_order_acceptance_id = [e['buy_child_order_acceptance_id'] for e in executions]
+        cols.sell_child_order_acceptance_id = [e['sell_child_order_acceptance_id'] for e in executions]
+        if len(executions):
+            cols.receved_at = executions[-1].get('receved_at')
+        return cols
+
+    @classmethod
+    def concat(cls, messages):
+        cols = cls()
+        for m in messages:
+            cols.extend(m if isinstance(m, cls) else cls.from_dicts(m))
+        return cols
+
+def parse_executions_frame(frame):
+    """JSON-RPCのchannelMessageフレームから(channel, ExecutionColumns)を取り出す
+
+    約定履歴以外・想定外の形式の場合はNoneを返す(呼び出し側で通常のJSONデコードを行う)
+    """
+    if EXECUTIONS_FRAME not in frame:
+        return None
+    m = CHANNEL_PATTERN.search(frame)
+    if m is None:
+        return None
+    parts = [chunk.split('"', 20) for chunk in frame.split('{"id":')[1:]]
+    for p in parts:
+        # 1,"side":"BUY","price":999970.0,"size":0.08,"exec_date":"...","buy_child_order_acceptance_id":"...","sell_child_order_acceptance_id":"..."}
+        if (len(p) < 21 or p[1] != 'side' or p[5] != 'price' or p[7] != 'size' or p[9] != 'exec_date'
+                or p[13] != 'buy_child_order_acceptance_id' or p[17] != 'sell_child_order_acceptance_id'):
+            return None
+    cols = ExecutionColumns()
+    cols.id = array('q', [int(p[0][:-1]) for p in parts])
+    cols.side = array('b', [SIDE_CODE.get(p[3], 0) for p in parts])
+    cols.price = array('d', [float(p[6][1:-1]) for p in parts])
+    cols.size = array('d', [float(p[8][1:-1]) for p in parts])
+    cols.exec_date = [p[11] for p in parts]
+    cols.exec_ns = array('q', [parse_exec_date_ns(d) for d in cols.exec_date])
+    cols.buy_child_order_acceptance_id = [p[15] for p in parts]
+    cols.sell_child_order_acceptance_id = [p[19] for p in parts]
+    return m.group(1), cols
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    from time import time
+    from . import fastjson
+    from .recorder import list_segments, read_records
+
+    parser = argparse.ArgumentParser(description="executions decode microbenchmark")
+    parser.add_argument("--dir", dest='dir', type=str, default='capture')
+    parser.add_argument("--product_id", dest='product_id', type=str, default='FX_BTC_JPY')
+    parser.add_argument("--repeat", dest='repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # 記録データからJSON-RPCフレームを再構成する(受信時に付加した項目は除く)
+    channel = 'lightning_executions_' + args.product_id
+    frames = []
+    for path in list_segments(args.dir, channel):
+        for _, _, message in read_records(path):
+            for e in message:
+                e.pop('receved_at', None)
+                e.pop('bucket_size', None)
+            frames.append(json.dumps({'jsonrpc':'2.0','method':'channelMessage',
+                'params':{'channel':channel,'message':message}}, separators=(',',':')))
+    num_executions = sum(f.count('{"id":') for f in frames)
+
+    def decode_dicts(loads):
+        n = 0
+        for f in frames:
+            message = loads(f)
+            if message['method'] == 'channelMessage':
+                n += len(message['params']['message'])
+        return n
+
+    def decode_dicts_to_columns(loads):
+        n = 0
+        for f in frames:
+            message = loads(f)
+            if message['method'] == 'channelMessage':
+                n += len(ExecutionColumns.from_dicts(message['params']['message']))
+        return n
+
+    def decode_columns():
+        n = 0
+        for f in frames:
+            channel, cols = parse_executions_frame(f)
+            n += len(cols)
+        return n
+
+    def bench(name, func, *params):
+        best = None
+        for _ in range(bench.repeat):
+            start = time()
+            func(*params)
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{0:<24} {1:8.3f}ms {2:8.0f} ns/execution'.format(name, best * 1000, best * 1e9 / num_executions))
+    bench.repeat = args.repeat
+
+    print('{0} frames {1} executions'.format(len(frames), num_executions))
+    bench('json.loads', decode_dicts, json.loads)
+    bench('json.loads+columns', decode_dicts_to_columns, json.loads)
+    for b in fastjson.BACKENDS[:-1]:
+        try:
+            fastjson.use(b)
+            bench(b + '.loads', decode_dicts, fastjson.loads)
+            bench(b + '.loads+columns', decode_dicts_to_columns, fastjson.loads)
+        except ImportError:
+            pass
+    bench('parse_executions_frame', decode_columns)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+JSONデコーダ切り換え
+
+インストールされていれば高速なデコーダ(orjson > ujson > rapidjson)を使い、
+なければ標準のjsonを使う. エンコードは送信(購読要求)のみなので標準のjsonを使う.
+
+socketio.Client(json=fastjson) のようにjsonモジュールの代わりとして渡せる.
+"""
+import json
+import logging
+from importlib import import_module
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['orjson', 'ujson', 'rapidjson', 'json']
+
+dumps = json.dumps
+backend = 'json'
+loads = json.loads
+
+def use(name=None):
+    """デコーダを選択する(Noneなら使えるものの中で最速のもの)"""
+    global backend, loads
+    for b in ([name] if name else BACKENDS):
+        try:
+            loads = import_module(b).loads
+            backend = b
+            break
+        except ImportError:
+            if name:
+                raise
+    logger.debug('JSON decoder: ' + backend)
+    return backend
+
+use()
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+マーケットデータハブ
+
+同じホストで複数のbotを動かす時、取引所への接続とJSONのデコードを1プロセスにまとめる.
+ハブはStreamingで受信・デコードしたチャンネルデータをUNIXドメインソケットで各botへ配る.
+botはStreamingの代わりにHubStreamingを使う(Strategyでは settings.stream_hub にソケットのパスを設定).
+
+    python -m flyerbots.hub --path $XDG_RUNTIME_DIR/flyerbots/hub.sock
+
+ソケットは既定でユーザー専用(0700)のディレクトリ($XDG_RUNTIME_DIR/flyerbots か ~/.flyerbots)に作る.
+同じユーザーのプロセス間のみ: 接続相手のuidをSO_PEERCREDで確かめ、違えば切断する(ハブ・bot双方).
+
+フレームは長さ付きのJSON(ExecutionColumnsは約定dictのリストにする. HubStreamingのexecution_columnsで列形式に戻す).
+
+    length   uint32 LE   ペイロード長
+    payload  bytes       JSON [channel, message, receved_at] / 購読要求は ["subscribe", channel]
+"""
+import os
+import json
+import stat
+import socket
+import struct
+import threading
+import logging
+from queue import Queue, Full
+from time import sleep
+from .streaming import Streaming
+from .executions import ExecutionColumns
+from .utils import time_ns
+from . import fastjson
+
+def default_path():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    directory = os.path.join(runtime, 'flyerbots') if runtime else os.path.join(os.path.expanduser('~'), '.flyerbots')
+    return os.path.join(directory, 'hub.sock')
+
+DEFAULT_PATH = default_path()
+
+HEADER = struct.Struct('<I')
+
+def private_directory(path):
+    """ソケットのディレクトリを作り、自分だけが使えることを確かめる"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError('{0} must be owned by the current user and not writable by others'.format(directory))
+
+def same_user(conn):
+    """接続相手が同じユーザーか(SO_PEERCREDがなければ確かめない)"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+def encode_json(obj):
+    if isinstance(obj, ExecutionColumns):
+        return list(obj)
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+def encode_frame(obj):
+    payload = json.dumps(obj, separators=(',', ':'), default=encode_json).encode()
+    return HEADER.pack(len(payload)) + payload
+
+def recv_exact(conn, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf.extend(chunk)
+    return buf
+
+def recv_frame(conn):
+    length, = HEADER.unpack(recv_exact(conn, HEADER.size))
+    return fastjson.loads(bytes(recv_exact(conn, length)))
+
+def message_receved_at(data):
+    if isinstance(data, ExecutionColumns):
+        return data.receved_at
+    if isinstance(data, list) and len(data):
+        return data[-1].get('receved_at')
+    return time_ns()
+
+class MarketDataHub:
+
+    def __init__(self, streaming, path=DEFAULT_PATH, queue_size=10000):
+        self.logger = logging.getLogger(__name__)
+        self.streaming = streaming
+        self.path = path
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.clients = []
+        self.running = False
+        self.published = 0
+
+    def start(self):
+        private_directory(self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # bindした時点で0600にする(chmodまでの間に接続されない)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        self.running = True
+        self.thread = threading.Thread(target=self.accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('Start MarketDataHub ' + self.path)
+        return self
+
+    def stop(self):
+        if self.running:
+            self.logger.info('Stop MarketDataHub')
+            self.running = False
+            self.sock.close()
+            for client in list(self.clients):
+                client.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            if not same_user(conn):
+                self.logger.warning('hub: reject a connection from another user')
+                conn.close()
+                continue
+            client = MarketDataHub.Client(self, conn)
+            with self.lock:
+                self.clients.append(client)
+            client.start()
+
+    def subscribe(self, client, channel):
+        with self.lock:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None:
+                subscribers = self.subscribers[channel] = []
+                first = True
+            else:
+                first = False
+            if client not in subscribers:
+                subscribers.append(client)
+        # 最初の購読者が来たチャンネルだけ取引所に購読要求を出す
+        if first:
+            self.streaming.subscribe_channel(channel, self.publish)
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            for subscribers in self.subscribers.values():
+                if client in subscribers:
+                    subscribers.remove(client)
+
+    def publish(self, channel, data):
+        subscribers = self.subscribers.get(channel)
+        if not subscribers:
+            return
+        # デコード済みのデータを1回だけエンコードして全購読者で共有する
+        frame = encode_frame((channel, data, message_receved_at(data)))
+        for client in list(subscribers):
+            client.send(frame)
+        self.published += 1
+
+    class Client:
+
+        def __init__(self, hub, conn):
+            self.hub = hub
+            self.conn = conn
+            self.queue = Queue(hub.queue_size)
+            self.closed = False
+
+        def start(self):
+            for target in [self.read_loop, self.write_loop]:
+                t = threading.Thread(target=target)
+                t.daemon = True
+                t.start()
+
+        def send(self, frame):
+            try:
+                self.queue.put_nowait(frame)
+            except Full:
+                # 遅い購読者で他の購読者を止めない(切断して再接続させる)
+                self.hub.logger.warning('hub subscriber too slow, disconnect')
+                self.close()
+
+        def close(self):
+            if not self.closed:
+                self.closed = True
+                self.hub.remove(self)
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                # 配信スレッドから呼ばれるので待たない(満杯なら書き込みスレッドがclosedを見て止まる)
+                try:
+                    self.queue.put_nowait(None)
+                except Full:
+                    pass
+
+        def read_loop(self):
+            try:
+                while not self.closed:
+                    method, channel = recv_frame(self.conn)
+                    if method == 'subscribe':
+                        self.hub.subscribe(self, channel)
+            except (ConnectionError, OSError):
+                pass
+            self.close()
+
+        def write_loop(self):
+            try:
+                while True:
+                    frame = self.queue.get()
+                    if frame is None or self.closed:
+                        break
+                    self.conn.sendall(frame)
+            except OSError:
+                pass
+            self.close()
+            self.conn.close()
+
+class HubStreaming(Streaming):
+    """MarketDataHubからチャンネルデータを受け取るStreaming"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        super().__init__()
+        self.transport = 'hub'
+        self.path = path
+        self.conn = None
+        self.send_lock = threading.Lock()
+
+    def subscribe(self, channel):
+        with self.send_lock:
+            self.conn.sendall(encode_frame(('subscribe', channel)))
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run_loop(self):
+        while self.running:
+            try:
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.conn.connect(self.path)
+                if not same_user(self.conn):
+                    raise ConnectionError('hub {0} is run by another user'.format(self.path))
+                self.on_connected()
+                while self.running:
+                    channel, data, receved_at = recv_frame(self.conn)
+                    self.on_data(channel, data, receved_at)
+            except (ConnectionError, OSError) as e:
+                if self.running:
+                    self.logger.info('hub: {0}'.format(e))
+            except Exception as e:
+                self.logger.exception(e)
+            self.on_disconnected()
+            self.conn.close()
+            if self.running:
+                sleep(self.reconnect_delay())
+
+    def start(self):
+        self.logger.info('Start Streaming (hub {0})'.format(self.path))
+        self.running = True
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+if __name__ == "__main__":
+    import argparse
+    from .exchange import Exchange
+
+    parser = argparse.ArgumentParser(description="market data hub")
+    parser.add_argument("--path", dest='path', type=str, default=DEFAULT_PATH)
+    parser.add_argument("--transport", dest='transport', type=str, default='socketio')
+    parser.add_argument("--queue_size", dest='queue_size', type=int, default=10000)
+    parser.add_argument("--disable_backfill", dest='disable_backfill', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    streaming = Streaming()
+    streaming.transport = args.transport
+    if not args.disable_backfill:
+        exchange = Exchange()
+        exchange.start()
+        streaming.enable_backfill(exchange.fetch_executions)
+    hub = MarketDataHub(streaming, args.path, args.queue_size).start()
+    streaming.start()
+    try:
+        while streaming.running:
+            sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    hub.stop()
+    streaming.stop()
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+逐次計算する指標
+
+flyerbots.indicatorの関数と同じ値を、足を1本追加する毎に計算する(更新はO(1)、highest/lowestは償却O(1)).
+update()に新しい足の値を渡すと最新の値を返す. history>0なら直近history個の値をvalues()で返す(コピーしないビュー).
+確定した足だけを渡すこと(未確定の最後の足を作り直すcreate_lazy_ohlcvでは確定した足を渡す).
+
+    ma = SMA(20)
+    z = ZScore(600, history=100)
+    for bar in closed_bars:
+        ma.update(bar.close)
+        z.update(bar.volume_imbalance)
+    ma.value, z.values()
+
+移動窓の平均・分散はWelford法で足し引きし、窓の長さ分の更新毎に窓から計算し直して誤差が溜まらないようにする.
+"""
+import numpy as np
+from math import sqrt, fsum, copysign, inf, nan
+from collections import deque
+
+def div(a, b):
+    """a / b (0除算はnumpyと同じくinf/nan)"""
+    if b == 0:
+        if a != a or a == 0:
+            return nan
+        return copysign(inf, a) * copysign(1, b)
+    return a / b
+
+class History:
+    """値の固定長リングバッファ(2倍の長さの配列に二重に書き、直近maxlen個を連続したビューで返す)"""
+
+    def __init__(self, maxlen, width=1):
+        self.maxlen = maxlen
+        self.width = width
+        self.buffer = np.full((2 * maxlen, width) if width > 1 else 2 * maxlen, nan)
+        self.count = 0
+
+    def append(self, value):
+        i = self.count % self.maxlen
+        self.buffer[i] = self.buffer[i + self.maxlen] = value
+        self.count += 1
+
+    def view(self):
+        n = min(self.count, self.maxlen)
+        end = (self.count - 1) % self.maxlen + self.maxlen + 1 if self.count else 0
+        return self.buffer[end - n:end]
+
+class Indicator:
+
+    outputs = 1
+
+    def __init__(self, history=0):
+        self.value = nan if self.outputs == 1 else (nan,) * self.outputs
+        self.history = History(history, self.outputs) if history else None
+
+    def __call__(self, *args):
+        return self.update(*args)
+
+    def push(self, value):
+        self.value = value
+        if self.history is not None:
+            self.history.append(value)
+        return value
+
+    def values(self):
+        """直近の値(historyを指定した場合)"""
+        return self.history.view()
+
+class Window:
+    """直近period個の値の個数(NaNを除く)・平均・偏差平方和"""
+
+    def __init__(self, period):
+        self.period = int(period)
+        self.queue = deque()
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.removed = 0
+        # 末尾で同じ値が続いている数(窓の値が全て同じなら分散は0. pandasと同じ)
+        self.same = 0
+        self.last = nan
+
+    def push(self, x):
+        self.queue.append(x)
+        if x == x:
+            self.same = self.same + 1 if x == self.last else 1
+            self.last = x
+            self.n += 1
+            d = x - self.mean
+            self.mean += d / self.n
+            self.m2 += d * (x - self.mean)
+        if len(self.queue) > self.period:
+            y = self.queue.popleft()
+            if y == y:
+                self.n -= 1
+                if self.n == 0:
+                    self.mean = self.m2 = 0.0
+                else:
+                    d = y - self.mean
+                    self.mean -= d / self.n
+                    self.m2 -= d * (y - self.mean)
+            self.removed += 1
+            if self.removed >= self.period:
+                self.resync()
+
+    def resync(self):
+        values = [v for v in self.queue if v == v]
+        self.n = len(values)
+        self.mean = fsum(values) / self.n if self.n else 0.0
+        self.m2 = fsum((v - self.mean) ** 2 for v in values)
+        self.removed = 0
+
+    @property
+    def sum(self):
+        return self.mean * self.n
+
+    @property
+    def var(self):
+        if self.n < 2:
+            return nan
+        if self.same >= self.n:
+            return 0.0
+        return max(self.m2, 0.0) / (self.n - 1)
+
+class SMA(Indicator):
+    """sma (min_periods=periodならrolling(period).mean())"""
+
+    def __init__(self, period, min_periods=1, history=0):
+        super().__init__(history)
+        self.window = Window(period)
+        self.min_periods = min_periods
+
+    def update(self, x):
+        w = self.window
+        w.push(x)
+        return self.push(w.mean if w.n >= self.min_periods else nan)
+
+class DSMA(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.sma = SMA(period, period)
+        self.sma2 = SMA(period)
+
+    def update(self, x):
+        sma = self.sma.update(x)
+        return self.push(sma * 2 - self.sma2.update(sma))
+
+class TSMA(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.sma = SMA(period, period)
+        self.sma2 = SMA(period)
+        self.sma3 = SMA(period)
+
+    def update(self, x):
+        sma = self.sma.update(x)
+        sma2 = self.sma2.update(sma)
+        return self.push(sma * 3 - sma2 * 3 + self.sma3.update(sma2))
+
+class EMA(Indicator):
+    """ewm(span=period).mean() (alphaを指定した場合はewm(alpha=alpha))"""
+
+    def __init__(self, period=None, alpha=None, history=0):
+        super().__init__(history)
+        self.decay = 1 - (alpha if alpha is not None else 2.0 / (period + 1))
+        self.weighted = 0.0
+        self.weight = 0.0
+
+    def update(self, x):
+        # adjust=True: 重みの合計で割る. NaNは足さずに減衰だけ進める
+        self.weighted *= self.decay
+        self.weight *= self.decay
+        if x == x:
+            self.weighted += x
+            self.weight += 1.0
+        return self.push(self.weighted / self.weight if self.weight > 0 else nan)
+
+class RMA(EMA):
+
+    def __init__(self, period, history=0):
+        super().__init__(alpha=1.0 / period, history=history)
+
+class DEMA(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.ema = EMA(period)
+        self.ema2 = EMA(period)
+
+    def update(self, x):
+        ema = self.ema.update(x)
+        return self.push(ema * 2 - self.ema2.update(ema))
+
+class TEMA(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.ema = EMA(period)
+        self.ema2 = EMA(period)
+        self.ema3 = EMA(period)
+
+    def update(self, x):
+        ema = self.ema.update(x)
+        ema2 = self.ema2.update(ema)
+        return self.push(ema * 3 - ema2 * 3 + self.ema3.update(ema2))
+
+class Highest(Indicator):
+    """highest (単調減少の両端キューで窓の最大値を保持する)"""
+
+    sign = 1
+
+    def __init__(self, period, min_periods=1, history=0):
+        super().__init__(history)
+        self.period = int(period)
+        self.min_periods = min_periods
+        self.queue = deque()
+        self.valid = deque()
+        self.i = 0
+
+    def update(self, x):
+        i = self.i
+        self.i += 1
+        if self.valid and self.valid[0] <= i - self.period:
+            self.valid.popleft()
+        if self.queue and self.queue[0][0] <= i - self.period:
+            self.queue.popleft()
+        if x == x:
+            self.valid.append(i)
+            k = self.sign * x
+            while self.queue and self.queue[-1][1] <= k:
+                self.queue.pop()
+            self.queue.append((i, k))
+        if len(self.valid) < self.min_periods:
+            return self.push(nan)
+        return self.push(self.sign * self.queue[0][1])
+
+class Lowest(Highest):
+
+    sign = -1
+
+class Variance(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.window = Window(period)
+
+    def update(self, x):
+        self.window.push(x)
+        return self.push(self.window.var)
+
+class Stdev(Variance):
+
+    def update(self, x):
+        self.window.push(x)
+        return self.push(sqrt(self.window.var))
+
+class ZScore(Variance):
+
+    def update(self, x):
+        w = self.window
+        w.push(x)
+        if w.n == 0:
+            return self.push(nan)
+        return self.push(div(x - w.mean, sqrt(w.var)))
+
+class BBand(Indicator):
+    """(upper, lower, middle, sigma)"""
+
+    outputs = 4
+
+    def __init__(self, period, mult=2.0, history=0):
+        super().__init__(history)
+        self.window = Window(period)
+        self.mult = mult
+
+    def update(self, x):
+        w = self.window
+        w.push(x)
+        if w.n < w.period:
+            return self.push((nan, nan, nan, nan))
+        middle = w.mean
+        sigma = sqrt(w.var)
+        return self.push((middle + sigma * self.mult, middle - sigma * self.mult, middle, sigma))
+
+class MACD(Indicator):
+    """(macd, signal, macd-signal)"""
+
+    outputs = 3
+
+    def __init__(self, fastlen, slowlen, siglen, use_sma=False, history=0):
+        super().__init__(history)
+        if use_sma:
+            self.fast = SMA(fastlen, int(fastlen))
+            self.slow = SMA(slowlen, int(slowlen))
+        else:
+            self.fast = EMA(fastlen)
+            self.slow = EMA(slowlen)
+        self.signal = SMA(siglen, int(siglen))
+
+    def update(self, x):
+        macd = self.fast.update(x) - self.slow.update(x)
+        signal = self.signal.update(macd)
+        return self.push((macd, signal, macd - signal))
+
+class RSI(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.positive = EMA(alpha=1.0 / period)
+        self.negative = EMA(alpha=1.0 / period)
+        self.last = nan
+
+    def update(self, x):
+        diff = x - self.last
+        self.last = x
+        positive = self.positive.update(max(diff, 0.0) if diff == diff else nan)
+        negative = self.negative.update(min(diff, 0.0) if diff == diff else nan)
+        return self.push(100 - div(100, 1 - div(positive, negative)))
+
+class TR(Indicator):
+
+    def __init__(self, history=0):
+        super().__init__(history)
+        self.last = nan
+
+    def update(self, close, high, low):
+        tr = high - low
+        last = self.last
+        if last == last:
+            tr = max(tr, abs(high - last), abs(low - last))
+        if close == close:
+            self.last = close
+        return self.push(tr)
+
+class ATR(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.tr = TR()
+        self.rma = RMA(period)
+
+    def update(self, close, high, low):
+        return self.push(self.rma.update(self.tr.update(close, high, low)))
+
+class Stoch(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.highest = Highest(period, int(period))
+        self.lowest = Lowest(period, int(period))
+
+    def update(self, close, high, low):
+        hline = self.highest.update(high)
+        lline = self.lowest.update(low)
+        return self.push(100 * div(close - lline, hline - lline))
+
+class Momentum(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.queue = deque(maxlen=int(period) + 1)
+
+    def update(self, x):
+        self.queue.append(x)
+        if len(self.queue) < self.queue.maxlen:
+            return self.push(nan)
+        return self.push(x - self.queue[0])
+
+class Cumsum(Indicator):
+
+    def __init__(self, period, history=0):
+        super().__init__(history)
+        self.window = Window(period)
+
+    def update(self, x):
+        w = self.window
+        w.push(x)
+        return self.push(w.sum if w.n else nan)
+
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+    from time import time
+    from . import indicator
+
+    parser = argparse.ArgumentParser(description="incremental indicators: self-check against flyerbots.indicator")
+    parser.add_argument("--bars", dest='bars', type=int, default=5000)
+    parser.add_argument("--bench", dest='bench', type=int, default=1000, help='history length for the per-update benchmark')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    n = args.bars
+    close = pd.Series(1000000 + np.cumsum(rng.normal(0, 300, n)))
+    high = close + rng.exponential(200, n)
+    low = close - rng.exponential(200, n)
+    imbalance = pd.Series(rng.normal(0, 2, n))
+    # 横ばい(分散0)の区間も含める
+    flat = close.copy()
+    flat[1000:1100] = flat[1000]
+
+    def run(stream, *sources):
+        out = [stream.update(*x) for x in zip(*[s.values for s in sources])]
+        return np.array(out)
+
+    def check(name, stream, expected, *sources, scale=None):
+        """scale: 許容誤差の基準(省略時は期待値の最大. 分散・標準偏差は入力の大きさで桁落ちするので入力の最大)"""
+        actual = run(stream, *sources)
+        if isinstance(expected, tuple):
+            expected = np.column_stack([e.values for e in expected])
+        else:
+            expected = expected.values
+        if scale is None:
+            scale = np.nanmax(np.abs(expected[np.isfinite(expected)])) if np.isfinite(expected).any() else 1
+        ok = np.allclose(actual, expected, rtol=1e-9, atol=1e-9 * scale, equal_nan=True)
+        err = np.nanmax(np.abs(actual - expected)[np.isfinite(expected)]) if np.isfinite(expected).any() else 0
+        print('{0:<10} {1} max abs err {2:.3g}'.format(name, 'ok  ' if ok else 'FAIL', err))
+        assert ok, name
+
+    for src_name, src in [('close', close), ('flat', flat), ('imbalance', imbalance)]:
+        print('-- ' + src_name)
+        for p in [1, 2, 14, 600]:
+            check('sma {0}'.format(p), SMA(p), indicator.sma(src, p), src)
+        check('dsma', DSMA(10), indicator.dsma(src, 10), src)
+        check('tsma', TSMA(10), indicator.tsma(src, 10), src)
+        check('ema', EMA(10), indicator.ema(src, 10), src)
+        check('dema', DEMA(10), indicator.dema(src, 10), src)
+        check('tema', TEMA(10), indicator.tema(src, 10), src)
+        check('rma', RMA(10), indicator.rma(src, 10), src)
+        check('highest', Highest(14), indicator.highest(src, 14), src)
+        check('lowest', Lowest(14), indicator.lowest(src, 14), src)
+        level = np.abs(src.values).max()
+        check('stdev', Stdev(17), indicator.stdev(src, 17), src, scale=level)
+        check('variance', Variance(17), indicator.variance(src, 17), src, scale=level * np.nanmax(indicator.stdev(src, 17).values))
+        check('zscore', ZScore(600), indicator.zscore(src, 600), src)
+        check('bband', BBand(20, 2.0), indicator.bband(src, 20, 2.0), src, scale=level)
+        check('macd', MACD(12, 26, 9), indicator.macd(src, 12, 26, 9), src)
+        check('macd sma', MACD(12, 26, 9, True), indicator.macd(src, 12, 26, 9, True), src)
+        check('rsi', RSI(14), indicator.rsi(src, 14), src)
+        check('momentum', Momentum(5), indicator.momentum(src, 5), src)
+        check('cumsum', Cumsum(30), indicator.cumsum(src, 30), src)
+    print('-- close/high/low')
+    check('tr', TR(), indicator.tr(close, high, low), close, high, low)
+    check('atr', ATR(14), indicator.atr(close, high, low, 14), close, high, low)
+    check('stoch', Stoch(14), indicator.stoch(close, high, low, 14), close, high, low)
+
+    # 1本追加する毎の計算時間(バッチは直近bench本を毎回計算し直す)
+    m = args.bench
+    print('-- per update, {0} bar history'.format(m))
+    for name, stream, batch in [
+            ('sma', SMA(20), lambda s: indicator.sma(s, 20)),
+            ('stdev', Stdev(20), lambda s: indicator.stdev(s, 20)),
+            ('zscore', ZScore(600), lambda s: indicator.zscore(s, 600))]:
+        values = close.values
+        start = time()
+        for x in values:
+            stream.update(x)
+        stream_us = (time() - start) * 1e6 / n
+        loops = 200
+        start = time()
+        for i in range(loops):
+            batch(close.iloc[i:i + m]).values[-1]
+        batch_us = (time() - start) * 1e6 / loops
+        print('{0:<10} batch {1:9.1f}us  incremental {2:6.2f}us'.format(name, batch_us, stream_us))
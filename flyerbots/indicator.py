@@ -1,8 +1,263 @@
 # -*- coding: utf-8 -*-
+"""
+指標
+
+引数はpandas.Series・numpy配列・リストのどれでもよい. 計算はnumbaのカーネルでnumpy配列に対して行い、
+最初の引数がSeriesなら同じindexのSeriesで、それ以外はnumpy配列で返す(disable_rich_ohlcvではindexを作らない).
+NaNの扱い・最初の足の値はpandasのrolling/ewmと同じ.
+memo.cache.enabledなら足のバッファを渡した指標は足が変わるまで結果を使い回す(memo.py).
+"""
 import pandas as pd
 import numpy as np
 from functools import lru_cache
 from numba import jit, b1, f8, i8, void
+from .memo import memoize as __memoize__
+
+def __values__(source):
+    """Series・リスト→float64のnumpy配列"""
+    if isinstance(source, pd.Series):
+        v = source.to_numpy(np.float64)
+    else:
+        v = np.asarray(source, np.float64)
+    if not v.flags.writeable:
+        # numbaのシグネチャは書き込み可能な配列(memmap等の読み出し専用はコピーする)
+        v = v.copy()
+    return v
+
+def __like__(source, r):
+    """sourceがSeriesなら同じindexのSeriesにする"""
+    if isinstance(source, pd.Series):
+        return pd.Series(r, index=source.index)
+    return r
+
+@jit(void(f8[:],i8,i8,b1,f8[:]),nopython=True,cache=True)
+def __rolling_sum__(v, p, minp, mean, r):
+    # 補正付きの足し引き. 窓の長さ分の更新毎に足し直して誤差を溜めない
+    n = len(v)
+    s = 0.0
+    c = 0.0
+    count = 0
+    removed = 0
+    for i in range(n):
+        x = v[i]
+        if x == x:
+            y = x - c
+            t = s + y
+            c = (t - s) - y
+            s = t
+            count += 1
+        if i >= p:
+            x = v[i-p]
+            if x == x:
+                y = -x - c
+                t = s + y
+                c = (t - s) - y
+                s = t
+                count -= 1
+            removed += 1
+            if removed >= p:
+                s = 0.0
+                c = 0.0
+                for j in range(i-p+1, i+1):
+                    if v[j] == v[j]:
+                        s += v[j]
+                removed = 0
+        if count >= minp and count > 0:
+            r[i] = s / count if mean else s
+        else:
+            r[i] = np.nan
+
+@jit(void(f8[:],i8,i8,f8[:],f8[:]),nopython=True,cache=True)
+def __rolling_var__(v, p, minp, m, r):
+    # Welford法の足し引き(ddof=1). 窓の値が全て同じなら0(pandasと同じ)
+    n = len(v)
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    removed = 0
+    same = 0
+    last = np.nan
+    for i in range(n):
+        x = v[i]
+        if x == x:
+            if x == last:
+                same += 1
+            else:
+                same = 1
+            last = x
+            count += 1
+            d = x - mean
+            mean += d / count
+            m2 += d * (x - mean)
+        if i >= p:
+            y = v[i-p]
+            if y == y:
+                count -= 1
+                if count == 0:
+                    mean = 0.0
+                    m2 = 0.0
+                else:
+                    d = y - mean
+                    mean -= d / count
+                    m2 -= d * (y - mean)
+            removed += 1
+            if removed >= p:
+                count = 0
+                mean = 0.0
+                for j in range(i-p+1, i+1):
+                    if v[j] == v[j]:
+                        count += 1
+                        mean += v[j]
+                mean = mean / count if count else 0.0
+                m2 = 0.0
+                for j in range(i-p+1, i+1):
+                    if v[j] == v[j]:
+                        m2 += (v[j] - mean) ** 2
+                removed = 0
+        if count >= minp and count > 0:
+            m[i] = mean
+            if count < 2:
+                r[i] = np.nan
+            elif same >= count:
+                r[i] = 0.0
+            else:
+                r[i] = max(m2, 0.0) / (count - 1)
+        else:
+            m[i] = np.nan
+            r[i] = np.nan
+
+@jit(void(f8[:],i8,i8,f8,f8[:]),nopython=True,cache=True)
+def __rolling_max__(v, p, minp, sign, r):
+    # 単調減少の両端キュー(sign=-1なら最小値)
+    n = len(v)
+    q = np.empty(n, np.int64)
+    head = 0
+    tail = 0
+    count = 0
+    for i in range(n):
+        x = v[i]
+        if x == x:
+            count += 1
+            while tail > head and sign * v[q[tail-1]] <= sign * x:
+                tail -= 1
+            q[tail] = i
+            tail += 1
+        if i >= p and v[i-p] == v[i-p]:
+            count -= 1
+        while tail > head and q[head] <= i - p:
+            head += 1
+        if count >= minp and tail > head:
+            r[i] = v[q[head]]
+        else:
+            r[i] = np.nan
+
+@jit(void(f8[:],f8,f8[:]),nopython=True,cache=True)
+def __ewm__(v, alpha, r):
+    # ewm(adjust=True).mean(). NaNは足さずに減衰だけ進める
+    decay = 1.0 - alpha
+    weighted = 0.0
+    weight = 0.0
+    for i in range(len(v)):
+        weighted *= decay
+        weight *= decay
+        if v[i] == v[i]:
+            weighted += v[i]
+            weight += 1.0
+        r[i] = weighted / weight if weight > 0 else np.nan
+
+@jit(void(f8[:],f8[:],f8[:],f8[:]),nopython=True,cache=True)
+def __tr_core__(close, high, low, r):
+    last = np.nan
+    for i in range(len(close)):
+        tr = high[i] - low[i]
+        if last == last:
+            d = abs(high[i] - last)
+            if d > tr:
+                tr = d
+            d = abs(low[i] - last)
+            if d > tr:
+                tr = d
+        r[i] = tr
+        if close[i] == close[i]:
+            last = close[i]
+
+@jit(void(f8[:],f8[:],i8,f8[:]),nopython=True,cache=True)
+def __corr_core__(a, b, p, r):
+    n = len(a)
+    for i in range(n):
+        r[i] = np.nan
+        if i < p - 1:
+            continue
+        ma = 0.0
+        mb = 0.0
+        valid = True
+        # どちらかが一定の窓は相関なし(NaN)
+        same_a = True
+        same_b = True
+        for j in range(i-p+1, i+1):
+            if a[j] != a[j] or b[j] != b[j]:
+                valid = False
+                break
+            same_a = same_a and a[j] == a[i]
+            same_b = same_b and b[j] == b[i]
+            ma += a[j]
+            mb += b[j]
+        if not valid or same_a or same_b:
+            continue
+        ma /= p
+        mb /= p
+        sab = 0.0
+        saa = 0.0
+        sbb = 0.0
+        for j in range(i-p+1, i+1):
+            sab += (a[j] - ma) * (b[j] - mb)
+            saa += (a[j] - ma) ** 2
+            sbb += (b[j] - mb) ** 2
+        if saa > 0 and sbb > 0:
+            r[i] = sab / np.sqrt(saa * sbb)
+
+def rolling_sum(v, period, min_periods=1):
+    r = np.empty(len(v))
+    __rolling_sum__(v, int(period), int(min_periods), False, r)
+    return r
+
+def rolling_mean(v, period, min_periods=1):
+    r = np.empty(len(v))
+    __rolling_sum__(v, int(period), int(min_periods), True, r)
+    return r
+
+def rolling_var(v, period, min_periods=1):
+    """(平均, 分散)"""
+    m = np.empty(len(v))
+    r = np.empty(len(v))
+    __rolling_var__(v, int(period), int(min_periods), m, r)
+    return m, r
+
+def rolling_max(v, period, min_periods=1):
+    r = np.empty(len(v))
+    __rolling_max__(v, int(period), int(min_periods), 1.0, r)
+    return r
+
+def rolling_min(v, period, min_periods=1):
+    r = np.empty(len(v))
+    __rolling_max__(v, int(period), int(min_periods), -1.0, r)
+    return r
+
+def ewm(v, alpha):
+    r = np.empty(len(v))
+    __ewm__(v, float(alpha), r)
+    return r
+
+def shift(v, period):
+    period = int(period)
+    if period == 0:
+        return v.copy()
+    r = np.full(len(v), np.nan)
+    if period > 0:
+        r[period:] = v[:-period]
+    else:
+        r[:period] = v[-period:]
+    return r
 
 @jit(void(f8[:],i8,i8,f8[:]),nopython=True)
 def __sma_core__(v, n, p, r):
@@ -21,101 +276,131 @@ def __sma_core__(v, n, p, r):
         wp = (wp + 1) % p
     r[n-1] = sum / p
 
+@__memoize__(lookback=lambda source, period: period)
 def fastsma(source, period):
-    v = source.values
+    v = __values__(source)
     n = len(v)
     p = int(period)
     r = np.empty(n)
-    __sma_core__(v,n,period,r)
-    return pd.Series(r, index=source.index)
+    __sma_core__(v,n,p,r)
+    return __like__(source, r)
 
+@__memoize__(lookback=lambda source, period: period)
 def sma(source, period):
-    period = int(period)
-    return source.rolling(period,min_periods=1).mean()
+    return __like__(source, rolling_mean(__values__(source), period))
 
+@__memoize__(lookback=lambda source, period: 2 * int(period) - 1)
 def dsma(source, period):
     period = int(period)
-    sma = source.rolling(period).mean()
-    return (sma * 2) - sma.rolling(period,min_periods=1).mean()
+    sma = rolling_mean(__values__(source), period, period)
+    return __like__(source, (sma * 2) - rolling_mean(sma, period))
 
+@__memoize__(lookback=lambda source, period: 3 * int(period) - 2)
 def tsma(source, period):
     period = int(period)
-    sma = source.rolling(period).mean()
-    sma2 = sma.rolling(period,min_periods=1).mean()
-    return (sma * 3) - (sma2 * 3) + sma2.rolling(period,min_periods=1).mean()
+    sma = rolling_mean(__values__(source), period, period)
+    sma2 = rolling_mean(sma, period)
+    return __like__(source, (sma * 3) - (sma2 * 3) + rolling_mean(sma2, period))
 
+@__memoize__()
 def ema(source, period):
     # alpha = 2.0 / (period + 1)
-    return source.ewm(span=period).mean()
+    return __like__(source, ewm(__values__(source), 2.0 / (period + 1)))
 
+@__memoize__()
 def dema(source, period):
-    ema = source.ewm(span=period).mean()
-    return (ema * 2) - ema.ewm(span=period).mean()
+    alpha = 2.0 / (period + 1)
+    ema = ewm(__values__(source), alpha)
+    return __like__(source, (ema * 2) - ewm(ema, alpha))
 
+@__memoize__()
 def tema(source, period):
-    ema = source.ewm(span=period).mean()
-    ema2 = ema.ewm(span=period).mean()
-    return (ema * 3) - (ema2 * 3) + ema2.ewm(span=period).mean()
+    alpha = 2.0 / (period + 1)
+    ema = ewm(__values__(source), alpha)
+    ema2 = ewm(ema, alpha)
+    return __like__(source, (ema * 3) - (ema2 * 3) + ewm(ema2, alpha))
 
+@__memoize__()
 def rma(source, period):
     alpha = 1.0 / (period)
-    return source.ewm(alpha=alpha).mean()
+    return __like__(source, ewm(__values__(source), alpha))
 
+@__memoize__(lookback=lambda source, period: period)
 def highest(source, period):
-    period = int(period)
-    return source.rolling(period,min_periods=1).max()
+    return __like__(source, rolling_max(__values__(source), period))
 
+@__memoize__(lookback=lambda source, period: period)
 def lowest(source, period):
-    period = int(period)
-    return source.rolling(period,min_periods=1).min()
+    return __like__(source, rolling_min(__values__(source), period))
 
+@__memoize__(lookback=lambda source, period: period)
 def stdev(source, period):
-    period = int(period)
-    return source.rolling(period,min_periods=1).std()
+    return __like__(source, np.sqrt(rolling_var(__values__(source), period)[1]))
 
+@__memoize__(lookback=lambda source, period: period)
 def variance(source, period):
-    period = int(period)
-    return source.rolling(period,min_periods=1).var()
+    return __like__(source, rolling_var(__values__(source), period)[1])
 
+@__memoize__()
 def rsi(source, period):
-    diff = source.diff()
+    diff = np.diff(__values__(source), prepend=np.nan)
     alpha = 1.0 / (period)
-    positive = diff.clip_lower(0).ewm(alpha=alpha).mean()
-    negative = diff.clip_upper(0).ewm(alpha=alpha).mean()
-    rsi = 100-100/(1-positive/negative)
-    return rsi
+    positive = ewm(np.maximum(diff, 0), alpha)
+    negative = ewm(np.minimum(diff, 0), alpha)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100-100/(1-positive/negative)
+    return __like__(source, rsi)
 
+@__memoize__(3, lambda close, high, low, period: period)
 def stoch(close, high, low, period):
     period = int(period)
-    hline = high.rolling(period).max()
-    lline = low.rolling(period).min()
-    return 100 * (close - lline) / (hline - lline)
+    hline = rolling_max(__values__(high), period, period)
+    lline = rolling_min(__values__(low), period, period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return __like__(close, 100 * (__values__(close) - lline) / (hline - lline))
 
+@__memoize__(lookback=lambda source, period: period + 1 if period >= 0 else None)
 def momentum(source, period):
-    return source - source.shift(int(period))
+    v = __values__(source)
+    return __like__(source, v - shift(v, period))
 
+@__memoize__(lookback=lambda source, period, mult=2.0: period)
 def bband(source, period, mult=2.0):
     period = int(period)
-    middle = source.rolling(period).mean()
-    sigma = source.rolling(period).std()
+    middle, var = rolling_var(__values__(source), period, period)
+    sigma = np.sqrt(var)
     upper = middle+sigma*mult
     lower = middle-sigma*mult
-    return (upper, lower, middle, sigma)
+    return (__like__(source, upper), __like__(source, lower), __like__(source, middle), __like__(source, sigma))
 
+@__memoize__(lookback=lambda source, fastlen, slowlen, siglen, use_sma=False: max(fastlen, slowlen) + siglen - 1 if use_sma else None)
 def macd(source, fastlen, slowlen, siglen, use_sma=False):
+    v = __values__(source)
     if use_sma:
-        macd = source.rolling(int(fastlen)).mean() - source.rolling(int(slowlen)).mean()
+        macd = rolling_mean(v, fastlen, fastlen) - rolling_mean(v, slowlen, slowlen)
     else:
-        macd = source.ewm(span=fastlen).mean() - source.ewm(span=slowlen).mean()
-    signal = macd.rolling(int(siglen)).mean()
-    return (macd, signal, macd-signal)
+        macd = ewm(v, 2.0 / (fastlen + 1)) - ewm(v, 2.0 / (slowlen + 1))
+    signal = rolling_mean(macd, siglen, siglen)
+    return (__like__(source, macd), __like__(source, signal), __like__(source, macd-signal))
 
+@__memoize__(lookback=lambda source, period: period)
 def hlband(source, period):
     period = int(period)
-    high = source.rolling(period).max()
-    low = source.rolling(period).min()
-    return (high, low)
+    v = __values__(source)
+    high = rolling_max(v, period, period)
+    low = rolling_min(v, period, period)
+    return (__like__(source, high), __like__(source, low))
+
+def __vixfix_bands__(source, wvf, bbl, mult, lb, ph, pl):
+    midLine, var = rolling_var(wvf, bbl, bbl)
+    sDev = mult * np.sqrt(var)
+    lowerBand = midLine - sDev
+    upperBand = midLine + sDev
+    rangeHigh = rolling_max(wvf, lb, lb) * ph
+    rangeLow = rolling_min(wvf, lb, lb) * pl
+    return tuple(__like__(source, r) for r in (wvf, lowerBand, upperBand, rangeHigh, rangeLow))
 
+@__memoize__(2, lambda close, low, period=22, bbl=20, mult=2.0, lb=50, ph=0.85, pl=1.01: period + max(bbl, lb) - 1)
 def wvf(close, low, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85, pl=1.01):
     """
     period: LookBack Period Standard Deviation High
@@ -125,21 +410,12 @@ def wvf(close, low, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85, pl=1.
     ph:     Highest Percentile - 0.90=90%, 0.95=95%, 0.99=99%
     pl:     Lowest Percentile - 1.10=90%, 1.05=95%, 1.01=99%
     """
-    bbl = int(bbl)
-    lb = int(lb)
-    period = int(period)
     # VixFix
-    close_max = close.rolling(period).max()
-    wvf = ((close_max - low) / close_max) * 100
-
-    sDev = mult * wvf.rolling(bbl).std()
-    midLine = wvf.rolling(bbl).mean()
-    lowerBand = midLine - sDev
-    upperBand = midLine + sDev
-    rangeHigh = wvf.rolling(lb).max() * ph
-    rangeLow = wvf.rolling(lb).min() * pl
-    return (wvf, lowerBand, upperBand, rangeHigh, rangeLow)
+    close_max = rolling_max(__values__(close), period, period)
+    wvf = ((close_max - __values__(low)) / close_max) * 100
+    return __vixfix_bands__(close, wvf, bbl, mult, lb, ph, pl)
 
+@__memoize__(2, lambda close, high, period=22, bbl=20, mult=2.0, lb=50, ph=0.85, pl=1.01: period + max(bbl, lb) - 1)
 def wvf_inv(close, high, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85, pl=1.01):
     """
     period: LookBack Period Standard Deviation High
@@ -149,46 +425,30 @@ def wvf_inv(close, high, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85,
     ph:     Highest Percentile - 0.90=90%, 0.95=95%, 0.99=99%
     pl:     Lowest Percentile - 1.10=90%, 1.05=95%, 1.01=99%
     """
-    bbl = int(bbl)
-    lb = int(lb)
-    period = int(period)
     # VixFix_inverse
-    close_min = close.rolling(period).min()
-    wvf_inv = abs(((close_min - high) / close_min) * 100)
-
-    sDev = mult * wvf_inv.rolling(bbl).std()
-    midLine = wvf_inv.rolling(bbl).mean()
-    lowerBand = midLine - sDev
-    upperBand = midLine + sDev
-    rangeHigh = wvf_inv.rolling(lb).max() * ph
-    rangeLow = wvf_inv.rolling(lb).min() * pl
-    return (wvf_inv, lowerBand, upperBand, rangeHigh, rangeLow)
+    close_min = rolling_min(__values__(close), period, period)
+    wvf_inv = np.abs(((close_min - __values__(high)) / close_min) * 100)
+    return __vixfix_bands__(close, wvf_inv, bbl, mult, lb, ph, pl)
 
+@__memoize__(3)
 def tr(close, high, low):
-    last = close.shift(1).fillna(method='ffill')
-    tr = high - low
-    diff_hc = (high - last).abs()
-    diff_lc = (low - last).abs()
-    tr[diff_hc > tr] = diff_hc
-    tr[diff_lc > tr] = diff_lc
-    return tr
+    r = np.empty(len(close))
+    __tr_core__(__values__(close), __values__(high), __values__(low), r)
+    return __like__(close, r)
 
+@__memoize__(3)
 def atr(close, high, low, period):
-    last = close.shift(1).fillna(method='ffill')
-    tr = high - low
-    diff_hc = (high - last).abs()
-    diff_lc = (low - last).abs()
-    tr[diff_hc > tr] = diff_hc
-    tr[diff_lc > tr] = diff_lc
-    return tr.ewm(alpha=1.0/period).mean()
+    r = np.empty(len(close))
+    __tr_core__(__values__(close), __values__(high), __values__(low), r)
+    return __like__(close, ewm(r, 1.0/period))
 
 def crossover(a, b):
-    cond1 = (a > b)
-    return cond1 & (~cond1).shift(1)
+    cond1 = np.asarray(__values__(a) > (__values__(b) if np.ndim(b) else b))
+    return __like__(a, cond1 & np.concatenate(([False], ~cond1[:-1])))
 
 def crossunder(a, b):
-    cond1 = (a < b)
-    return cond1 & (~cond1).shift(1)
+    cond1 = np.asarray(__values__(a) < (__values__(b) if np.ndim(b) else b))
+    return __like__(a, cond1 & np.concatenate(([False], ~cond1[:-1])))
 
 def last(source, period=0):
     """
@@ -196,44 +456,65 @@ def last(source, period=0):
     last(close, 0)  現在の足
     last(close, 1)  1つ前の足
     """
-    return source.values[int(-1-period)]
+    if isinstance(source, pd.Series):
+        source = source.values
+    return source[int(-1-period)]
 
 def totuple(source):
-    return tuple(source.values.flatten())
+    return tuple(np.asarray(source).flatten())
 
 def tolist(source):
-    return list(source.values.flatten())
+    return list(np.asarray(source).flatten())
+
+def __change__(source, period):
+    v = __values__(source)
+    diff = v - shift(v, period)
+    diff[np.isnan(diff)] = 0
+    return diff
 
+@__memoize__(lookback=lambda source, period=1: period + 1 if period >= 0 else None)
 def change(source, period=1):
-    return source.diff(period).fillna(0)
+    return __like__(source, __change__(source, period))
 
+@__memoize__(lookback=lambda source, period=1: period + 1 if period >= 0 else None)
 def falling(source, period=1):
-    return source.diff(period).fillna(0)<0
+    return __like__(source, __change__(source, period)<0)
 
+@__memoize__(lookback=lambda source, period=1: period + 1 if period >= 0 else None)
 def rising(source, period=1):
-    return source.diff(period).fillna(0)>0
+    return __like__(source, __change__(source, period)>0)
 
+@__memoize__(lookback=lambda source, period=1: period + 1)
 def fallingcnt(source, period=1):
-    return (source.diff()<0).rolling(period, min_periods=1).sum()
+    v = __values__(source)
+    with np.errstate(invalid='ignore'):
+        falling = (v - shift(v, 1) < 0).astype(np.float64)
+    return __like__(source, rolling_sum(falling, period))
 
+@__memoize__(lookback=lambda source, period=1: period + 1)
 def risingcnt(source, period=1):
-    return (source.diff()>0).rolling(period, min_periods=1).sum()
+    v = __values__(source)
+    with np.errstate(invalid='ignore'):
+        rising = (v - shift(v, 1) > 0).astype(np.float64)
+    return __like__(source, rolling_sum(rising, period))
 
+@__memoize__(lookback=lambda source, leftbars, rightbars: int(leftbars) + int(rightbars) + 1)
 def pivothigh(source, leftbars, rightbars):
     leftbars = int(leftbars)
     rightbars = int(rightbars)
-    high = source.rolling(leftbars).max()
-    diff = high.diff()
-    pvhi = pd.Series(high[diff >= 0], index=source.index)
-    return pvhi.shift(rightbars) if rightbars > 0 else pvhi
+    high = rolling_max(__values__(source), leftbars, leftbars)
+    diff = high - shift(high, 1)
+    pvhi = np.where(diff >= 0, high, np.nan)
+    return __like__(source, shift(pvhi, rightbars) if rightbars > 0 else pvhi)
 
+@__memoize__(lookback=lambda source, leftbars, rightbars: int(leftbars) + int(rightbars) + 1)
 def pivotlow(source, leftbars, rightbars):
     leftbars = int(leftbars)
     rightbars = int(rightbars)
-    low = source.rolling(leftbars).min()
-    diff = low.diff()
-    pvlo = pd.Series(low[diff <= 0], index=source.index)
-    return pvlo.shift(rightbars) if rightbars > 0 else pvlo
+    low = rolling_min(__values__(source), leftbars, leftbars)
+    diff = low - shift(low, 1)
+    pvlo = np.where(diff <= 0, low, np.nan)
+    return __like__(source, shift(pvlo, rightbars) if rightbars > 0 else pvlo)
 
 @jit(void(f8[:],f8[:],i8,f8,f8,f8,f8[:]),nopython=True)
 def __sar_core__(high, low, n, start, inc, max, sar):
@@ -262,19 +543,19 @@ def __sar_core__(high, low, n, start, inc, max, sar):
                 acc = start
                 sar[i] = ep
 
+@__memoize__(2)
 def fastsar(high, low, start, inc, max):
-    index = high.index
-    high = high.values
-    low = low.values
-    n = len(high)
+    h = __values__(high)
+    n = len(h)
     sar = np.empty(n)
-    __sar_core__(high, low, n, start, inc, max, sar)
-    return pd.Series(sar, index=index)
+    __sar_core__(h, __values__(low), n, start, inc, max, sar)
+    return __like__(high, sar)
 
+@__memoize__(2)
 def sar(high, low, start, inc, max):
-    index = high.index
-    high = high.values
-    low = low.values
+    source = high
+    high = __values__(high)
+    low = __values__(low)
     n = len(high)
     sar = np.empty(n)
     sar[0] = low[0]
@@ -301,23 +582,25 @@ def sar(high, low, start, inc, max):
                 long = True
                 acc = start
                 sar[i] = ep
-    return pd.Series(sar, index=index)
+    return __like__(source, sar)
 
+@__memoize__(2, lambda a, b, period=1: max(period, 1))
 def minimum(a, b, period=1):
-    c = a.copy()
-    c[a > b] = b
+    va = __values__(a)
+    c = np.where(va > __values__(b), __values__(b), va)
     if period < 2:
-        return c
+        return __like__(a, c)
     period = int(period)
-    return c.rolling(period).min()
+    return __like__(a, rolling_min(c, period, period))
 
+@__memoize__(2, lambda a, b, period=1: max(period, 1))
 def maximum(a, b, period=1):
-    c = a.copy()
-    c[a < b] = b
+    va = __values__(a)
+    c = np.where(va < __values__(b), __values__(b), va)
     if period < 2:
-        return c
+        return __like__(a, c)
     period = int(period)
-    return c.rolling(period).max()
+    return __like__(a, rolling_max(c, period, period))
 
 @lru_cache(maxsize=None)
 def fib(n):
@@ -354,14 +637,102 @@ def __rci_core__(v, n, p, r):
     for i in range(p-1, n):
         r[i] = ((1.0 - (6.0 * __rci_d__(v, i, p)) / k)) * 100.0
 
+@jit(i8(i8[:],i8),nopython=True,cache=True)
+def __bit_sum__(tree, k):
+    s = 0
+    while k > 0:
+        s += tree[k]
+        k -= k & -k
+    return s
+
+@jit(void(i8[:],i8,i8),nopython=True,cache=True)
+def __bit_add__(tree, k, d):
+    while k < len(tree):
+        tree[k] += d
+        k += k & -k
+
+@jit(void(f8[:],i8[:],i8,i8,f8[:]),nopython=True,cache=True)
+def __rolling_rci__(v, rank, u, p, r):
+    # __rci_core__と同じ値をO(n log u)で計算する(uは値の種類数、rankは値の順位(1..u, NaNは0)).
+    # 窓の足eの経過本数a(最新が0)・順位o=1+G(Gは値がより大きい足の数. 同値は同じ順位)から
+    #   d = Σ(a+1)^2 - 2Σ(a+1)o + Σo^2
+    #   Σo^2 = p + 2ΣG + ΣG^2,  Σ(a+1)o = (i+1)(p+ΣG) - Σt - ΣtG  (tは足の番号、a=i-t)
+    # ΣG・ΣG^2・ΣtGを足の出入り毎に更新する. 値の順位毎の個数c・c^2・tの和をBITで持ち、
+    # 値がzより小さい足のGの和は N*C - (C^2+Q)/2 (C・Qはzより小さい値のcとc^2の和)
+    n = len(v)
+    cnt = np.zeros(u + 1, np.int64)
+    sq = np.zeros(u + 1, np.int64)
+    tsum = np.zeros(u + 1, np.int64)
+    c = np.zeros(u + 1, np.int64)
+    k = (p * (p ** 2 - 1))
+    j2 = p * (p + 1) * (2 * p + 1) // 6
+    N = 0
+    G = 0
+    G2 = 0
+    T = 0
+    TG = 0
+    nan = 0
+    for i in range(n):
+        # 足i-pを出して足iを入れる(出し入れの差分は同じ式で符号が逆)
+        for step in range(2):
+            t = i - p + step * p
+            sign = 2 * step - 1
+            if t < 0:
+                continue
+            z = rank[t]
+            if z == 0:
+                nan += sign
+                continue
+            if sign < 0:
+                N -= 1
+                c[z] -= 1
+                __bit_add__(cnt, z, -1)
+                __bit_add__(sq, z, -2 * c[z] - 1)
+                __bit_add__(tsum, z, -t)
+            less = __bit_sum__(cnt, z - 1)
+            greater = N - __bit_sum__(cnt, z)
+            sumg = N * less - (less * less + __bit_sum__(sq, z - 1)) // 2
+            G += sign * (less + greater)
+            G2 += sign * (2 * sumg + less + greater * greater)
+            T += sign * t
+            TG += sign * (t * greater + __bit_sum__(tsum, z - 1))
+            if sign > 0:
+                N += 1
+                __bit_add__(cnt, z, 1)
+                __bit_add__(sq, z, 2 * c[z] + 1)
+                __bit_add__(tsum, z, t)
+                c[z] += 1
+        if i < p - 1:
+            r[i] = np.nan
+        elif nan:
+            # NaNを含む窓は比較の結果が変わるのでそのまま数える
+            r[i] = ((1.0 - (6.0 * __rci_d__(v, i, p)) / k)) * 100.0
+        else:
+            d = j2 - 2 * ((i + 1) * (p + G) - T - TG) + p + 2 * G + G2
+            r[i] = ((1.0 - (6.0 * d) / k)) * 100.0
+
+@__memoize__(lookback=lambda source, period: period)
 def fastrci(source, period):
-    v = source.values
+    v = __values__(source)
     n = len(v)
     p = int(period)
     r = np.empty(n)
-    __rci_core__(v,n,p,r)
-    return pd.Series(r, index=source.index)
-
+    if n < p:
+        r[:] = np.nan
+        return __like__(source, r)
+    if p <= 12:
+        # 短い期間は窓内の比較(O(p^2))の方が速い(値は同じ)
+        __rci_core__(v,n,p,r)
+        return __like__(source, r)
+    # 値の順位(同値は同じ順位)
+    valid = v == v
+    values = np.unique(v[valid])
+    rank = np.zeros(n, np.int64)
+    rank[valid] = np.searchsorted(values, v[valid]) + 1
+    __rolling_rci__(v, rank, len(values), p, r)
+    return __like__(source, r)
+
+@__memoize__(lookback=lambda source, period: period)
 def rci(source, period):
     """
     ord(seq, idx, itv) =>
@@ -380,7 +751,7 @@ def rci(source, period):
     rci(itv) => (1.0 - 6.0 * d(itv) / (itv * (itv * itv - 1.0))) * 100.0
     """
     period = int(period)
-    v = source.values
+    v = __values__(source)
     n = len(v)
     r = np.empty(n)
     for i in range(period-1):
@@ -402,28 +773,68 @@ def rci(source, period):
     for i in range(period-1, n):
         r[i] = ((1.0 - (6.0 * d(i)) / k)) * 100.0
 
-    return pd.Series(r, index=source.index)
+    return __like__(source, r)
 
-def polyfline(source, period, deg=2):
+@lru_cache(maxsize=None)
+def __polyfit_weights__(period, deg):
+    """
+    x=0..period-1にdeg次の多項式を最小二乗で当てはめた時の、x=period-1での(値, 傾き, 2階微分)の重み.
+    xが固定なので正規方程式の解は窓の値の線形結合になる(xは0..1に縮めて解く)
+    """
+    x = np.linspace(0, 1, period)
+    powers = np.arange(deg + 1)
+    solve = np.linalg.pinv(x[:, None] ** powers)
+    scale = period - 1 if period > 1 else 1
+    return (np.ones(deg + 1) @ solve,
+        (powers @ solve) / scale,
+        ((powers * (powers - 1)) @ solve) / scale ** 2)
+
+@jit(void(f8[:],f8[:],b1,f8[:]),nopython=True,cache=True)
+def __polyfit_core__(v, w, value, r):
+    # 窓毎に窓の平均を引いてから重みを掛けて桁落ちを抑える(値の重みの和は1、傾き・2階微分は0)
+    p = len(w)
+    for i in range(p, len(v)):
+        m = 0.0
+        for k in range(i-p, i):
+            m += v[k]
+        m /= p
+        s = 0.0
+        for k in range(p):
+            s += w[k] * (v[i-p+k] - m)
+        r[i] = s + m if value else s
+
+def __polyfit__(source, period, deg, output):
+    """v[i-period:i]に当てはめた多項式のx=period-1での値(output=0)・傾き(1)・2階微分(2)"""
     period = int(period)
-    deg = int(deg)
-    v = source.values
-    n = len(v)
-    x = np.linspace(0, period-1, period)
-    poly = np.empty(n)
-    for i in range(0, period):
-        poly[i] = np.nan
-    for i in range(period, n):
-        p = np.poly1d(np.polyfit(x, v[i-period:i], deg))
-        poly[i] = p(period-1)
-    return pd.Series(poly, index=source.index)
+    v = __values__(source)
+    r = np.full(len(v), np.nan)
+    if len(v) > period:
+        __polyfit_core__(v, __polyfit_weights__(period, int(deg))[output], output == 0, r)
+    return __like__(source, r)
+
+@__memoize__(lookback=lambda source, period, deg=2: int(period) + 1)
+def polyfline(source, period, deg=2):
+    return __polyfit__(source, period, deg, 0)
 
+@__memoize__(lookback=lambda source, period, deg=2: int(period) + 1)
+def polyfslope(source, period, deg=2):
+    """polyflineの多項式の傾き(1本あたり)"""
+    return __polyfit__(source, period, deg, 1)
+
+@__memoize__(lookback=lambda source, period, deg=2: int(period) + 1)
+def polyfcurve(source, period, deg=2):
+    """polyflineの多項式の2階微分(deg=1なら0)"""
+    return __polyfit__(source, period, deg, 2)
+
+@__memoize__(2, lambda source_a, source_b, period: period)
 def correlation(source_a, source_b, period):
-    period = int(period)
-    return source_a.rolling(period).corr(source_b)
+    r = np.empty(len(source_a))
+    __corr_core__(__values__(source_a), __values__(source_b), int(period), r)
+    return __like__(source_a, r)
 
+@__memoize__(lookback=lambda source, period: period)
 def cumsum(source, period):
-    return source.rolling(int(period),min_periods=1).sum()
+    return __like__(source, rolling_sum(__values__(source), period))
 
 def hlc3(ohlcv):
     return (ohlcv.high+ohlcv.low+ohlcv.close)/3
@@ -431,112 +842,183 @@ def hlc3(ohlcv):
 def ohlc4(ohlcv):
     return (ohlcv.open+ohlcv.high+ohlcv.low+ohlcv.close)/4
 
+@__memoize__(lookback=lambda source, period: period)
 def zscore(source, period):
-    period = int(period)
-    std = source.rolling(period,min_periods=1).std()
-    avg = source.rolling(period,min_periods=1).mean()
-    return (source-avg)/std
+    v = __values__(source)
+    avg, var = rolling_var(v, period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return __like__(source, (v-avg)/np.sqrt(var))
 
 if __name__ == '__main__':
-
-    from .utils import stop_watch
-
-    # p0 = 8000 #初期値
-    # vola = 15.0 #ボラティリティ(%)
-    # dn = np.random.randint(2, size=1000)*2-1
-    # scale = vola/100/np.sqrt(365*24*60)
-    # gwalk = np.cumprod(np.exp(scale*dn))*p0
-    # data = pd.Series(gwalk)
-
-    ohlc = pd.read_csv('csv/bitmex_2018_1h.csv', index_col='timestamp', parse_dates=True)
-
-    fastsma = stop_watch(fastsma)
-    sma = stop_watch(sma)
-    dsma = stop_watch(dsma)
-    tsma = stop_watch(tsma)
-    ema = stop_watch(ema)
-    dema = stop_watch(dema)
-    tema = stop_watch(tema)
-    rma = stop_watch(rma)
-    rsi = stop_watch(rsi)
-    stoch = stop_watch(stoch)
-    wvf = stop_watch(wvf)
-    highest = stop_watch(highest)
-    lowest = stop_watch(lowest)
-    macd = stop_watch(macd)
-    tr = stop_watch(tr)
-    atr = stop_watch(atr)
-    pivothigh = stop_watch(pivothigh)
-    pivotlow = stop_watch(pivotlow)
-    sar = stop_watch(sar)
-    fastsar = stop_watch(fastsar)
-    minimum = stop_watch(minimum)
-    maximum = stop_watch(maximum)
-    rci = stop_watch(rci)
-    fastrci = stop_watch(fastrci)
-    polyfline = stop_watch(polyfline)
-    corr = stop_watch(corr)
-
-    vfastsma = fastsma(ohlc.close, 10)
-    vsma = sma(ohlc.close, 10)
-    vdsma = dsma(ohlc.close, 10)
-    vtsma = tsma(ohlc.close, 10)
-    vema = ema(ohlc.close, 10)
-    vdema = dema(ohlc.close, 10)
-    vtema = tema(ohlc.close, 10)
-    vrma = rma(ohlc.close, 10)
-    vrsi = rsi(ohlc.close, 14)
-    vstoch = stoch(vrsi, vrsi, vrsi, 14)
-    (vwvf, lowerBand, upperBand, rangeHigh, rangeLow) = wvf(ohlc.close, ohlc.low)
-    vhighest = highest(ohlc.high, 14)
-    vlowest = lowest(ohlc.low, 14)
-    (vmacd, vsig, vhist) = macd(ohlc.close, 9, 26, 5)
-    vtr = tr(ohlc.close, ohlc.high, ohlc.low)
-    vatr = atr(ohlc.close, ohlc.high, ohlc.low, 14)
-    vpivoth = pivothigh(ohlc.high, 4, 2).ffill()
-    vpivotl = pivotlow(ohlc.low, 4, 2).ffill()
-    vsar = sar(ohlc.high, ohlc.low, 0.02, 0.02, 0.2)
-    vfastsar = fastsar(ohlc.high, ohlc.low, 0.02, 0.02, 0.2)
-    vmin = minimum(ohlc.open, ohlc.close, 14)
-    vmax = maximum(ohlc.open, ohlc.close, 14)
-    vrci = rci(ohlc.open, 14)
-    vfastrci = fastrci(ohlc.open, 14)
-    vply = polyfline(ohlc.open, 14)
-    vcorr = corr(ohlc.close, ohlc.volume, 14)
-    df = pd.DataFrame({
-        'high':ohlc.high,
-        'low':ohlc.low,
-        'close':ohlc.close,
-        'fastsma':vfastsma,
-        'sma':vsma,
-        'dsma':vdsma,
-        'tsma':vtsma,
-        'ema':vema,
-        'dema':vdema,
-        'tema':vtema,
-        'rma':vrma,
-        'rsi':vrsi,
-        'stochrsi':vstoch,
-        'wvf':vwvf,
-        'wvf-upper':upperBand,
-        'wvf-lower':lowerBand,
-        'wvf-high':rangeHigh,
-        'wvf-low':rangeLow,
-        'highest':vhighest,
-        'lowest':vlowest,
-        'macd':vmacd,
-        'macd-signal':vsig,
-        'tr':vtr,
-        'atr':vatr,
-        'pivot high':vpivoth,
-        'pivot low':vpivotl,
-        'sar':vsar,
-        'fastsar':vfastsar,
-        'min':vmin,
-        'max':vmax,
-        'rci':vrci,
-        'fastrci':vfastrci,
-        'polyfit':vply,
-        'corr':vcorr,
-        }, index=ohlc.index)
-    print(df.to_csv())
+    import argparse
+    from time import time
+
+    parser = argparse.ArgumentParser(description="indicators: check against pandas and time numpy vs Series input")
+    parser.add_argument("--bars", dest='bars', type=int, default=5000)
+    parser.add_argument("--loops", dest='loops', type=int, default=200)
+    parser.add_argument("--csv", dest='csv', type=str, default=None, help='print indicators of an OHLC csv (timestamp,open,high,low,close,volume)')
+    parser.add_argument("--rci", dest='rci', action='store_true', help='time fastrci (BIT) vs the O(p^2) kernel and rci for p in 9,26,52,104 over 100k bars')
+    args = parser.parse_args()
+
+    if args.rci:
+        rng = np.random.default_rng(7)
+        # 1秒足を想定して同値を多めにする
+        v = np.round(1000000 + np.cumsum(rng.normal(0, 300, 100000)), -2)
+        print('{0:>5} {1:>14} {2:>14} {3:>14}'.format('p', 'fastrci ms', 'O(p^2) ms', 'rci ms'))
+        for p in [9, 26, 52, 104]:
+            start = time()
+            a = fastrci(v, p)
+            t_bit = (time() - start) * 1000
+            b = np.empty(len(v))
+            start = time()
+            __rci_core__(v, len(v), p, b)
+            t_core = (time() - start) * 1000
+            start = time()
+            rci(v, p)
+            t_rci = (time() - start) * 1000
+            assert np.array_equal(a, b, equal_nan=True)
+            print('{0:>5} {1:14.1f} {2:14.1f} {3:14.1f}'.format(p, t_bit, t_core, t_rci))
+        raise SystemExit
+
+    if args.csv:
+        ohlc = pd.read_csv(args.csv, index_col='timestamp', parse_dates=True)
+        (vwvf, lowerBand, upperBand, rangeHigh, rangeLow) = wvf(ohlc.close, ohlc.low)
+        (vmacd, vsig, vhist) = macd(ohlc.close, 9, 26, 5)
+        vrsi = rsi(ohlc.close, 14)
+        df = pd.DataFrame({
+            'high':ohlc.high, 'low':ohlc.low, 'close':ohlc.close,
+            'fastsma':fastsma(ohlc.close, 10), 'sma':sma(ohlc.close, 10), 'dsma':dsma(ohlc.close, 10), 'tsma':tsma(ohlc.close, 10),
+            'ema':ema(ohlc.close, 10), 'dema':dema(ohlc.close, 10), 'tema':tema(ohlc.close, 10), 'rma':rma(ohlc.close, 10),
+            'rsi':vrsi, 'stochrsi':stoch(vrsi, vrsi, vrsi, 14),
+            'wvf':vwvf, 'wvf-upper':upperBand, 'wvf-lower':lowerBand, 'wvf-high':rangeHigh, 'wvf-low':rangeLow,
+            'highest':highest(ohlc.high, 14), 'lowest':lowest(ohlc.low, 14), 'macd':vmacd, 'macd-signal':vsig,
+            'tr':tr(ohlc.close, ohlc.high, ohlc.low), 'atr':atr(ohlc.close, ohlc.high, ohlc.low, 14),
+            'pivot high':pivothigh(ohlc.high, 4, 2).ffill(), 'pivot low':pivotlow(ohlc.low, 4, 2).ffill(),
+            'sar':sar(ohlc.high, ohlc.low, 0.02, 0.02, 0.2), 'fastsar':fastsar(ohlc.high, ohlc.low, 0.02, 0.02, 0.2),
+            'min':minimum(ohlc.open, ohlc.close, 14), 'max':maximum(ohlc.open, ohlc.close, 14),
+            'rci':rci(ohlc.open, 14), 'fastrci':fastrci(ohlc.open, 14), 'polyfit':polyfline(ohlc.open, 14),
+            'polyfit-slope':polyfslope(ohlc.open, 14), 'polyfit-curve':polyfcurve(ohlc.open, 14),
+            'corr':correlation(ohlc.close, ohlc.volume, 14),
+            }, index=ohlc.index)
+        print(df.to_csv())
+        raise SystemExit
+
+    # pandasで計算していた時の実装(比較用)
+    def pd_tr(close, high, low):
+        last = close.shift(1).ffill()
+        tr = high - low
+        diff_hc = (high - last).abs()
+        diff_lc = (low - last).abs()
+        tr[diff_hc > tr] = diff_hc
+        tr[diff_lc > tr] = diff_lc
+        return tr
+
+    def pd_rsi(source, period):
+        diff = source.diff()
+        positive = diff.clip(lower=0).ewm(alpha=1.0/period).mean()
+        negative = diff.clip(upper=0).ewm(alpha=1.0/period).mean()
+        return 100-100/(1-positive/negative)
+
+    def pd_wvf(close, low):
+        close_max = close.rolling(22).max()
+        w = ((close_max - low) / close_max) * 100
+        sDev = 2.0 * w.rolling(20).std()
+        midLine = w.rolling(20).mean()
+        return (w, midLine - sDev, midLine + sDev, w.rolling(50).max() * 0.85, w.rolling(50).min() * 1.01)
+
+    def pd_pivothigh(source, leftbars, rightbars):
+        high = source.rolling(leftbars).max()
+        diff = high.diff()
+        return pd.Series(high[diff >= 0], index=source.index).shift(rightbars)
+
+    def pd_minimum(a, b, period):
+        c = a.copy()
+        c[a > b] = b
+        return c.rolling(period).min()
+
+    def pd_crossover(a, b):
+        cond1 = (a > b)
+        return cond1 & ~(cond1.shift(1, fill_value=True))
+
+    rng = np.random.default_rng(7)
+    n = args.bars
+    close = pd.Series(1000000 + np.cumsum(rng.normal(0, 300, n)))
+    close[1000:1100] = close[1000]
+    high = close + rng.exponential(200, n)
+    low = close - rng.exponential(200, n)
+    volume = pd.Series(rng.exponential(3, n))
+    level = close.abs().max()
+
+    def bands(r, *ref):
+        return tuple(zip(r, ref))
+
+    cases = [
+        ('sma', lambda s: sma(s, 14), lambda: close.rolling(14, min_periods=1).mean()),
+        ('dsma', lambda s: dsma(s, 10), lambda: close.rolling(10).mean() * 2 - close.rolling(10).mean().rolling(10, min_periods=1).mean()),
+        ('ema', lambda s: ema(s, 10), lambda: close.ewm(span=10).mean()),
+        ('tema', lambda s: tema(s, 10), lambda: close.ewm(span=10).mean() * 3 - close.ewm(span=10).mean().ewm(span=10).mean() * 3
+            + close.ewm(span=10).mean().ewm(span=10).mean().ewm(span=10).mean()),
+        ('rma', lambda s: rma(s, 10), lambda: close.ewm(alpha=0.1).mean()),
+        ('highest', lambda s: highest(s, 14), lambda: close.rolling(14, min_periods=1).max()),
+        ('lowest', lambda s: lowest(s, 14), lambda: close.rolling(14, min_periods=1).min()),
+        ('stdev', lambda s: stdev(s, 17), lambda: close.rolling(17, min_periods=1).std()),
+        ('zscore', lambda s: zscore(s, 600), lambda: (close - close.rolling(600, min_periods=1).mean()) / close.rolling(600, min_periods=1).std()),
+        ('rsi', lambda s: rsi(s, 14), lambda: pd_rsi(close, 14)),
+        ('momentum', lambda s: momentum(s, 5), lambda: close - close.shift(5)),
+        ('cumsum', lambda s: cumsum(s, 30), lambda: close.rolling(30, min_periods=1).sum()),
+        ('change', lambda s: change(s, 3), lambda: close.diff(3).fillna(0)),
+        ('risingcnt', lambda s: risingcnt(s, 10), lambda: (close.diff() > 0).rolling(10, min_periods=1).sum()),
+        ('pivothigh', lambda s: pivothigh(s, 4, 2), lambda: pd_pivothigh(close, 4, 2)),
+        ('minimum', lambda s: minimum(s, high, 14), lambda: pd_minimum(close, high, 14)),
+        ('crossover', lambda s: crossover(s, high.shift(3).fillna(0)), lambda: pd_crossover(close, high.shift(3).fillna(0))),
+        ('tr', lambda s: tr(s, high, low), lambda: pd_tr(close, high, low)),
+        ('atr', lambda s: atr(s, high, low, 14), lambda: pd_tr(close, high, low).ewm(alpha=1/14).mean()),
+        ('stoch', lambda s: stoch(s, high, low, 14), lambda: 100 * (close - low.rolling(14).min()) / (high.rolling(14).max() - low.rolling(14).min())),
+        ('bband', lambda s: bband(s, 20, 2.0), lambda: (close.rolling(20).mean() + 2 * close.rolling(20).std(),
+            close.rolling(20).mean() - 2 * close.rolling(20).std(), close.rolling(20).mean(), close.rolling(20).std())),
+        ('macd', lambda s: macd(s, 12, 26, 9), lambda: (lambda m: (m, m.rolling(9).mean(), m - m.rolling(9).mean()))(
+            close.ewm(span=12).mean() - close.ewm(span=26).mean())),
+        ('wvf', lambda s: wvf(s, low), lambda: pd_wvf(close, low)),
+        ('correlation', lambda s: correlation(s, volume, 14), lambda: close.rolling(14).corr(volume).where(close.rolling(14).std() > 0)),
+    ]
+
+    print('{0:<12} {1:>5} {2:>12} {3:>12} {4:>12}'.format('', 'check', 'pandas us', 'Series us', 'ndarray us'))
+    values = close.values
+    for name, func, reference in cases:
+        expected = reference()
+        actual = func(close)
+        as_array = func(values)
+        for a, b, e in zip(*[x if isinstance(x, tuple) else (x,) for x in (actual, as_array, expected)]):
+            assert isinstance(a, pd.Series) and a.index is close.index and isinstance(b, np.ndarray), name
+            e = e.values.astype(float)
+            # 分散を使う指標は入力の大きさで桁落ちする(pandas自身の誤差)
+            atol = 1e-9 * max(level, np.nanmax(np.abs(e[np.isfinite(e)]), initial=1))
+            assert np.allclose(a.values.astype(float), e, rtol=1e-9, atol=atol, equal_nan=True), name
+            assert np.array_equal(a.values.astype(float), b.astype(float), equal_nan=True), name
+
+        def bench(func, *params):
+            start = time()
+            for _ in range(args.loops):
+                func(*params)
+            return (time() - start) * 1e6 / args.loops
+        print('{0:<12} {1:>5} {2:12.1f} {3:12.1f} {4:12.1f}'.format(name, 'ok', bench(reference), bench(func, close), bench(func, values)))
+
+    # polyfline・polyfslope・polyfcurveは足毎のnp.polyfitと比べる(遅いので1000本. 価格の水準が大きく動く系列)
+    head = values[:1000] + np.linspace(0, 1e8, 1000)
+    for period, deg in [(14, 1), (20, 2), (50, 3)]:
+        x = np.linspace(0, period-1, period)
+        expected = np.full((3, len(head)), np.nan)
+        start = time()
+        for i in range(period, len(head)):
+            # 比較する側も窓の平均を引いて当てはめる
+            m = head[i-period:i].mean()
+            p = np.poly1d(np.polyfit(x, head[i-period:i] - m, deg))
+            expected[:, i] = p(period-1) + m, p.deriv()(period-1), p.deriv(2)(period-1) if deg > 1 else 0.0
+        elapsed = (time() - start) * 1e6
+        start = time()
+        actual = (polyfline(head, period, deg), polyfslope(head, period, deg), polyfcurve(head, period, deg))
+        for a, e in zip(actual, expected):
+            # 2階微分は0をまたぐので、その系列の大きさに対する誤差も許す
+            atol = 1e-9 * np.nanmax(np.abs(e[np.isfinite(e)]), initial=1)
+            assert np.allclose(a, e, rtol=1e-9, atol=atol, equal_nan=True), ('polyfit', period, deg)
+        print('{0:<12} {1:>5} {2:12.1f} {3:>12} {4:12.1f}'.format('polyfit{0}/{1}'.format(deg, period), 'ok', elapsed, '', (time() - start) * 1e6))
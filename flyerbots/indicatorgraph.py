@@ -0,0 +1,662 @@
+# -*- coding: utf-8 -*-
+"""
+指標の依存グラフ
+
+yoursetupで使う指標を登録しておくと、途中の計算(列・ローリング平均/分散・最大/最小・EMA・TR等)を
+(演算, 入力, 引数)が同じものは1つのノードにまとめ、足毎に1回だけ計算して各指標に配る.
+bband・zscore・stdev・variance は同じ窓のローリング平均/分散を、highest・hlband・stoch はローリング最大/最小を、
+ema・dema・tema・macd はEMAの連鎖を、atr は tr を共有する.
+
+    def mysetup(strategy):
+        g = strategy.indicators
+        g.add('bb', 'bband', 'close', 20)
+        g.add('z', 'zscore', 'close', 20)
+        g.add('dema', 'dema', 'close', 9)
+        g.add('atr', 'atr', 'close', 'high', 'low', 14)
+        g.add('rsi', 'rsi', 'close', 14)            # 分解していない指標は関数のまま1つのノード
+        g.add('rsi_sma', 'sma', g['rsi'], 5)        # 登録した指標を入力にする
+
+    def mylogic(ticker, ohlcv, strategy, **other):
+        ind = strategy.indicators.update(ohlcv)
+        upper, lower, middle, sigma = ind.bb
+
+ノードの値は足のバッファ(OHLCVColumns)と同じ並びのリングバッファに持ち、全ノードを1つのnumbaカーネルで足毎に計算する.
+ohlcvの列が足のバッファのビューなら、updateは追加・更新された足だけ計算する(1本あたりノード数×窓の長さで、足の本数に依らない).
+それ以外(配列・DataFrame等)は毎回全部の足を計算する. 分解していない指標は毎回その関数で計算する.
+
+入力は列名か登録した指標(ノード). 値はindicatorの同じ関数に追ってきた全ての足を渡した場合と同じ
+(足のバッファから落ちた足も窓・EMAに含む. 丸め分だけ違うことがある).
+返す配列・Seriesはリングバッファのビュー(コピーしない)なので、次のupdateまでに使うこと.
+"""
+import weakref
+import numpy as np
+import pandas as pd
+from numba import jit, f8, i8, void
+from . import indicator
+from .indicator import __values__
+from .memo import locate
+from .utils import dotdict
+
+# ノードの演算
+COLUMN = 0
+MEAN = 1
+SUM = 2
+VAR = 3
+MAX = 4
+MIN = 5
+EWM = 6
+SHIFT = 7
+TR = 8
+SQRT = 9
+SUB = 10
+SCALE = 11
+AFFINE = 12
+COMBINE2 = 13
+COMBINE3 = 14
+ZSCORE = 15
+STOCH = 16
+VIXFIX = 17
+VIXFIX_INV = 18
+
+NAMES = ['column', 'mean', 'sum', 'var', 'max', 'min', 'ewm', 'shift', 'tr', 'sqrt', 'sub', 'scale', 'affine',
+    'combine2', 'combine3', 'zscore', 'stoch', 'vixfix', 'vixfix_inv']
+
+# 値の行に続けて使う作業用の行数(EWMは重み付きの和と重み、TRは直前の有効な終値)
+EXTRA_ROWS = {EWM: 2, TR: 1}
+
+@jit(void(i8[:,:],f8[:],f8[:,:],f8[:,:],i8,i8,i8),nopython=True,cache=True,error_model='numpy')
+def __run_ops__(ops, k, cols, buf, start, lo, hi):
+    # ops[j] = (演算, 出力の行, 入力の行a, b, c, 窓の長さ, min_periods)、k[j]は演算の係数
+    # bufの各行は長さ2mで、足tをt%mとt%m+mの2か所に書く. 窓はstartより前の足を含めない
+    m = buf.shape[1] // 2
+    for t in range(lo, hi):
+        i = t % m
+        h = (t - 1) % m
+        for j in range(len(ops)):
+            op = ops[j, 0]
+            o = ops[j, 1]
+            a = ops[j, 2]
+            b = ops[j, 3]
+            c = ops[j, 4]
+            w = max(t - ops[j, 5] + 1, start)
+            r = np.nan
+            if op == COLUMN:
+                r = cols[a, t - lo]
+            elif op == MEAN or op == SUM:
+                s = 0.0
+                count = 0
+                for u in range(w, t + 1):
+                    x = buf[a, u % m]
+                    if x == x:
+                        s += x
+                        count += 1
+                if count >= ops[j, 6] and count > 0:
+                    r = s / count if op == MEAN else s
+            elif op == VAR:
+                # 窓の平均を引いて足す(ddof=1). 窓の値が全て同じなら0
+                s = 0.0
+                count = 0
+                first = np.nan
+                same = True
+                for u in range(w, t + 1):
+                    x = buf[a, u % m]
+                    if x == x:
+                        if count == 0:
+                            first = x
+                        elif x != first:
+                            same = False
+                        s += x
+                        count += 1
+                if count >= ops[j, 6] and count >= 2:
+                    if same:
+                        r = 0.0
+                    else:
+                        mean = s / count
+                        s = 0.0
+                        for u in range(w, t + 1):
+                            x = buf[a, u % m]
+                            if x == x:
+                                s += (x - mean) * (x - mean)
+                        r = s / (count - 1)
+            elif op == MAX or op == MIN:
+                count = 0
+                for u in range(w, t + 1):
+                    x = buf[a, u % m]
+                    if x == x:
+                        if count == 0 or (x > r if op == MAX else x < r):
+                            r = x
+                        count += 1
+                if count < ops[j, 6] or count == 0:
+                    r = np.nan
+            elif op == EWM:
+                # indicator.ewmと同じ足し方. 前の足の重み付きの和と重みをo+1, o+2行に持つ
+                decay = 1.0 - k[j]
+                weighted = 0.0
+                weight = 0.0
+                if t > start:
+                    weighted = buf[o + 1, h] * decay
+                    weight = buf[o + 2, h] * decay
+                x = buf[a, i]
+                if x == x:
+                    weighted += x
+                    weight += 1.0
+                buf[o + 1, i] = buf[o + 1, i + m] = weighted
+                buf[o + 2, i] = buf[o + 2, i + m] = weight
+                if weight > 0:
+                    r = weighted / weight
+            elif op == SHIFT:
+                if t - ops[j, 5] >= start:
+                    r = buf[a, (t - ops[j, 5]) % m]
+            elif op == TR:
+                # 入力はclose, high, low. 直前の有効な終値をo+1行に持つ
+                last = buf[o + 1, h] if t > start else np.nan
+                r = buf[b, i] - buf[c, i]
+                if last == last:
+                    d = abs(buf[b, i] - last)
+                    if d > r:
+                        r = d
+                    d = abs(buf[c, i] - last)
+                    if d > r:
+                        r = d
+                x = buf[a, i]
+                buf[o + 1, i] = buf[o + 1, i + m] = x if x == x else last
+            elif op == SQRT:
+                r = np.sqrt(buf[a, i])
+            elif op == SUB:
+                r = buf[a, i] - buf[b, i]
+            elif op == SCALE:
+                r = buf[a, i] * k[j]
+            elif op == AFFINE:
+                r = buf[a, i] + buf[b, i] * k[j]
+            elif op == COMBINE2:
+                r = (buf[a, i] * k[j]) - buf[b, i]
+            elif op == COMBINE3:
+                r = (buf[a, i] * k[j]) - (buf[b, i] * k[j]) + buf[c, i]
+            elif op == ZSCORE:
+                r = (buf[a, i] - buf[b, i]) / np.sqrt(buf[c, i])
+            elif op == STOCH:
+                r = 100 * (buf[a, i] - buf[c, i]) / (buf[b, i] - buf[c, i])
+            elif op == VIXFIX:
+                r = ((buf[a, i] - buf[b, i]) / buf[a, i]) * 100
+            elif op == VIXFIX_INV:
+                r = abs(((buf[a, i] - buf[b, i]) / buf[a, i]) * 100)
+            buf[o, i] = buf[o, i + m] = r
+
+class Node:
+    __slots__ = ('key', 'op', 'inputs', 'params', 'row', 'value')
+
+    def __init__(self, key, op, inputs, params):
+        self.key = key
+        self.op = op
+        self.inputs = inputs
+        self.params = params
+        # リングバッファの行と、関数のノードが複数の値を返した場合の値
+        self.row = None
+        self.value = None
+
+    def __repr__(self):
+        return 'Node({0})'.format(self.op.__name__ if isinstance(self.op, Call) else NAMES[self.op])
+
+class Call:
+    """indicatorの関数をそのまま呼ぶ演算(関数名と引数が同じなら同じノード)"""
+
+    def __init__(self, name, args, kwargs):
+        f = getattr(indicator, name)
+        # メモ化(memo)の前の関数
+        self.func = getattr(f, '__wrapped__', f)
+        self.__name__ = name
+        self.args = args
+        self.kwargs = kwargs
+        self.key = (name, args, tuple(sorted(kwargs.items())))
+
+    def __call__(self, *values):
+        return self.func(*values, *self.args, **self.kwargs)
+
+    def __eq__(self, other):
+        return isinstance(other, Call) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+class IndicatorGraph:
+
+    def __init__(self):
+        # (演算, 入力のキー, 引数)→ノード. 入力より後に追加するので追加順に計算すればよい
+        self.nodes = {}
+        # 名前→ノード(複数の出力はノードのタプル)
+        self.outputs = {}
+        self.values = dotdict()
+        # 名前→出力の行(複数の出力は行のタプル. 関数のノードを含む出力はノードのまま)
+        self.layout = None
+        # (列のノード, 計算順の手順, 窓の最大, 行数). 手順は演算の配列の組か関数のノード
+        self.plan = None
+        # ノードの値のリングバッファ(行×2m)
+        self.buf = None
+        # 追っている足のバッファとそのversion・計算を始めた足・計算した最後の足の次
+        self.owner = None
+        self.version = None
+        self.start = 0
+        self.done = 0
+        # 前回返した値の(先頭の足, 本数)とSeriesのindex
+        self.view = None
+        self.index = None
+
+    def __getitem__(self, name):
+        return self.outputs[name]
+
+    def __contains__(self, name):
+        return name in self.outputs
+
+    def node(self, op, *inputs, params=()):
+        key = (op, tuple(n.key for n in inputs), params)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = Node(key, op, inputs, params)
+            self.plan = None
+        return node
+
+    def column(self, name):
+        return self.node(COLUMN, params=(name,))
+
+    def source(self, source):
+        if isinstance(source, Node):
+            return source
+        if isinstance(source, str):
+            return self.column(source)
+        raise TypeError('source must be a column name or a Node: {0!r}'.format(source))
+
+    def window(self, op, v, period, min_periods=1):
+        period = int(period)
+        if period < 1:
+            raise ValueError('period must be >= 1: {0}'.format(period))
+        return self.node(op, v, params=(period, int(min_periods)))
+
+    def mean(self, v, period, min_periods=1):
+        return self.window(MEAN, v, period, min_periods)
+
+    def moments(self, v, period, min_periods=1):
+        """(ローリング平均, 分散)"""
+        return self.window(MEAN, v, period, min_periods), self.window(VAR, v, period, min_periods)
+
+    def highest(self, v, period, min_periods=1):
+        return self.window(MAX, v, period, min_periods)
+
+    def lowest(self, v, period, min_periods=1):
+        return self.window(MIN, v, period, min_periods)
+
+    def ewm(self, v, alpha):
+        return self.node(EWM, v, params=(float(alpha),))
+
+    def shift(self, v, period):
+        period = int(period)
+        if period < 0:
+            raise ValueError('period must be >= 0: {0}'.format(period))
+        return self.node(SHIFT, v, params=(period,))
+
+    def add(self, name, func, *args, **kwargs):
+        """
+        指標を登録して出力のノード(複数ならタプル)を返す
+        func    indicatorの関数名
+        args    入力(列名・ノード)に続けて関数と同じ引数
+        """
+        n = 0
+        while n < len(args) and isinstance(args[n], (str, Node)):
+            n += 1
+        sources = [self.source(s) for s in args[:n]]
+        build = BUILDERS.get(func)
+        if build is not None:
+            output = build(self, *sources, *args[n:], **kwargs)
+        else:
+            # 分解していない指標は関数のまま1つのノードにする
+            output = self.node(Call(func, args[n:], kwargs), *sources)
+        self.outputs[name] = output
+        self.layout = None
+        return output
+
+    def build(self):
+        """ノードにリングバッファの行を割り当て、関数のノードで区切って演算の配列にする"""
+        columns = []
+        steps = []
+        ops = []
+        k = []
+        rows = 0
+        lookback = 1
+
+        def flush():
+            if ops:
+                steps.append((np.array(ops, np.int64), np.array(k, np.float64)))
+                ops.clear()
+                k.clear()
+
+        for node in self.nodes.values():
+            node.row = rows
+            node.value = None
+            if isinstance(node.op, Call):
+                rows += 1
+                flush()
+                steps.append(node)
+                continue
+            rows += 1 + EXTRA_ROWS.get(node.op, 0)
+            inputs = [n.row for n in node.inputs] + [0] * (3 - len(node.inputs))
+            period = minp = 0
+            scale = 0.0
+            if node.op == COLUMN:
+                inputs[0] = len(columns)
+                columns.append(node)
+            elif node.op in (MEAN, SUM, VAR, MAX, MIN):
+                period, minp = node.params
+            elif node.op == SHIFT:
+                period = node.params[0]
+            elif node.params:
+                scale = node.params[0]
+            lookback = max(lookback, period + 1)
+            ops.append([node.op, node.row] + inputs + [period, minp])
+            k.append(scale)
+        flush()
+        self.plan = (columns, steps, lookback, rows)
+        self.buf = None
+        self.layout = None
+
+    def block(self, first, n):
+        """全ての行の足[first, first + n)のビュー"""
+        m = self.buf.shape[1] // 2
+        end = (first + n - 1) % m + m + 1
+        return self.buf[:, end - n:end]
+
+    def update(self, ohlcv):
+        """ohlcvで全ノードを計算し、名前→値を返す(同じ足なら前回の値)"""
+        if self.plan is None:
+            self.build()
+        columns, steps, lookback, rows = self.plan
+        sources = [ohlcv[node.params[0]] for node in columns]
+        if len(sources) == 0:
+            return self.values
+        n = len(sources[0])
+        owner = None
+        first = 0
+        located = locate(sources[0])
+        if located is not None:
+            owner, _, first = located
+            for source in sources[1:]:
+                located = locate(source)
+                if located is None or located[0] is not owner or located[2] != first or len(source) != n:
+                    owner = None
+                    first = 0
+                    break
+
+        # 足のバッファのビューなら前回から変わった足だけ計算する
+        size = 2 * (max(owner.maxlen if owner is not None else n, n) + lookback)
+        changed = None
+        if owner is not None and self.buf is not None and self.owner is not None and self.owner() is owner and self.buf.shape[1] >= size:
+            changed = owner.changed_since(self.version)
+            if changed is not None and min(changed, self.done) < first:
+                # 計算していない足がバッファから落ちた
+                changed = None
+        if changed is None:
+            if self.buf is None or self.buf.shape[1] < size:
+                self.buf = np.full((rows, size), np.nan)
+            self.start = lo = first
+        else:
+            lo = min(changed, self.done)
+        hi = first + n
+        self.owner = weakref.ref(owner) if owner is not None else None
+        self.version = owner.version if owner is not None else None
+        self.done = hi
+
+        like = sources[0]
+        index = like.index if isinstance(like, pd.Series) else None
+        if lo < hi:
+            cols = np.empty((len(sources), hi - lo))
+            for j, source in enumerate(sources):
+                cols[j] = __values__(source)[lo - first:]
+            for step in steps:
+                if isinstance(step, Node):
+                    self.call(step, first, n, lo)
+                else:
+                    __run_ops__(step[0], step[1], cols, self.buf, self.start, lo, hi)
+        elif self.view == (first, n) and index is self.index:
+            return self.values
+        block = self.block(first, n)
+        if isinstance(like, pd.Series):
+            self.values = dotdict({name:self.wrap(output, block, like) for name, output in self.outputs.items()})
+        else:
+            if self.layout is None:
+                self.layout = [(name, self.rows(output)) for name, output in self.outputs.items()]
+            self.values = values = dotdict()
+            for name, rows in self.layout:
+                if rows.__class__ is int:
+                    values[name] = block[rows]
+                elif rows.__class__ is tuple:
+                    values[name] = tuple([block[r] for r in rows])
+                else:
+                    values[name] = self.wrap(rows, block, like)
+        self.view = (first, n)
+        self.index = index
+        return self.values
+
+    def call(self, node, first, n, lo):
+        """関数のノードを足[first, first + n)で計算し、変わった足[lo, first + n)をリングバッファに書く"""
+        block = self.block(first, n)
+        value = node.op(*[block[i.row] for i in node.inputs])
+        if isinstance(value, tuple):
+            node.value = tuple(__values__(v) for v in value)
+            return
+        value = __values__(value)
+        m = self.buf.shape[1] // 2
+        t = lo
+        while t < first + n:
+            # リングバッファの折り返しで分けて書く
+            i = t % m
+            w = min(first + n - t, m - i)
+            self.buf[node.row, i:i + w] = self.buf[node.row, i + m:i + m + w] = value[t - first:t - first + w]
+            t += w
+
+    def rows(self, output):
+        """出力の行(関数のノードを含む場合は出力のまま)"""
+        if isinstance(output, tuple):
+            rows = tuple(self.rows(o) for o in output)
+            return rows if all(r.__class__ is int for r in rows) else output
+        return output if isinstance(output.op, Call) else output.row
+
+    def wrap(self, output, block, like):
+        if isinstance(output, tuple):
+            return tuple(self.wrap(o, block, like) for o in output)
+        if output.value is not None:
+            values = output.value
+            if isinstance(like, pd.Series):
+                values = tuple(pd.Series(v, index=like.index, copy=False) for v in values)
+            return values
+        if isinstance(like, pd.Series):
+            return pd.Series(block[output.row], index=like.index, copy=False)
+        return block[output.row]
+
+# 指標名→ノードの組み立て(引数はindicatorの関数と同じ)
+
+def build_dsma(g, v, period):
+    period = int(period)
+    sma = g.mean(v, period, period)
+    return g.node(COMBINE2, sma, g.mean(sma, period), params=(2.0,))
+
+def build_tsma(g, v, period):
+    period = int(period)
+    sma = g.mean(v, period, period)
+    sma2 = g.mean(sma, period)
+    return g.node(COMBINE3, sma, sma2, g.mean(sma2, period), params=(3.0,))
+
+def build_dema(g, v, period):
+    alpha = 2.0 / (period + 1)
+    ema = g.ewm(v, alpha)
+    return g.node(COMBINE2, ema, g.ewm(ema, alpha), params=(2.0,))
+
+def build_tema(g, v, period):
+    alpha = 2.0 / (period + 1)
+    ema = g.ewm(v, alpha)
+    ema2 = g.ewm(ema, alpha)
+    return g.node(COMBINE3, ema, ema2, g.ewm(ema2, alpha), params=(3.0,))
+
+def build_bband(g, v, period, mult=2.0):
+    period = int(period)
+    middle, var = g.moments(v, period, period)
+    sigma = g.node(SQRT, var)
+    return (g.node(AFFINE, middle, sigma, params=(float(mult),)), g.node(AFFINE, middle, sigma, params=(-float(mult),)), middle, sigma)
+
+def build_macd(g, v, fastlen, slowlen, siglen, use_sma=False):
+    if use_sma:
+        macd = g.node(SUB, g.mean(v, fastlen, fastlen), g.mean(v, slowlen, slowlen))
+    else:
+        macd = g.node(SUB, g.ewm(v, 2.0 / (fastlen + 1)), g.ewm(v, 2.0 / (slowlen + 1)))
+    signal = g.mean(macd, siglen, siglen)
+    return (macd, signal, g.node(SUB, macd, signal))
+
+def build_vixfix_bands(g, wvf, bbl, mult, lb, ph, pl):
+    middle, var = g.moments(wvf, bbl, bbl)
+    sdev = g.node(SCALE, g.node(SQRT, var), params=(float(mult),))
+    return (wvf, g.node(SUB, middle, sdev), g.node(AFFINE, middle, sdev, params=(1.0,)),
+        g.node(SCALE, g.highest(wvf, lb, lb), params=(float(ph),)), g.node(SCALE, g.lowest(wvf, lb, lb), params=(float(pl),)))
+
+def build_wvf(g, close, low, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85, pl=1.01):
+    wvf = g.node(VIXFIX, g.highest(close, period, period), low)
+    return build_vixfix_bands(g, wvf, bbl, mult, lb, ph, pl)
+
+def build_wvf_inv(g, close, high, period = 22, bbl = 20, mult = 2.0, lb = 50, ph = 0.85, pl=1.01):
+    wvf_inv = g.node(VIXFIX_INV, g.lowest(close, period, period), high)
+    return build_vixfix_bands(g, wvf_inv, bbl, mult, lb, ph, pl)
+
+BUILDERS = {
+    'sma': lambda g, v, period: g.mean(v, period),
+    'dsma': build_dsma,
+    'tsma': build_tsma,
+    'ema': lambda g, v, period: g.ewm(v, 2.0 / (period + 1)),
+    'dema': build_dema,
+    'tema': build_tema,
+    'rma': lambda g, v, period: g.ewm(v, 1.0 / (period)),
+    'highest': lambda g, v, period: g.highest(v, period),
+    'lowest': lambda g, v, period: g.lowest(v, period),
+    'variance': lambda g, v, period: g.moments(v, period)[1],
+    'stdev': lambda g, v, period: g.node(SQRT, g.moments(v, period)[1]),
+    'zscore': lambda g, v, period: g.node(ZSCORE, v, *g.moments(v, period)),
+    'bband': build_bband,
+    'hlband': lambda g, v, period: (g.highest(v, period, int(period)), g.lowest(v, period, int(period))),
+    'stoch': lambda g, close, high, low, period: g.node(STOCH, close, g.highest(high, period, int(period)), g.lowest(low, period, int(period))),
+    'momentum': lambda g, v, period: g.node(SUB, v, g.shift(v, period)),
+    'macd': build_macd,
+    'wvf': build_wvf,
+    'wvf_inv': build_wvf_inv,
+    'tr': lambda g, close, high, low: g.node(TR, close, high, low),
+    'atr': lambda g, close, high, low, period: g.ewm(g.node(TR, close, high, low), 1.0/period),
+    'cumsum': lambda g, v, period: g.window(SUM, v, period),
+}
+
+if __name__ == '__main__':
+    import argparse
+    from time import time
+    from .ohlcvbuilder import OHLCVColumns
+
+    parser = argparse.ArgumentParser(description="indicator graph: per-bar update cost vs calling each indicator")
+    parser.add_argument("--bars", dest='bars', type=int, default=1000)
+    parser.add_argument("--loops", dest='loops', type=int, default=300)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    total = args.bars + args.loops
+    close = 1000000 + np.cumsum(rng.normal(0, 100, total))
+    close[100:120] = close[100]
+    close[200] = np.nan
+    source = dotdict(close=close, high=close + rng.random(total) * 100, low=close - rng.random(total) * 100,
+        volume=rng.random(total))
+    bars = [{k:source[k][i] for k in source} for i in range(total)]
+    level = np.nanmax(np.abs(close))
+
+    specs = [
+        ('bb', 'bband', 'close', 20),
+        ('z', 'zscore', 'close', 20),
+        ('sd', 'stdev', 'close', 20),
+        ('var', 'variance', 'close', 20),
+        ('hi', 'highest', 'high', 20),
+        ('lo', 'lowest', 'low', 20),
+        ('hl', 'hlband', 'close', 20),
+        ('st', 'stoch', 'close', 'high', 'low', 20),
+        ('ema', 'ema', 'close', 9),
+        ('dema', 'dema', 'close', 9),
+        ('tema', 'tema', 'close', 9),
+        ('macd', 'macd', 'close', 9, 26, 9),
+        ('tr', 'tr', 'close', 'high', 'low'),
+        ('atr', 'atr', 'close', 'high', 'low', 14),
+        ('wvf', 'wvf', 'close', 'low'),
+        ('mom', 'momentum', 'close', 5),
+        ('sum', 'cumsum', 'volume', 30),
+        ('sma6', 'sma', 'volume', 6),
+        ('sma12', 'sma', 'volume', 12),
+    ]
+
+    def each(ohlcv, specs):
+        return {name:getattr(indicator, func)(*[ohlcv[x] if isinstance(x, str) else x for x in a]) for name, func, *a in specs}
+
+    def check(values, expected, specs, tail=None):
+        for name, _, *a in specs:
+            r, e = values[name], expected[name]
+            for x, y in zip(r if isinstance(r, tuple) else (r,), e if isinstance(e, tuple) else (e,)):
+                y = y if tail is None else y[-tail:]
+                # 分散を使う指標は入力の大きさで桁落ちする(indicatorの確認と同じ許容誤差)
+                assert np.allclose(x, y, rtol=1e-9, atol=1e-9 * level, equal_nan=True), name
+
+    def graph(specs):
+        g = IndicatorGraph()
+        for name, func, *a in specs:
+            g.add(name, func, *a)
+        return g
+
+    # 配列: 毎回全部の足を計算する. 分解していない指標(rsi)とそれを入力にする指標も
+    g = graph(specs)
+    g.add('rsi', 'rsi', 'close', 14)
+    g.add('rsi_sma', 'sma', g['rsi'], 5)
+    expected = each(source, specs)
+    expected['rsi_sma'] = indicator.sma(indicator.rsi(source.close, 14), 5)
+    check(g.update(source), expected, specs + [('rsi_sma', 'sma')])
+    series = dotdict({k:pd.Series(v) for k, v in source.items()})
+    check(g.update(series), expected, specs)
+    assert isinstance(g.values.bb[0], pd.Series) and g.values.bb[0].index is series.close.index
+
+    def run(specs, lazy):
+        """足のバッファに1本ずつ追加(lazyなら最後の足を置き換えてから追加)して1本あたりの時間(us)を返す"""
+        g = graph(specs)
+        columns = OHLCVColumns(args.bars)
+        for bar in bars[:args.bars]:
+            columns.append(bar)
+        g.update(dotdict(columns.view()))
+        t_graph = t_each = 0
+        for bar in bars[args.bars:]:
+            if lazy:
+                # 確定前の足(値は違う)を追加して計算してから置き換える
+                columns.append(bars[0])
+                g.update(dotdict(columns.view()))
+                columns.pop()
+            columns.append(bar)
+            ohlcv = dotdict(columns.view())
+            start = time()
+            values = g.update(ohlcv)
+            t_graph += time() - start
+            start = time()
+            each(ohlcv, specs)
+            t_each += time() - start
+        return values, t_graph * 1e6 / args.loops, t_each * 1e6 / args.loops, len(g.nodes)
+
+    # 足のバッファ: 追加・更新された足だけ計算し、全ての足で計算した場合と同じ
+    for lazy in [False, True]:
+        values, t_graph, t_each, nodes = run(specs, lazy)
+        check(values, each(source, specs), specs, args.bars)
+        print('{0:<10} {1} indicators {2} nodes ({3} bars): each indicator {4:.1f}us/bar graph {5:.1f}us/bar'.format(
+            'pop+append' if lazy else 'append', len(specs), nodes, args.bars, t_each, t_graph))
+
+    # 指標の数を増やした時、同じ中間値を使う指標ならノードも時間もほぼ増えない. 時間は中間値(ノード)の数で増える
+    shared = [('bb', 'bband', 'close', 20), ('z', 'zscore', 'close', 20), ('sd', 'stdev', 'close', 20),
+        ('var', 'variance', 'close', 20), ('sma', 'sma', 'close', 20), ('hl', 'hlband', 'close', 20),
+        ('hi', 'highest', 'close', 20), ('lo', 'lowest', 'close', 20)]
+    distinct = [('bb{0}'.format(p), 'bband', 'close', p) for p in range(20, 28)]
+    print('{0:<10} {1:>10} {2:>6} {3:>10} {4:>10}'.format('', 'indicators', 'nodes', 'each us', 'graph us'))
+    for label, family in [('shared', shared), ('distinct', distinct)]:
+        for k in [1, 2, 4, 8]:
+            # 3回の最小
+            results = [run(family[:k], False)[1:] for _ in range(3)]
+            t_graph, t_each, nodes = min(r[0] for r in results), min(r[1] for r in results), results[0][2]
+            print('{0:<10} {1:>10} {2:>6} {3:>10.1f} {4:>10.1f}'.format(label, k, nodes, t_each, t_graph))
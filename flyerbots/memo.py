@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+指標のメモ化
+
+yourlogicは同じ列に同じ指標を何度も(ループ毎・複数箇所から)計算する.
+足のバッファ(OHLCVColumns)のビュー(disable_rich_ohlcvの配列・LazyOHLCVのSeries)を渡した指標は
+(関数, 列, 引数)毎に結果を持ち、バッファが書き換わるまで(OHLCVColumns.version)同じ結果を返す.
+足が追加・更新された場合、窓の長さ(lookback)が決まっている指標は前回の結果のうち
+変わっていない足を使い回し、先頭の窓が揃わない区間と変わった足以降だけを計算する.
+
+    cache.enabled = True
+    sma(ohlcv.close, 20)        # 計算して保存(misses)
+    sma(ohlcv.close, 20)        # 同じ結果(hits)
+    # 次の足が追加された後
+    sma(ohlcv.close, 20)        # 最後の足と先頭の19本だけ計算(extends)
+
+結果は共有するので書き換えないこと. 足のバッファ以外(計算した系列・リスト等)を渡した場合はそのまま計算する(bypass).
+使い回した区間は全部計算した場合と浮動小数点の丸め分だけ違うことがある.
+"""
+import weakref
+import numpy as np
+import pandas as pd
+from functools import wraps
+from .ohlcvbuilder import OHLCVColumns
+from .utils import dotdict
+
+class Entry:
+    __slots__ = ('columns', 'version', 'first', 'length', 'result', 'index', 'wrapped')
+
+    def wrap(self, source):
+        """sourceがSeriesなら同じindexのSeries(indexが同じ間は同じオブジェクト)"""
+        if not isinstance(source, pd.Series):
+            return self.result
+        if self.index is not source.index:
+            if isinstance(self.result, tuple):
+                self.wrapped = tuple(pd.Series(r, index=source.index) for r in self.result)
+            else:
+                self.wrapped = pd.Series(self.result, index=source.index)
+            self.index = source.index
+        return self.wrapped
+
+def locate(source):
+    v = source.values if isinstance(source, pd.Series) else source
+    if not isinstance(v, np.ndarray):
+        return None
+    return OHLCVColumns.locate(v)
+
+class IndicatorCache:
+
+    def __init__(self, maxsize=256):
+        self.enabled = False
+        self.maxsize = maxsize
+        self.entries = {}
+        # hits: 同じ足の結果を返した extends: 前回の結果を延長した misses: 全部計算した bypass: メモ化しない入力
+        self.stats = dotdict(hits=0, extends=0, misses=0, bypass=0)
+
+    def clear(self):
+        self.entries.clear()
+        for k in self.stats:
+            self.stats[k] = 0
+
+    def call(self, func, nsources, lookback, args, kwargs):
+        sources = args[:nsources]
+        located = [locate(s) for s in sources]
+        if any(l is None for l in located):
+            self.stats.bypass += 1
+            return func(*args, **kwargs)
+        columns, _, first = located[0]
+        n = len(sources[0])
+        # 全部同じバッファの同じ足の範囲
+        for (c, _, f), s in zip(located, sources):
+            if c is not columns or f != first or len(s) != n:
+                self.stats.bypass += 1
+                return func(*args, **kwargs)
+        params = args[nsources:]
+        key = (func, tuple(l[1] for l in located), params, tuple(sorted(kwargs.items())))
+        try:
+            entry = self.entries.get(key)
+        except TypeError:
+            # ハッシュできない引数
+            self.stats.bypass += 1
+            return func(*args, **kwargs)
+
+        # 配列で計算して、Seriesにするのはwrapで行う
+        arrays = [s.values if isinstance(s, pd.Series) else s for s in sources]
+        result = None
+        if entry is not None and entry.columns() is columns:
+            if entry.version == columns.version and entry.first == first and entry.length == n:
+                self.stats.hits += 1
+                return entry.wrap(sources[0])
+            bars = lookback(*args, **kwargs) if lookback is not None else None
+            if bars is not None:
+                result = self.extend(entry, func, arrays, params, kwargs, int(bars), columns, first, n)
+        if result is None:
+            self.stats.misses += 1
+            result = func(*arrays, *params, **kwargs)
+        else:
+            self.stats.extends += 1
+
+        if entry is None:
+            if len(self.entries) >= self.maxsize:
+                del self.entries[next(iter(self.entries))]
+            entry = self.entries[key] = Entry()
+        entry.columns = weakref.ref(columns)
+        entry.version = columns.version
+        entry.first = first
+        entry.length = n
+        entry.result = result
+        entry.index = entry.wrapped = None
+        return entry.wrap(sources[0])
+
+    def extend(self, entry, func, arrays, params, kwargs, lookback, columns, first, n):
+        """前回の結果のうち窓の中の足が変わっていない区間を使い回す(使えなければNone)"""
+        changed = columns.changed_since(entry.version)
+        if changed is None:
+            return None
+        lookback = max(lookback, 1)
+        # 使い回すのは足の番号[lo, hi): 窓が前回・今回の範囲に収まり、変わった足を含まない
+        lo = max(entry.first, first) + lookback - 1
+        hi = min(entry.first + entry.length, first + n, changed)
+        if hi <= lo:
+            return None
+        head = tail = None
+        h = lo - first
+        t = hi - first
+        if h > 0:
+            # 先頭の窓が揃わない区間(カーネルが窓より短い配列を扱えないことがあるのでlookback本以上で計算)
+            head = func(*[v[:max(h, lookback)] for v in arrays], *params, **kwargs)
+        if t < n:
+            tail = func(*[v[t - lookback + 1:] for v in arrays], *params, **kwargs)
+
+        def join(old, head, tail):
+            r = np.empty(n, old.dtype)
+            if head is not None:
+                r[:h] = head[:h]
+            r[h:t] = old[lo - entry.first:hi - entry.first]
+            if tail is not None:
+                r[t:] = tail[lookback - 1:]
+            return r
+
+        if isinstance(entry.result, tuple):
+            return tuple(join(old, head and head[i], tail and tail[i]) for i, old in enumerate(entry.result))
+        return join(entry.result, head, tail)
+
+cache = IndicatorCache()
+
+def memoize(nsources=1, lookback=None):
+    """
+    指標関数をcacheでメモ化する(cache.enabledの時だけ)
+    nsources  先頭から何個の引数が足の列か
+    lookback  指標関数と同じ引数→1本の値に使う足の数(窓の外の足に依らない場合. Noneなら延長しない)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return func(*args, **kwargs)
+            return cache.call(func, nsources, lookback, args, kwargs)
+        return wrapper
+    return decorator
+
+if __name__ == '__main__':
+    import argparse
+    from time import time
+    from . import indicator as ind
+    # python -m で実行した時はこのモジュールと指標が使うflyerbots.memoが別になる
+    from .memo import cache
+
+    parser = argparse.ArgumentParser(description="indicator cache: per-loop cost of a typical yourlogic with/without memoization")
+    parser.add_argument("--bars", dest='bars', type=int, default=1000)
+    parser.add_argument("--loops", dest='loops', type=int, default=30)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    def bars(n):
+        close = 1000000 + np.cumsum(rng.normal(0, 100, n))
+        for i in range(n):
+            yield {'created_at':i, 'open':close[i], 'high':close[i] + 50, 'low':close[i] - 50, 'close':close[i],
+                'volume':abs(rng.normal(1, 0.3))}
+
+    def logic(ohlcv):
+        # 同じ指標を複数箇所から呼ぶyourlogic
+        for _ in range(2):
+            ind.sma(ohlcv.volume, 6)
+            ind.sma(ohlcv.volume, 12)
+            ind.stdev(ohlcv.close, 17)
+            ind.bband(ohlcv.close, 20)
+            ind.highest(ohlcv.high, 20)
+            ind.rci(ohlcv.close, 9)
+            ind.polyfline(ohlcv.close, 20)
+
+    print('{0:>16} {1:>14} {2:>14}'.format('', 'cache off(ms)', 'cache on(ms)'))
+    for lazy in [False, True]:
+        results = []
+        for enabled in [False, True]:
+            cache.clear()
+            cache.enabled = enabled
+            source = list(bars(args.bars + args.loops))
+            columns = OHLCVColumns(args.bars)
+            for bar in source[:args.bars]:
+                columns.append(bar)
+            logic(dotdict(columns.view()))
+            start = time()
+            for i, bar in enumerate(source[args.bars:]):
+                if lazy:
+                    # 確定前の足の置き換えと、interval毎の足の追加
+                    columns.pop()
+                columns.append(bar)
+                logic(dotdict(columns.view()))
+            results.append((time() - start) * 1000 / args.loops)
+        print('{0:>16} {1:>14.3f} {2:>14.3f}  {3}'.format('pop+append' if lazy else 'append', results[0], results[1], dict(cache.stats)))
+    cache.enabled = False
@@ -1,23 +1,60 @@
 # -*- coding: utf-8 -*-
+"""
+OHLCV生成
+
+足は列毎の固定長リングバッファ(OHLCVColumns)に追加し、yourlogicには直近の足をコピーせずに渡す.
+disable_rich_ohlcv=True なら列名→numpy配列(ビュー)のdotdict、
+False なら列アクセス時にSeriesを作るLazyOHLCV(DataFrame固有の操作をした時だけDataFrameを作る).
+ビューは次の足の追加で書き換わるので、次のループまで保持する場合はコピーすること.
+"""
+import numpy as np
 import pandas as pd
-from collections import deque
-from datetime import datetime
-from .utils import dotdict
-from .streaming import parse_exec_date, parse_order_ref_id
+from .utils import dotdict, time_ns, parse_exec_date_ns, parse_order_ref_id_ns
+from .executions import ExecutionColumns, SIDE_NAME
 from math import sqrt
-from statistics import mean
+from itertools import islice
+from collections import deque
+import weakref
+
+try:
+    from numba import jit, f8, i1, void
+except ImportError:
+    jit = None
+
+EXTRAS = frozenset(['vwap', 'stdev', 'market_order_delay'])
 
 class OHLCVBuilder:
 
-    def __init__(self, maxlen=100, timeframe=60, disable_rich_ohlcv=False):
+    def __init__(self, maxlen=100, timeframe=60, disable_rich_ohlcv=False, extras=()):
+        """
+        extras  追加で集計する列
+            'vwap'                出来高加重平均価格
+            'stdev'               約定価格の分散(variance)・標準偏差(stdev)
+            'market_order_delay'  最後の約定の成行注文の受付から約定までの秒数
+        """
         self.disable_rich_ohlcv = disable_rich_ohlcv
-        self.ohlcv = deque(maxlen=maxlen)
+        self.extras = frozenset(extras)
+        unknown = self.extras - EXTRAS
+        if unknown:
+            raise ValueError('unknown extras {0}'.format(sorted(unknown)))
+        self.ohlcv = OHLCVColumns(maxlen)
         self.last = None
         self.timeframe = timeframe
-        self.previous = datetime.utcnow().timestamp() // timeframe
+        self.timeframe_ns = int(timeframe * 1000000000)
+        self.previous = time_ns() // self.timeframe_ns
         self.remain_executions = []
+        self.current = None
+        # 足の作成時刻(Noneなら現在時刻. 過去の約定から足を作る時に使う)
+        self.clock = None
+        # 確定した足の追記先(store.ColumnStore)
+        self.store = None
 
-    def create_lazy_ohlcv(self, data):
+    def save(self, ohlcv):
+        if self.store is not None:
+            self.store.append_row(ohlcv)
+
+    def update_lazy(self, data):
+        """約定時刻で区切った足を更新し、確定した足の(区間番号, 足)のリストを返す(未確定の足はself.current)"""
         if len(self.remain_executions)>0:
             self.ohlcv.pop()
         if len(data)==0:
@@ -26,20 +63,33 @@ class OHLCVBuilder:
                 e['size'] = 0
                 e['side'] = ''
                 data.append([e])
+        closed = []
         for dat in data:
-            closed_at = parse_exec_date(dat[-1]['exec_date'])
-            current = closed_at.timestamp() // self.timeframe
+            current = parse_exec_date_ns(dat[-1]['exec_date']) // self.timeframe_ns
             if current > self.previous:
                 if len(self.remain_executions) > 0:
-                    self.ohlcv.append(self.make_ohlcv(self.remain_executions))
+                    ohlcv = self.make_ohlcv(self.remain_executions)
+                    self.ohlcv.append(ohlcv)
+                    self.save(ohlcv)
+                    closed.append((self.previous, ohlcv))
                 self.remain_executions = []
                 self.previous = current
             self.remain_executions.extend(dat)
+        self.current = None
         if len(self.remain_executions) > 0:
-            self.ohlcv.append(self.make_ohlcv(self.remain_executions))
+            self.current = self.make_ohlcv(self.remain_executions)
+            self.ohlcv.append(self.current)
+        return closed
+
+    def create_lazy_ohlcv(self, data):
+        self.update_lazy(data)
         return self.to_rich_ohlcv()
 
     def create_boundary_ohlcv(self, executions):
+        if len(self.remain_executions):
+            # prefillで残った区間途中の約定
+            executions = self.remain_executions + executions
+            self.remain_executions = []
         if len(executions)==0:
             if self.last is not None:
                 e = self.last.copy()
@@ -49,20 +99,724 @@ class OHLCVBuilder:
                 executions.append(e)
         if len(executions):
             self.last = executions[-1]
-            self.ohlcv.append(self.make_ohlcv(executions))
+            ohlcv = self.make_ohlcv(executions)
+            self.ohlcv.append(ohlcv)
+            self.save(ohlcv)
         return self.to_rich_ohlcv()
 
+    def prefill(self, messages, interval=0, lazy=False, now=None):
+        """過去の約定から足を作る(起動前から動いていた場合と同じ足にする)
+
+        messages  受信単位の約定のリスト(get_executions(chained=False)と同じ形. 最後の約定にreceved_at)を古い順
+        interval  売買ロジックの呼び出し間隔(lazy=Falseの場合はこの間隔で区切る. 0なら受信単位毎)
+        """
+        if len(messages) == 0:
+            return
+        if lazy:
+            self.previous = parse_exec_date_ns(messages[0][-1]['exec_date']) // self.timeframe_ns
+            for group in self.prefill_groups(messages):
+                self.update_lazy(group)
+        else:
+            now = now or time_ns()
+            interval_ns = int(interval * 1000000000)
+            executions = []
+            loop_at = None
+            for message in messages:
+                receved_at = message[-1]['receved_at']
+                # このメッセージを受け取る売買ロジックの呼び出し時刻
+                t = -(-receved_at // interval_ns) * interval_ns if interval_ns else receved_at
+                if loop_at is None:
+                    loop_at = t
+                while loop_at < t:
+                    self.clock = loop_at
+                    self.create_boundary_ohlcv(executions)
+                    executions = []
+                    loop_at = loop_at + interval_ns if interval_ns else t
+                executions.extend(message)
+            while loop_at <= now:
+                self.clock = loop_at
+                self.create_boundary_ohlcv(executions)
+                executions = []
+                if not interval_ns:
+                    break
+                loop_at += interval_ns
+            self.remain_executions = executions
+        self.clock = None
+
+    def prefill_groups(self, messages):
+        # 約定時刻の区間毎にまとめ、足の作成時刻は区間の最後の受信時刻とする
+        group = []
+        previous = None
+        for message in messages:
+            current = parse_exec_date_ns(message[-1]['exec_date']) // self.timeframe_ns
+            if previous is not None and current != previous:
+                self.clock = group[-1][-1]['receved_at']
+                yield group
+                group = []
+            previous = current
+            group.append(message)
+        self.clock = group[-1][-1]['receved_at']
+        yield group
+
     def to_rich_ohlcv(self):
-        ohlcv = list(self.ohlcv)
+        columns = self.ohlcv.view()
         if self.disable_rich_ohlcv:
-            rich_ohlcv = dotdict()
-            for k in ohlcv[0].keys():
-                rich_ohlcv[k] = [v[k] for v in ohlcv]
+            return dotdict(columns)
+        return LazyOHLCV(columns)
+
+    def make_ohlcv(self, executions, receved_at=None):
+        """約定履歴(dictのリスト または ExecutionColumns)から1本の足を作る"""
+        if isinstance(executions, ExecutionColumns):
+            return self.make_ohlcv_columns(executions, receved_at)
+        # 1回の走査で集計する(価格の和・二乗和は先頭の価格からの差で持つ)
+        stdev = 'stdev' in self.extras
+        vwap = 'vwap' in self.extras
+        first = high = low = executions[0]['price']
+        buy_volume = sell_volume = 0
+        buy_count = sell_count = 0
+        sum_dp = sum_dp2 = notional = total_size = 0
+        bucket_number = bucket_size = bucket_size_max = bucket_size_sum = 0
+        for e in executions:
+            price = e['price']
+            if price > high:
+                high = price
+            elif price < low:
+                low = price
+            side = e['side']
+            if side == 'BUY':
+                buy_volume += e['size']
+                buy_count += 1
+            elif side == 'SELL':
+                sell_volume += e['size']
+                sell_count += 1
+            dp = price - first
+            sum_dp += dp
+            if stdev:
+                sum_dp2 += dp * dp
+            if vwap:
+                notional += price * e['size']
+                total_size += e['size']
+            if 'bucket_size' in e:
+                bucket_size = e['bucket_size']
+                bucket_number += 1
+                bucket_size_sum += bucket_size
+                if bucket_size > bucket_size_max:
+                    bucket_size_max = bucket_size
+        e = executions[-1]
+        n = len(executions)
+        ohlcv = dotdict()
+        ohlcv.open = first
+        ohlcv.high = high
+        ohlcv.low = low
+        ohlcv.close = e['price']
+        self.set_volumes(ohlcv, buy_volume, sell_volume, buy_count, sell_count)
+        self.set_extras(ohlcv, first, sum_dp, sum_dp2, n, notional, total_size)
+        ohlcv.created_at = self.clock or time_ns()
+        ohlcv.closed_at = parse_exec_date_ns(e['exec_date'])
+        if 'market_order_delay' in self.extras:
+            self.set_market_order_delay(ohlcv, e['side'], e['buy_child_order_acceptance_id'], e['sell_child_order_acceptance_id'])
+        ohlcv.receved_at = e.get('receved_at', receved_at or ohlcv.created_at)
+        ohlcv.bucket_number = bucket_number
+        # 受信単位の途中で区切った足は0
+        ohlcv.bucket_size = bucket_size
+        ohlcv.bucket_size_max = bucket_size_max
+        ohlcv.bucket_size_avg = bucket_size_sum / bucket_number if bucket_number else 0
+        ohlcv.execution_id = e['id']
+        return self.set_delays(ohlcv)
+
+    def make_ohlcv_columns(self, cols, receved_at=None):
+        """ExecutionColumnsから1本の足を作る(numbaがあれば1回の走査. 受信単位はcols全体で1つとみなす)"""
+        price = np.frombuffer(cols.price, dtype=np.float64)
+        size = np.frombuffer(cols.size, dtype=np.float64)
+        side = np.frombuffer(cols.side, dtype=np.int8)
+        r = np.empty(12)
+        ohlcv_core(price, size, side, r)
+        ohlcv = dotdict()
+        ohlcv.open = r[0]
+        ohlcv.high = r[1]
+        ohlcv.low = r[2]
+        ohlcv.close = r[3]
+        self.set_volumes(ohlcv, r[4], r[5], int(r[6]), int(r[7]))
+        self.set_extras(ohlcv, r[0], r[8], r[9], len(price), r[10], r[11])
+        ohlcv.created_at = self.clock or time_ns()
+        ohlcv.closed_at = cols.exec_ns[-1]
+        if 'market_order_delay' in self.extras:
+            self.set_market_order_delay(ohlcv, SIDE_NAME[side[-1]], cols.buy_child_order_acceptance_id[-1], cols.sell_child_order_acceptance_id[-1])
+        ohlcv.receved_at = cols.receved_at or receved_at or ohlcv.created_at
+        ohlcv.bucket_number = 1
+        ohlcv.bucket_size = ohlcv.bucket_size_max = ohlcv.bucket_size_avg = len(price)
+        ohlcv.execution_id = cols.id[-1]
+        return self.set_delays(ohlcv)
+
+    def set_volumes(self, ohlcv, buy_volume, sell_volume, buy_count, sell_count):
+        ohlcv.buy_volume = buy_volume
+        ohlcv.sell_volume = sell_volume
+        ohlcv.volume = buy_volume + sell_volume
+        ohlcv.volume_imbalance = buy_volume - sell_volume
+        ohlcv.buy_count = buy_count
+        ohlcv.sell_count = sell_count
+        ohlcv.trades = buy_count + sell_count
+        ohlcv.imbalance = buy_count - sell_count
+
+    def set_extras(self, ohlcv, first, sum_dp, sum_dp2, n, notional, total_size):
+        mean_dp = sum_dp / n
+        ohlcv.average = first + mean_dp
+        if 'stdev' in self.extras:
+            ohlcv.variance = max(sum_dp2 / n - mean_dp * mean_dp, 0)
+            ohlcv.stdev = sqrt(ohlcv.variance)
+        if 'vwap' in self.extras:
+            ohlcv.vwap = notional / total_size if total_size > 0 else ohlcv.close
+
+    def set_market_order_delay(self, ohlcv, side, buy_id, sell_id):
+        # 最後の約定の成行注文を受け付けてから約定するまでの秒数
+        if side == 'SELL':
+            ohlcv.market_order_delay = (ohlcv.closed_at - parse_order_ref_id_ns(sell_id)) / 1000000000
+        elif side == 'BUY':
+            ohlcv.market_order_delay = (ohlcv.closed_at - parse_order_ref_id_ns(buy_id)) / 1000000000
         else:
-            rich_ohlcv = pd.DataFrame.from_records(ohlcv, index="created_at")
-        return rich_ohlcv
+            ohlcv.market_order_delay = 0
+
+    def set_delays(self, ohlcv):
+        ohlcv.distribution_delay = (ohlcv.receved_at - ohlcv.closed_at) / 1000000000
+        ohlcv.elapsed_seconds = max((ohlcv.created_at - ohlcv.closed_at) / 1000000000,0)
+        return ohlcv
+
+
+def __ohlcv_core__(price, size, side, r):
+    first = high = low = price[0]
+    buy_volume = sell_volume = 0.0
+    buy_count = sell_count = 0
+    sum_dp = sum_dp2 = notional = total_size = 0.0
+    for i in range(len(price)):
+        p = price[i]
+        if p > high:
+            high = p
+        elif p < low:
+            low = p
+        if side[i] > 0:
+            buy_volume += size[i]
+            buy_count += 1
+        elif side[i] < 0:
+            sell_volume += size[i]
+            sell_count += 1
+        dp = p - first
+        sum_dp += dp
+        sum_dp2 += dp * dp
+        notional += p * size[i]
+        total_size += size[i]
+    r[0] = first
+    r[1] = high
+    r[2] = low
+    r[3] = price[len(price) - 1]
+    r[4] = buy_volume
+    r[5] = sell_volume
+    r[6] = buy_count
+    r[7] = sell_count
+    r[8] = sum_dp
+    r[9] = sum_dp2
+    r[10] = notional
+    r[11] = total_size
+
+def __ohlcv_numpy__(price, size, side, r):
+    # numbaがない場合(列毎にnumpyで集計する)
+    buy = side > 0
+    sell = side < 0
+    dp = price - price[0]
+    r[:] = (price[0], price.max(), price.min(), price[-1], size[buy].sum(), size[sell].sum(),
+        buy.sum(), sell.sum(), dp.sum(), (dp * dp).sum(), (price * size).sum(), size.sum())
+
+if jit is not None:
+    ohlcv_core = jit(void(f8[:], f8[:], i1[:], f8[:]), nopython=True)(__ohlcv_core__)
+else:
+    ohlcv_core = __ohlcv_numpy__
+
+def merge_ohlcv(a, b):
+    """連続する2本の足(aが古い)を1本にまとめる"""
+    ohlcv = dotdict(b)
+    ohlcv.open = a.open
+    ohlcv.high = max(a.high, b.high)
+    ohlcv.low = min(a.low, b.low)
+    for k in ['buy_volume', 'sell_volume', 'volume', 'volume_imbalance',
+        'buy_count', 'sell_count', 'trades', 'imbalance', 'bucket_number']:
+        ohlcv[k] = a[k] + b[k]
+    if ohlcv.trades:
+        # 平均・分散は売買の約定数で重み付けする
+        ohlcv.average = (a.average * a.trades + b.average * b.trades) / ohlcv.trades
+        if 'variance' in b:
+            d = b.average - a.average
+            ohlcv.variance = (a.variance * a.trades + b.variance * b.trades + d * d * a.trades * b.trades / ohlcv.trades) / ohlcv.trades
+            ohlcv.stdev = sqrt(ohlcv.variance)
+    if 'vwap' in b:
+        volume = a.volume + b.volume
+        if volume > 0:
+            ohlcv.vwap = (a.vwap * a.volume + b.vwap * b.volume) / volume
+    ohlcv.bucket_size_max = max(a.bucket_size_max, b.bucket_size_max)
+    if b.bucket_number == 0:
+        ohlcv.bucket_size = a.bucket_size
+    if ohlcv.bucket_number:
+        ohlcv.bucket_size_avg = (a.bucket_size_avg * a.bucket_number + b.bucket_size_avg * b.bucket_number) / ohlcv.bucket_number
+    return ohlcv
+
+class MultiOHLCVBuilder:
+    """複数時間足のOHLCV
+
+    約定履歴から作るのは最も短い足(基準足)だけで、長い足は確定した基準足と未確定の基準足をまとめて作る.
+    足の区切りは約定時刻(create_lazy_ohlcvと同じ). 時間足は基準足の整数倍であること.
+
+        builder = MultiOHLCVBuilder([1, 5, 60])
+        ohlcv = builder.create_ohlcv(ep.get_executions(chained=False))
+        ohlcv[5].close
+    """
+
+    def __init__(self, timeframes, maxlen=100, disable_rich_ohlcv=False, extras=()):
+        self.timeframes = sorted(set(timeframes))
+        self.builders = {tf:OHLCVBuilder(maxlen, tf, disable_rich_ohlcv, extras) for tf in self.timeframes}
+        self.base = self.builders[self.timeframes[0]]
+        for tf in self.timeframes[1:]:
+            if self.builders[tf].timeframe_ns % self.base.timeframe_ns:
+                raise ValueError('timeframe {0} is not a multiple of {1}'.format(tf, self.base.timeframe))
+        # 長い足毎の(区間番号, 確定した基準足をまとめた足)
+        self.pending = {tf:(None, None) for tf in self.timeframes[1:]}
+
+    def update(self, data):
+        self.update_higher(self.base.update_lazy(data))
+
+    def prefill(self, messages, interval=0, lazy=True, now=None):
+        """過去の約定から足を作る(OHLCVBuilder.prefill参照)"""
+        if len(messages) == 0:
+            return
+        self.base.previous = parse_exec_date_ns(messages[0][-1]['exec_date']) // self.base.timeframe_ns
+        for group in self.base.prefill_groups(messages):
+            for builder in self.builders.values():
+                builder.clock = self.base.clock
+            self.update(group)
+        for builder in self.builders.values():
+            builder.clock = None
+
+    def update_higher(self, closed):
+        base_ns = self.base.timeframe_ns
+        for tf in self.timeframes[1:]:
+            builder = self.builders[tf]
+            if builder.current is not None:
+                builder.ohlcv.pop()
+            bucket, ohlcv = self.pending[tf]
+            bars = closed + [(self.base.previous, self.base.current)] if self.base.current is not None else closed
+            for base_bucket, bar in bars:
+                current = base_bucket * base_ns // builder.timeframe_ns
+                if ohlcv is not None and current != bucket:
+                    # 区間が変わったら確定
+                    builder.ohlcv.append(ohlcv)
+                    builder.save(ohlcv)
+                    ohlcv = None
+                merged = bar if ohlcv is None else merge_ohlcv(ohlcv, bar)
+                # 未確定の基準足はまとめた足に含めない
+                self.pending[tf] = (current, ohlcv if bar is self.base.current else merged)
+                bucket, ohlcv = current, merged
+            builder.current = ohlcv
+            if ohlcv is not None:
+                builder.ohlcv.append(ohlcv)
+
+    def create_ohlcv(self, data):
+        """時間足→OHLCV"""
+        self.update(data)
+        return {tf:builder.to_rich_ohlcv() for tf, builder in self.builders.items()}
+
+# 足を区切る活動量
+ACTIVITY = {
+    'tick': lambda e: 1,
+    'volume': lambda e: e['size'],
+    'notional': lambda e: e['price'] * e['size'],
+}
+
+class ActivityOHLCVBuilder(OHLCVBuilder):
+    """約定回数・出来高・売買代金で区切るOHLCV
+
+    bar_type='tick'      bar_size回の約定で1本
+    bar_type='volume'    出来高(BTC)がbar_size以上になったら1本
+    bar_type='notional'  売買代金(円)がbar_size以上になったら1本
+    約定の途中では分けない(閾値を超えた約定までを1本にする). 最後の足は未確定の足.
+    未確定の足は受け取った約定の分だけ足し込むので、1回の更新は新しい約定数に比例する.
+    """
+
+    def __init__(self, maxlen=100, bar_type='volume', bar_size=10, disable_rich_ohlcv=False, extras=()):
+        super().__init__(maxlen, disable_rich_ohlcv=disable_rich_ohlcv, extras=extras)
+        if bar_type not in ACTIVITY:
+            raise ValueError('unknown bar_type {0}'.format(bar_type))
+        self.bar_type = bar_type
+        self.bar_size = bar_size
+        self.measure = ACTIVITY[bar_type]
+        # 浮動小数の足し込み誤差で1約定遅れないようにする
+        self.threshold = bar_size * (1 - 1e-12)
+        self.activity = 0
+
+    def create_ohlcv(self, executions):
+        self.update(executions)
+        return self.to_rich_ohlcv()
+
+    def prefill(self, messages, interval=0, lazy=False, now=None):
+        """過去の約定から足を作る(OHLCVBuilder.prefill参照)"""
+        for message in messages:
+            self.clock = message[-1]['receved_at']
+            self.update(message)
+        self.clock = None
+
+    def update(self, executions):
+        if self.current is not None:
+            self.ohlcv.pop()
+        measure = self.measure
+        start = 0
+        for i, e in enumerate(executions):
+            self.activity += measure(e)
+            if self.activity >= self.threshold:
+                self.add(executions, start, i + 1)
+                self.ohlcv.append(self.current)
+                self.save(self.current)
+                self.current = None
+                self.activity = 0
+                start = i + 1
+        if start < len(executions):
+            self.add(executions, start, len(executions))
+        if self.current is not None:
+            self.ohlcv.append(self.current)
+
+    def add(self, executions, start, end):
+        receved_at = None
+        if 'receved_at' not in executions[end - 1]:
+            # 受信単位の途中で区切った場合はその受信単位の受信時刻
+            for e in islice(executions, end, None):
+                if 'receved_at' in e:
+                    receved_at = e['receved_at']
+                    break
+        ohlcv = self.make_ohlcv(executions[start:end], receved_at)
+        self.current = ohlcv if self.current is None else merge_ohlcv(self.current, ohlcv)
+
+def empty_ohlcv(previous):
+    """約定がなかった区間の足(直前の足の終値で横ばい)"""
+    ohlcv = dotdict(previous)
+    ohlcv.open = ohlcv.high = ohlcv.low = ohlcv.average = previous.close
+    for k in ['buy_volume', 'sell_volume', 'volume', 'volume_imbalance', 'buy_count', 'sell_count', 'trades', 'imbalance',
+        'bucket_number', 'bucket_size', 'bucket_size_max', 'bucket_size_avg']:
+        ohlcv[k] = 0
+    if 'vwap' in previous:
+        ohlcv.vwap = previous.close
+    if 'variance' in previous:
+        ohlcv.variance = ohlcv.stdev = 0
+    if 'market_order_delay' in previous:
+        ohlcv.market_order_delay = 0
+    return ohlcv
+
+class AlignedOHLCVBuilder(OHLCVBuilder):
+    """約定時刻の区切りで確定する足
 
-    def make_ohlcv(self, executions):
+    約定毎にexec_dateでtimeframeの区間に振り分け、区間の終わりからgrace秒の間は遅れて届いた約定を足し込む.
+    確定前の足はリングバッファ上でその場で書き換える(create_lazy_ohlcvのようにpopして作り直さない).
+    1約定あたりの処理は区間の判定と足し込みだけ. 確定後に届いた約定は捨ててstats.lateに数える.
+    約定がなかった区間は直前の終値で横ばいの足を入れる.
+
+    opened_at  区間の開始時刻(エポックナノ秒)
+    revision   既に渡した足を書き換えた回数
+    confirmed  1なら確定(以降は変わらない)
+    self.revisions  直前の更新で書き換えた足の(opened_at, revision)
+    """
+
+    def __init__(self, maxlen=100, timeframe=60, grace=2.0, disable_rich_ohlcv=False, extras=()):
+        super().__init__(maxlen, timeframe, disable_rich_ohlcv, extras)
+        self.grace_ns = int(grace * 1000000000)
+        # 確定前の足(古い順). リングバッファの末尾と同じ並び
+        self.open_bars = deque()
+        self.last_bucket = None
+        self.last_bar = None
+        # 既に渡した確定前の足のopened_at
+        self.published = set()
+        self.revisions = []
+        self.stats = dotdict(late=0, revisions=0, empty=0)
+        # 確定前の足のopened_at→最初の約定ID(execution_idは最後の約定ID)
+        self.first_ids = {}
+
+    def create_ohlcv(self, data, now=None):
+        """data: get_executions(chained=False)"""
+        self.update(data, now)
+        return self.to_rich_ohlcv()
+
+    def prefill(self, messages, interval=0, lazy=False, now=None):
+        """過去の約定から足を作る(OHLCVBuilder.prefill参照)"""
+        for message in messages:
+            self.clock = message[-1]['receved_at']
+            self.update([message])
+        self.clock = None
+        self.confirm(now or time_ns())
+
+    def update(self, data, now=None):
+        revised = set()
+        for message in data:
+            if isinstance(message, ExecutionColumns):
+                message = list(message)
+            if len(message) == 0:
+                continue
+            receved_at = message[-1].get('receved_at')
+            # 同じ区間の約定をまとめて足し込む
+            bucket = None
+            start = 0
+            for i, e in enumerate(message):
+                current = parse_exec_date_ns(e['exec_date']) // self.timeframe_ns
+                if current != bucket:
+                    if i > start:
+                        self.add(bucket, message[start:i], receved_at, revised)
+                    bucket, start = current, i
+            self.add(bucket, message[start:], receved_at, revised)
+        self.revisions = []
+        for bar in self.open_bars:
+            if bar.opened_at in revised:
+                bar.revision += 1
+                self.revisions.append((bar.opened_at, bar.revision))
+                self.ohlcv.replace(self.position(bar), bar)
+            self.published.add(bar.opened_at)
+        self.stats.revisions += len(self.revisions)
+        self.confirm(now or self.clock or time_ns())
+
+    def position(self, bar):
+        """確定前の足のリングバッファ上の位置(後ろから)"""
+        for i, b in enumerate(self.open_bars):
+            if b is bar:
+                return i - len(self.open_bars)
+
+    def add(self, bucket, executions, receved_at, revised):
+        ohlcv = self.make_ohlcv(executions, receved_at)
+        first_id = executions[0]['id']
+        if self.last_bucket is None or bucket > self.last_bucket:
+            if self.last_bar is not None:
+                for b in range(max(self.last_bucket + 1, bucket - self.ohlcv.maxlen), bucket):
+                    self.append_bar(b, empty_ohlcv(self.last_bar))
+                    self.stats.empty += 1
+            self.append_bar(bucket, ohlcv)
+            self.first_ids[ohlcv.opened_at] = first_id
+            return
+        opened_at = bucket * self.timeframe_ns
+        for i, bar in enumerate(self.open_bars):
+            if bar.opened_at == opened_at:
+                break
+        else:
+            self.stats.late += len(executions)
+            return
+        if bar.trades == 0 and bar.bucket_number == 0:
+            # 約定がないまま作った足は置き換える
+            merged = ohlcv
+            self.first_ids[opened_at] = first_id
+        else:
+            # 遅れた約定が足の約定IDの範囲の途中に入ることがあるので、
+            # 始値は最初の約定IDが小さい方、終値(と最後の約定の列)は最後の約定IDが大きい方から取る
+            if ohlcv.execution_id > bar.execution_id:
+                merged = merge_ohlcv(bar, ohlcv)
+            else:
+                merged = merge_ohlcv(ohlcv, bar)
+            bar_first_id = self.first_ids.get(opened_at, bar.execution_id)
+            merged.open = ohlcv.open if first_id < bar_first_id else bar.open
+            self.first_ids[opened_at] = min(first_id, bar_first_id)
+        for k in ['opened_at', 'revision', 'confirmed']:
+            merged[k] = bar[k]
+        self.open_bars[i] = merged
+        self.last_bar = self.open_bars[-1]
+        if opened_at in self.published:
+            revised.add(opened_at)
+        else:
+            self.ohlcv.replace(self.position(merged), merged)
+
+    def append_bar(self, bucket, ohlcv, confirmed=0):
+        ohlcv.opened_at = bucket * self.timeframe_ns
+        ohlcv.revision = 0
+        ohlcv.confirmed = confirmed
+        self.ohlcv.append(ohlcv)
+        if not confirmed:
+            self.open_bars.append(ohlcv)
+        self.last_bucket = bucket
+        self.last_bar = ohlcv
+
+    def confirm(self, now):
+        """区間の終わりからgrace秒過ぎた足を確定する"""
+        while len(self.open_bars) and self.open_bars[0].opened_at + self.timeframe_ns + self.grace_ns <= now:
+            bar = self.open_bars[0]
+            bar.confirmed = 1
+            self.ohlcv.replace(self.position(bar), bar)
+            self.save(bar)
+            self.open_bars.popleft()
+            self.published.discard(bar.opened_at)
+            self.first_ids.pop(bar.opened_at, None)
+        # 約定がないまま確定する区間
+        if self.last_bar is not None and len(self.open_bars) == 0:
+            last = (now - self.grace_ns) // self.timeframe_ns - 1
+            for b in range(max(self.last_bucket + 1, last + 1 - self.ohlcv.maxlen), last + 1):
+                self.append_bar(b, empty_ohlcv(self.last_bar), confirmed=1)
+                self.save(self.last_bar)
+                self.stats.empty += 1
+
+# 整数で持つ列(それ以外はfloat64)
+INT_COLUMNS = {'created_at', 'closed_at', 'receved_at', 'execution_id',
+    'buy_count', 'sell_count', 'trades', 'imbalance', 'bucket_number', 'bucket_size', 'bucket_size_max',
+    'opened_at', 'revision', 'confirmed'}
+
+class OHLCVColumns:
+    """OHLCVの列形式リングバッファ
+
+    各列は長さ2*maxlenの配列で、k本目の足を k%maxlen と k%maxlen+maxlen の2か所に書く.
+    直近maxlen本は常に連続した領域になるので、追加はO(1)、参照はコピーなしのスライスで済む.
+    列は最初の足のキーから作る.
+    書き換える度にversionを進め、(version, 変わった最初の足の番号)を残す(指標のメモ化が前回の結果を使い回す範囲).
+    """
+
+    # 列の配列のid→OHLCVColumns(ビューから元のバッファを探す)
+    registry = weakref.WeakValueDictionary()
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.columns = {}
+        # 追加した足の総数
+        self.count = 0
+        self.version = 0
+        self.changes = deque(maxlen=64)
+
+    def __len__(self):
+        return min(self.count, self.maxlen)
+
+    def append(self, bar):
+        if not self.columns:
+            for k in bar.keys():
+                col = self.columns[k] = np.zeros(self.maxlen * 2, dtype=np.int64 if k in INT_COLUMNS else np.float64)
+                OHLCVColumns.registry[id(col)] = self
+        i = self.count % self.maxlen
+        j = i + self.maxlen
+        for k, col in self.columns.items():
+            col[i] = col[j] = bar[k]
+        self.count += 1
+        self.changed(self.count - 1)
+
+    def replace(self, i, bar):
+        """後ろからi番目(-1が最後)の足を書き換える"""
+        k = (self.count + i) % self.maxlen
+        j = k + self.maxlen
+        for key, col in self.columns.items():
+            col[k] = col[j] = bar[key]
+        self.changed(self.count + i)
+
+    def pop(self):
+        """最後の足を取り消す(確定前の足の置き換え用. 続けてappendすること)"""
+        if self.count:
+            self.count -= 1
+            self.changed(self.count)
+
+    def changed(self, first):
+        self.version += 1
+        self.changes.append((self.version, first))
+
+    def changed_since(self, version):
+        """versionの後に変わった最初の足の番号(記録が残っていなければNone)"""
+        first = self.count
+        for v, i in reversed(self.changes):
+            if v <= version:
+                return first
+            first = min(first, i)
+        if len(self.changes) and self.changes[0][0] == version + 1:
+            return first
+        return None
+
+    @classmethod
+    def locate(cls, v):
+        """view()の配列(のスライス)なら(OHLCVColumns, 列の配列のid, 先頭の足の番号)、それ以外はNone"""
+        base = v.base
+        if base is None or v.ndim != 1:
+            return None
+        columns = cls.registry.get(id(base))
+        if columns is None or v.strides[0] != base.itemsize:
+            return None
+        q = (v.__array_interface__['data'][0] - base.__array_interface__['data'][0]) // base.itemsize
+        # 位置qの足はq%maxlenが同じ直近maxlen本のどれか
+        first = columns.count - 1 - (columns.count - 1 - q) % columns.maxlen
+        if first + len(v) > columns.count:
+            return None
+        return columns, id(base), first
+
+    def view(self):
+        """列名→直近の足の配列(ビュー)"""
+        n = len(self)
+        start = (self.count - n) % self.maxlen
+        return {k:col[start:start + n] for k, col in self.columns.items()}
+
+class LazyOHLCV:
+    """OHLCVの遅延DataFrame
+
+    ohlcv.close / ohlcv['close'] はリングバッファのビューを持つSeries(インデックスはcreated_at).
+    それ以外の属性(iloc, tail, rolling ...)に触れた時だけDataFrameを作る.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+        self._series = {}
+        self._index = None
+        self._frame = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            # 時刻はエポックナノ秒のまま持ち、インデックスのみdatetime64にする
+            self._index = pd.DatetimeIndex(self._columns['created_at'].view('datetime64[ns]'), name='created_at', copy=False)
+        return self._index
+
+    @property
+    def columns(self):
+        return pd.Index([k for k in self._columns.keys() if k != 'created_at'])
+
+    def __len__(self):
+        return len(self._columns['created_at']) if self._columns else 0
+
+    def __contains__(self, key):
+        return key in self._columns and key != 'created_at'
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and key in self:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = pd.Series(self._columns[key], index=self.index, name=key, copy=False)
+            return series
+        return self.to_frame()[key]
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        if attr in self:
+            return self[attr]
+        return getattr(self.to_frame(), attr)
+
+    def to_frame(self):
+        if self._frame is None:
+            self._frame = pd.DataFrame({k:v for k, v in self._columns.items() if k != 'created_at'}, index=self.index)
+        return self._frame
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    from time import time
+    from collections import deque
+    from datetime import datetime, timedelta
+
+    parser = argparse.ArgumentParser(description="OHLCV benchmarks")
+    parser.add_argument("--bench", dest='bench', type=str, default='ring', choices=['ring', 'kernel'],
+        help='ring: per-tick cost deque+from_records vs ring buffer / kernel: per-bar make_ohlcv cost')
+    parser.add_argument("--loops", dest='loops', type=int, default=2000)
+    args = parser.parse_args()
+
+    def executions(n):
+        t = datetime(2018, 10, 18, 8, 0, 0)
+        for i in range(n):
+            t += timedelta(microseconds=random.randint(1, 200000))
+            accepted = (t - timedelta(microseconds=random.randint(1, 500000))).strftime('JRF%Y%m%d-%H%M%S-%f')
+            yield {'id':i, 'side':random.choice(['BUY', 'SELL']), 'price':1000000.0+random.randint(-500, 500),
+                'size':random.random(), 'exec_date':t.strftime('%Y-%m-%dT%H:%M:%S.%f') + '0Z',
+                'buy_child_order_acceptance_id':accepted, 'sell_child_order_acceptance_id':accepted,
+                'receved_at':time_ns(), 'bucket_size':1}
+
+    def make_ohlcv_multipass(executions):
+        # 従来のmake_ohlcv(VWAP等を含めて列毎に走査する)
+        from statistics import mean
         price = [e['price'] for e in executions]
         buy = [e for e in executions if e['side'] == 'BUY']
         sell = [e for e in executions if e['side'] == 'SELL']
@@ -75,31 +829,70 @@ class OHLCVBuilder:
         ohlcv.buy_volume = sum(e['size'] for e in buy)
         ohlcv.sell_volume = sum(e['size'] for e in sell)
         ohlcv.volume = ohlcv.buy_volume + ohlcv.sell_volume
-        ohlcv.volume_imbalance = ohlcv.buy_volume - ohlcv.sell_volume
         ohlcv.buy_count = len(buy)
         ohlcv.sell_count = len(sell)
-        ohlcv.trades = ohlcv.buy_count + ohlcv.sell_count
-        ohlcv.imbalance = ohlcv.buy_count - ohlcv.sell_count
         ohlcv.average = sum(price) / len(price)
-        # ohlcv.average_sq = sum(p**2 for p in price) / len(price)
-        # ohlcv.variance = ohlcv.average_sq - (ohlcv.average * ohlcv.average)
-        # ohlcv.stdev = sqrt(ohlcv.variance)
-        # ohlcv.vwap = sum(e['price']*e['size'] for e in executions) / ohlcv.volume if ohlcv.volume > 0 else price[-1]
-        ohlcv.created_at = datetime.utcnow()
-        e = executions[-1]
-        ohlcv.closed_at = parse_exec_date(e['exec_date'])
-        # if e['side']=='SELL':
-        #     ohlcv.market_order_delay = (ohlcv.closed_at-parse_order_ref_id(e['sell_child_order_acceptance_id'])).total_seconds()
-        # elif e['side']=='BUY':
-        #     ohlcv.market_order_delay = (ohlcv.closed_at-parse_order_ref_id(e['buy_child_order_acceptance_id'])).total_seconds()
-        # else:
-        #     ohlcv.market_order_delay = 0
-        ohlcv.receved_at = e['receved_at']
-        ohlcv.bucket_number = len(bucket_size)
-        ohlcv.bucket_size = bucket_size[-1]
-        ohlcv.bucket_size_max = max(bucket_size)
+        ohlcv.variance = sum(p**2 for p in price) / len(price) - (ohlcv.average * ohlcv.average)
+        ohlcv.vwap = sum(e['price']*e['size'] for e in executions) / ohlcv.volume
         ohlcv.bucket_size_avg = mean(bucket_size)
-        ohlcv.execution_id = e['id']
-        ohlcv.distribution_delay = (ohlcv.receved_at - ohlcv.closed_at).total_seconds()
-        ohlcv.elapsed_seconds = max((ohlcv.created_at - ohlcv.closed_at).total_seconds(),0)
         return ohlcv
+
+    if args.bench == 'kernel':
+        random.seed(1)
+        all_extras = sorted(EXTRAS)
+        print('{0:>7} {1:>14} {2:>14} {3:>14} {4:>14} {5:>14}'.format('execs', 'multipass us', 'basic us', 'extras us', 'columns us', 'per exec ns'))
+        for n in [1000, 10000, 100000]:
+            data = list(executions(n))
+            cols = ExecutionColumns.from_dicts(data)
+            loops = max(args.loops * 1000 // n // 10, 3)
+            results = []
+            for make_ohlcv, source in [(make_ohlcv_multipass, data), (OHLCVBuilder().make_ohlcv, data),
+                    (OHLCVBuilder(extras=all_extras).make_ohlcv, data), (OHLCVBuilder(extras=all_extras).make_ohlcv, cols)]:
+                start = time()
+                for _ in range(loops):
+                    ohlcv = make_ohlcv(source)
+                results.append((time() - start) * 1e6 / loops)
+            reference = make_ohlcv_multipass(data)
+            # 二乗平均からの分散は桁落ちするのでnumpyと比べる
+            reference.variance = np.var(cols.price)
+            extras = OHLCVBuilder(extras=all_extras).make_ohlcv(data)
+            columns = OHLCVBuilder(extras=all_extras).make_ohlcv(cols)
+            for k in ['open', 'high', 'low', 'close', 'buy_volume', 'sell_volume', 'buy_count', 'sell_count', 'average', 'variance', 'vwap']:
+                assert abs(extras[k] - reference[k]) <= 1e-6 * max(abs(reference[k]), 1), k
+                assert abs(columns[k] - reference[k]) <= 1e-6 * max(abs(reference[k]), 1), k
+            assert extras.market_order_delay == columns.market_order_delay
+            print('{0:>7} {1:>14.1f} {2:>14.1f} {3:>14.1f} {4:>14.1f} {5:>14.1f}'.format(n, *results, results[2] * 1000 / n))
+        raise SystemExit
+
+    def from_records(bars):
+        # 従来のto_rich_ohlcv
+        rich_ohlcv = pd.DataFrame.from_records(list(bars), index="created_at")
+        rich_ohlcv.index = pd.DatetimeIndex(rich_ohlcv.index.values.astype('datetime64[ns]'), name='created_at')
+        return rich_ohlcv
+
+    def from_lists(bars):
+        bars = list(bars)
+        rich_ohlcv = dotdict()
+        for k in bars[0].keys():
+            rich_ohlcv[k] = [v[k] for v in bars]
+        return rich_ohlcv
+
+    random.seed(1)
+    bars = [OHLCVBuilder().make_ohlcv([e]) for e in executions(args.loops + 5000)]
+    print('{0:>6} {1:>14} {2:>14} {3:>14} {4:>14}'.format('bars', 'records us', 'lists us', 'ring lazy us', 'ring dict us'))
+    for maxlen in [100, 600, 1000, 5000]:
+        results = []
+        for to_ohlcv in [from_records, from_lists, None, None]:
+            builder = OHLCVBuilder(maxlen=maxlen, disable_rich_ohlcv=len(results) == 3)
+            if to_ohlcv is not None:
+                builder.ohlcv = deque(maxlen=maxlen)
+            for bar in bars[:maxlen]:
+                builder.ohlcv.append(bar)
+            start = time()
+            for bar in bars[maxlen:maxlen + args.loops]:
+                builder.ohlcv.append(bar)
+                ohlcv = to_ohlcv(builder.ohlcv) if to_ohlcv is not None else builder.to_rich_ohlcv()
+                close = ohlcv.close[-1] if isinstance(ohlcv, dict) else ohlcv.close.values[-1]
+            results.append((time() - start) * 1e6 / args.loops)
+            assert close == bars[maxlen + args.loops - 1].close
+        print('{0:>6} {1:>14.1f} {2:>14.1f} {3:>14.1f} {4:>14.1f}'.format(maxlen, *results))
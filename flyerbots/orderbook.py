@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+板情報
+
+board_snapshot で初期化し、board の差分で更新する.
+価格帯は最良気配から順に並べて保持するので最良気配・価格帯のサイズ・累積サイズを二分探索で求められる.
+累積サイズ・サイズの累積最大値は問い合わせ時に、変更のあった位置から必要な所までだけ作り直す.
+
+    book = streaming.get_order_book('FX_BTC_JPY')
+    with book.lock:
+        bid, size = book.bids.best()
+        depth = book.bids.depth(bid - 1000)          # bid-1000円までの累積サイズ
+        price = book.asks.price_at_depth(5.0)        # 累積サイズが5.0以上になる価格
+        price = book.asks.price_at_size(1.0)         # サイズ1.0以上の最初の価格帯
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain, islice
+
+class OrderBook:
+
+    def __init__(self, product_id=None):
+        self.product_id = product_id
+        self.lock = threading.RLock()
+        self.bids = OrderBook.Side(-1)
+        self.asks = OrderBook.Side(1)
+        self.mid_price = 0
+        # 更新回数(価格帯毎の最終更新と比べて差分に現れたかを判定する)
+        self.seq = 0
+        self.synced = False
+        self.snapshots = 0
+
+    def put(self, channel, message):
+        """Streamingのコールバック(board_snapshot / board)"""
+        if channel.startswith('lightning_board_snapshot_'):
+            self.snapshot(message)
+        else:
+            self.update(message)
+
+    def snapshot(self, board):
+        with self.lock:
+            self.seq += 1
+            self.bids.load(board['bids'], self.seq)
+            self.asks.load(board['asks'], self.seq)
+            self.mid_price = board['mid_price']
+            self.synced = True
+            self.snapshots += 1
+
+    def update(self, board):
+        with self.lock:
+            # スナップショットを受け取るまでの差分は捨てる
+            if not self.synced:
+                return
+            self.seq += 1
+            seq = self.seq
+            for b in board['bids']:
+                self.bids.set(b['price'], b['size'], seq)
+            for a in board['asks']:
+                self.asks.set(a['price'], a['size'], seq)
+            # 差分で消されずに残った仲値を跨ぐ価格帯を消す
+            self.mid_price = board['mid_price']
+            self.bids.trim(self.mid_price, seq)
+            self.asks.trim(self.mid_price, seq)
+
+    def best_bid(self):
+        with self.lock:
+            return self.bids.best()
+
+    def best_ask(self):
+        with self.lock:
+            return self.asks.best()
+
+    def side(self, side):
+        return self.bids if side in ('buy', 'bid', 'bids') else self.asks
+
+    def size_at(self, side, price):
+        with self.lock:
+            return self.side(side).size_at(price)
+
+    def depth(self, side, price):
+        with self.lock:
+            return self.side(side).depth(price)
+
+    class Side:
+        """片側の板(sign=-1:買い板 1:売り板)
+
+        keys は sign*price の昇順(先頭が最良気配)、values は keys と同じ並びのサイズ
+        """
+
+        def __init__(self, sign):
+            self.sign = sign
+            self.keys = []
+            self.values = []
+            self.sizes = {}
+            self.updated = {}
+            # 累積サイズ・サイズの累積最大値(それぞれ先頭からcum_valid個/peak_valid個が有効)
+            self.cum = []
+            self.peak = []
+            self.cum_valid = 0
+            self.peak_valid = 0
+
+        def __len__(self):
+            return len(self.keys)
+
+        def load(self, levels, seq):
+            for price in self.sizes:
+                self.updated[price] = seq
+            self.sizes = {l['price']:l['size'] for l in levels if l['size'] > 0}
+            self.keys = sorted(self.sign * price for price in self.sizes)
+            self.values = [self.sizes[self.sign * k] for k in self.keys]
+            for price in self.sizes:
+                self.updated[price] = seq
+            self.cum_valid = self.peak_valid = 0
+            self.compact()
+
+        def set(self, price, size, seq):
+            key = self.sign * price
+            i = bisect_left(self.keys, key)
+            if size > 0:
+                if price in self.sizes:
+                    self.values[i] = size
+                else:
+                    self.keys.insert(i, key)
+                    self.values.insert(i, size)
+                self.sizes[price] = size
+            elif price in self.sizes:
+                del self.sizes[price]
+                del self.keys[i]
+                del self.values[i]
+            else:
+                self.updated[price] = seq
+                return
+            if i < self.cum_valid:
+                self.cum_valid = i
+            if i < self.peak_valid:
+                self.peak_valid = i
+            self.updated[price] = seq
+            if len(self.updated) > 4 * len(self.sizes) + 10000:
+                self.compact()
+
+        def trim(self, mid_price, seq):
+            n = bisect_right(self.keys, self.sign * mid_price)
+            if n:
+                for key in self.keys[:n]:
+                    price = self.sign * key
+                    del self.sizes[price]
+                    self.updated[price] = seq
+                del self.keys[:n]
+                del self.values[:n]
+                self.cum_valid = self.peak_valid = 0
+
+        def compact(self):
+            # 消えた価格帯の更新記録は新しいものだけ残す
+            if len(self.updated) > 2 * len(self.sizes) + 1000:
+                recent = sorted(self.updated.values())[-(len(self.sizes) + 1000)]
+                self.updated = {p:s for p, s in self.updated.items() if p in self.sizes or s >= recent}
+
+        def price(self, i):
+            """i番目(0が最良気配)の価格"""
+            return self.sign * self.keys[i]
+
+        def best(self):
+            if len(self.keys):
+                price = self.sign * self.keys[0]
+                return price, self.sizes[price]
+            return None, 0
+
+        def size_at(self, price):
+            return self.sizes.get(price, 0)
+
+        def updated_since(self, price, seq):
+            """価格帯がseqより後の差分で更新されたか"""
+            return self.updated.get(price, 0) > seq
+
+        def levels(self, n=None):
+            """最良気配から順に(price, size)"""
+            keys = self.keys if n is None else self.keys[:n]
+            return [(self.sign * k, v) for k, v in zip(keys, self.values)]
+
+        def extend_cum(self, n):
+            """先頭からn個の累積サイズを有効にする"""
+            n = min(n, len(self.keys))
+            i = self.cum_valid
+            if i < n:
+                if i:
+                    self.cum[i:n] = islice(accumulate(chain((self.cum[i - 1],), self.values[i:n])), 1, None)
+                else:
+                    self.cum[:n] = accumulate(self.values[:n])
+                self.cum_valid = n
+            return self.cum_valid
+
+        def extend_peak(self, n):
+            """先頭からn個のサイズの累積最大値を有効にする"""
+            n = min(n, len(self.keys))
+            i = self.peak_valid
+            if i < n:
+                if i:
+                    self.peak[i:n] = islice(accumulate(chain((self.peak[i - 1],), self.values[i:n]), max), 1, None)
+                else:
+                    self.peak[:n] = accumulate(self.values[:n], max)
+                self.peak_valid = n
+            return self.peak_valid
+
+        def search(self, extend, index, target, lo, bisect):
+            # 最良気配に近い所から探すので有効範囲を広げながら二分探索する
+            n = max(lo + 1, 64)
+            while True:
+                valid = extend(n)
+                i = bisect(index, target, lo, valid)
+                if i < valid:
+                    return i
+                if valid >= len(self.keys):
+                    return None
+                n = valid * 4
+
+        def cumulative(self, i):
+            """最良気配からi番目の価格帯までの累積サイズ"""
+            if i < 0:
+                return 0
+            self.extend_cum(i + 1)
+            return self.cum[i]
+
+        def depth(self, price):
+            """最良気配からpriceまで(priceを含む)の累積サイズ"""
+            return self.cumulative(bisect_right(self.keys, self.sign * price) - 1)
+
+        def depth_index(self, depth, lo=0, strict=False):
+            """lo番目から数えた累積サイズがdepth以上(strict=Trueなら超える)になる最初の位置"""
+            target = depth + self.cumulative(lo - 1)
+            return self.search(self.extend_cum, self.cum, target, lo, bisect_right if strict else bisect_left)
+
+        def size_index(self, size, lo=0):
+            """lo番目以降でサイズがsize以上の最初の位置"""
+            self.extend_peak(lo)
+            if lo == 0 or self.peak[lo - 1] < size:
+                return self.search(self.extend_peak, self.peak, size, lo, bisect_left)
+            # lo より手前に大きい価格帯がある場合は順に探す
+            for i in range(lo, len(self.values)):
+                if self.values[i] >= size:
+                    return i
+            return None
+
+        def find(self, depth=0, size=0, lo=0):
+            """lo番目から数えた累積サイズがdepthを超えるか、サイズがsize以上になる最初の位置"""
+            i = self.depth_index(depth, lo, strict=True) if depth > 0 else None
+            if size > 0:
+                j = self.size_index(size, lo)
+                if j is not None and (i is None or j < i):
+                    i = j
+            return i
+
+        def price_at_depth(self, depth, strict=False):
+            i = self.depth_index(depth, 0, strict)
+            return None if i is None else self.sign * self.keys[i]
+
+        def price_at_size(self, size):
+            i = self.size_index(size)
+            return None if i is None else self.sign * self.keys[i]
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import numpy as np
+    from time import time
+
+    parser = argparse.ArgumentParser(description="price-at-depth: yen scan vs cumulative-depth index")
+    parser.add_argument("--loops", dest='loops', type=int, default=2000)
+    parser.add_argument("--scan_loops", dest='scan_loops', type=int, default=20)
+    parser.add_argument("--depth", dest='depth', type=float, default=5.0)
+    parser.add_argument("--diffs", dest='diffs', type=int, default=5, help='board diffs applied between queries')
+    args = parser.parse_args()
+
+    def scan(allboard, mid, d):
+        # 従来の方法(仲値から1円ずつ売り板を辿る)
+        target = mid
+        depth = 0
+        while True:
+            target += 1
+            depth += allboard[target]
+            if depth > d:
+                return target
+
+    mid = 1000000
+    print('{0:>8} {1:>7} {2:>12} {3:>12} {4:>12}'.format('spacing', 'levels', 'scan us', 'index us', 'index+diff us'))
+    for spacing, size in [(1, 0.05), (10, 0.02), (100, 0.01), (400, 0.005)]:
+        random.seed(spacing)
+        allboard = np.zeros(2000000)
+        levels = [{'price':float(mid + spacing * i), 'size':round(random.random() * size * 2, 8)} for i in range(1, 2000)]
+        for l in levels:
+            allboard[int(l['price'])] = l['size']
+        book = OrderBook()
+        book.snapshot({'mid_price':mid, 'bids':[], 'asks':levels})
+        asks = book.asks
+
+        start = time()
+        for _ in range(args.scan_loops):
+            expected = scan(allboard, mid, args.depth)
+        scan_us = (time() - start) * 1e6 / args.scan_loops
+
+        start = time()
+        for _ in range(args.loops):
+            price = asks.price(asks.find(args.depth))
+        index_us = (time() - start) * 1e6 / args.loops
+        assert price == expected
+
+        # 差分を当ててから問い合わせる(累積サイズの作り直しを含む)
+        diffs = [[{'price':float(mid + spacing * random.randint(1, 50)), 'size':round(random.random() * size * 2, 8)} for _ in range(args.diffs)]
+            for _ in range(args.loops)]
+        start = time()
+        for asks_diff in diffs:
+            book.update({'mid_price':mid, 'bids':[], 'asks':asks_diff})
+            price = asks.price(asks.find(args.depth))
+        diff_us = (time() - start) * 1e6 / args.loops
+        print('{0:>8} {1:>7} {2:>12.1f} {3:>12.2f} {4:>12.1f}'.format(spacing, len(asks), scan_us, index_us, diff_us))
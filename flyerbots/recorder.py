@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+ストリーム記録
+
+Streaming.on_dataが受け取った全メッセージをチャンネル毎・1時間毎(UTC)のセグメントに追記する.
+
+    <root>/<channel>/<channel>_YYYYmmddHH.rec.gz
+
+セグメントはgzip圧縮された長さ付きレコードの列(追記のみ).
+
+    length   uint32 LE   ペイロード長
+    mono_ns  int64  LE   受信時刻(time.monotonic ナノ秒)
+    wall_ns  int64  LE   受信時刻(UNIXエポック ナノ秒)
+    payload  bytes       メッセージ(JSON UTF-8)
+"""
+import os
+import gzip
+import glob
+import json
+import struct
+import threading
+import logging
+from time import sleep
+from datetime import datetime
+from collections import deque
+from .utils import time_ns, monotonic_ns
+from .executions import ExecutionColumns
+
+HEADER = struct.Struct('<Iqq')
+
+def segment_path(root, channel, wall_ns):
+    hour = datetime.utcfromtimestamp(wall_ns // 1000000000).strftime('%Y%m%d%H')
+    return os.path.join(root, channel, channel + '_' + hour + '.rec.gz')
+
+def list_segments(root, channel):
+    return sorted(glob.glob(os.path.join(root, channel, channel + '_*.rec.gz')))
+
+def list_channels(root):
+    return sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+
+def encode_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, ExecutionColumns):
+        return list(o)
+    raise TypeError(repr(o) + ' is not JSON serializable')
+
+def read_records(path):
+    """セグメントから(mono_ns, wall_ns, message)を順に読み出す"""
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, mono_ns, wall_ns = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+            except EOFError:
+                # 書き込み途中のセグメント
+                break
+            yield mono_ns, wall_ns, json.loads(payload.decode('utf-8'))
+
+class StreamRecorder:
+
+    def __init__(self, root, flush_interval=1.0, compresslevel=6):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.pending = deque()
+        self.files = {}
+        self.running = False
+        self.records = 0
+        self.bytes = 0
+
+    def put(self, channel, message):
+        # 受信スレッドではキューに積むだけ(シリアライズ・書き込みは記録スレッドで行う)
+        self.pending.append((channel, monotonic_ns(), time_ns(), message))
+
+    def attach(self, streaming):
+        streaming.recorders.append(self)
+        return self
+
+    def start(self):
+        self.logger.info('Start Recording ' + self.root)
+        self.running = True
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.running:
+            self.logger.info('Stop Recording ({0} records {1} bytes)'.format(self.records, self.bytes))
+            self.running = False
+            self.thread.join()
+            self.flush()
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+
+    def run_loop(self):
+        while self.running:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def open_segment(self, channel, path):
+        f = self.files.get(channel)
+        if f is None or f.name != path:
+            if f is not None:
+                f.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = gzip.GzipFile(path, mode='ab', compresslevel=self.compresslevel)
+            self.files[channel] = f
+        return f
+
+    def write(self, channel, path, chunks):
+        f = self.open_segment(channel, path)
+        f.write(b''.join(chunks))
+        f.flush()
+
+    def flush(self):
+        n = len(self.pending)
+        if n == 0:
+            return
+        # チャンネル・セグメント毎にまとめて書き込む
+        batches = {}
+        for _ in range(n):
+            channel, mono_ns, wall_ns, message = self.pending.popleft()
+            payload = json.dumps(message, default=encode_default, separators=(',',':')).encode('utf-8')
+            path = segment_path(self.root, channel, wall_ns)
+            batch = batches.get(channel)
+            if batch is not None and batch[0] != path:
+                self.write(channel, *batch)
+                batch = None
+            if batch is None:
+                batch = batches[channel] = (path, [])
+            batch[1].append(HEADER.pack(len(payload), mono_ns, wall_ns))
+            batch[1].append(payload)
+            self.records += 1
+            self.bytes += len(payload)
+        for channel, batch in batches.items():
+            self.write(channel, *batch)
+
+
+if __name__ == "__main__":
+    import argparse
+    from .streaming import Streaming, lightning_channels
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--product_id", dest='product_id', type=str, nargs='*', default=['FX_BTC_JPY'])
+    parser.add_argument("--topics", dest='topics', type=str, nargs='*', default=['executions','ticker','board'])
+    parser.add_argument("--dir", dest='dir', type=str, default='capture')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("socketio").setLevel(logging.WARNING)
+    logging.getLogger("engineio").setLevel(logging.WARNING)
+
+    streaming = Streaming()
+    recorder = StreamRecorder(args.dir).attach(streaming).start()
+    for product_id in args.product_id:
+        for channel in lightning_channels(product_id, args.topics):
+            streaming.subscribe_channel(channel, lambda channel, data: None)
+    streaming.start()
+
+    while True:
+        try:
+            sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            break
+
+    streaming.stop()
+    recorder.stop()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+記録データ再生
+
+StreamRecorder(python -m flyerbots.recorder)で記録したセグメントを読み出し、
+Streamingと同じインターフェースでEndpointへ配信する.
+
+    speed = 1.0   実時間
+    speed = N     N倍速
+    speed = 0     待ち時間なし(最速)
+"""
+import heapq
+import threading
+import logging
+from time import sleep, monotonic
+from .streaming import Streaming
+from .recorder import list_channels, list_segments, read_records
+
+def channel_records(root, channel, start_ns=None, end_ns=None):
+    for path in list_segments(root, channel):
+        for mono_ns, wall_ns, message in read_records(path):
+            if start_ns is not None and wall_ns < start_ns:
+                continue
+            if end_ns is not None and wall_ns >= end_ns:
+                return
+            yield wall_ns, mono_ns, channel, message
+
+def merge_records(root, channels=None, start_ns=None, end_ns=None):
+    """全チャンネルの記録を受信時刻順にマージして返す"""
+    channels = channels or list_channels(root)
+    return heapq.merge(*[channel_records(root, c, start_ns, end_ns) for c in channels],
+        key=lambda r: r[0])
+
+class ReplayStreaming(Streaming):
+
+    offline = True
+
+    def __init__(self, root, speed=1.0, channels=None, start_ns=None, end_ns=None):
+        super().__init__()
+        self.root = root
+        self.speed = speed
+        self.channels = channels
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.messages = 0
+        self.finished = threading.Event()
+
+    def records(self):
+        return merge_records(self.root, self.channels, self.start_ns, self.end_ns)
+
+    def subscribe(self, channel):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def replay_loop(self):
+        self.logger.info('Start Replay ' + self.root)
+        base_ns = None
+        started = monotonic()
+        try:
+            for wall_ns, mono_ns, channel, message in self.records():
+                if not self.running:
+                    break
+                if self.speed:
+                    if base_ns is None:
+                        base_ns = wall_ns
+                    wait = (wall_ns - base_ns) / 1000000000 / self.speed - (monotonic() - started)
+                    if wait > 0:
+                        sleep(wait)
+                self.on_data(channel, message, wall_ns)
+                self.messages += 1
+        except Exception as e:
+            self.logger.exception(e)
+        self.logger.info('End of Replay ({0} messages)'.format(self.messages))
+        self.connected = False
+        self.running = False
+        for ep in self.endpoints:
+            ep.shutdown()
+        self.finished.set()
+
+    def start(self):
+        self.logger.info('Start Streaming (replay x{0})'.format(self.speed or 'max'))
+        self.running = True
+        self.connected = True
+        self.thread = threading.Thread(target=self.replay_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.logger.info('Stop Streaming')
+            self.running = False
+            self.thread.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import time
+    from .streaming import lightning_channels
+    from .ohlcvbuilder import OHLCVBuilder
+
+    parser = argparse.ArgumentParser(description="Endpoint -> OHLCVBuilder -> yourlogic throughput")
+    parser.add_argument("--dir", dest='dir', type=str, default='capture')
+    parser.add_argument("--product_id", dest='product_id', type=str, default='FX_BTC_JPY')
+    parser.add_argument("--batch", dest='batch', type=int, default=10, help='messages per loop')
+    parser.add_argument("--max_ohlcv_size", dest='max_ohlcv_size', type=int, default=1000)
+    parser.add_argument("--disable_rich_ohlcv", dest='disable_rich_ohlcv', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    channels = lightning_channels(args.product_id, ['ticker', 'executions'])
+    streaming = ReplayStreaming(args.dir, speed=0, channels=channels)
+    ep = streaming.get_endpoint(args.product_id, ['ticker', 'executions'])
+    builder = OHLCVBuilder(maxlen=args.max_ohlcv_size, disable_rich_ohlcv=args.disable_rich_ohlcv)
+
+    def yourlogic(ticker, executions, ohlcv, strategy):
+        return len(ohlcv.close)
+
+    # 受信から売買ロジック呼び出しまでを1スレッドで実行して処理能力を測る
+    num_executions = num_loops = 0
+    start = time()
+    for n, (wall_ns, mono_ns, channel, message) in enumerate(streaming.records(), 1):
+        streaming.on_data(channel, message, wall_ns)
+        if n % args.batch == 0:
+            ticker = ep.get_ticker()
+            executions = ep.get_executions()
+            num_executions += len(executions)
+            if ticker is not None and (len(executions) or builder.last is not None):
+                yourlogic(ticker=ticker, executions=None, ohlcv=builder.create_boundary_ohlcv(executions), strategy=None)
+                num_loops += 1
+    elapsed = time() - start
+    print('{0} executions {1} loops in {2:.3f}s: {3:.0f} executions/s {4:.3f}ms/loop'.format(
+        num_executions, num_loops, elapsed, num_executions / elapsed, elapsed * 1000 / max(num_loops, 1)))
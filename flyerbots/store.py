@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+列形式の約定履歴・OHLCVストア
+
+列毎の生バイナリファイルにテーブル・商品・日(UTC)で分けて追記する.
+読み出しはnp.memmapで、時刻の列を二分探索して範囲を切り出すのでパースしない.
+
+    <root>/<table>/<product_id>/<YYYYmmdd>/<column>.<dtype>
+
+    executions  約定履歴(ExecutionRecorderがStreamingから追記する. 時刻の列はexec_ns)
+    ohlcv       確定した足(OHLCVBuilder.storeに設定すると追記する. 時刻の列はcreated_at、AlignedOHLCVBuilderはopened_at)
+
+各列のファイルは同じ行数(書き込み途中で止まった場合は短い列に揃える). 行は時刻の列の順に追記すること(順でなければValueError).
+最後に書いた時刻と同じ時刻の行は、約定は約定IDで重複を除き、足は最後の足を書き換える.
+
+    store = ColumnStore('store', 'executions', 'FX_BTC_JPY', 'exec_ns', EXECUTION_DTYPES, key_column='id')
+    e = store.read(start_ns, end_ns)            # 列名→numpy配列
+    e.price, e.size, e.exec_ns
+"""
+import os
+import glob
+import threading
+import logging
+import numpy as np
+from time import sleep
+from datetime import datetime
+from collections import deque
+from .utils import dotdict
+from .executions import ExecutionColumns
+from .ohlcvbuilder import INT_COLUMNS
+from .streaming import lightning_channel
+
+DAY_NS = 86400 * 1000000000
+
+EXECUTION_DTYPES = {
+    'id': 'i8',
+    'exec_ns': 'i8',
+    'price': 'f8',
+    'size': 'f8',
+    'side': 'i1',
+    'receved_at': 'i8',
+    'buy_child_order_acceptance_id': 'S32',
+    'sell_child_order_acceptance_id': 'S32',
+}
+
+def day_name(day):
+    return datetime.utcfromtimestamp(day * 86400).strftime('%Y%m%d')
+
+def day_number(name):
+    return (datetime.strptime(name, '%Y%m%d') - datetime(1970, 1, 1)).days
+
+def read_column(path, dtype, rows):
+    if rows == 0:
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype, 'r', shape=(rows,))
+
+class ColumnStore:
+
+    def __init__(self, root, table, product_id, time_column, dtypes, key_column=None, replace_last=False):
+        """
+        dtypes        列名→dtype(dict または 列名を受け取る関数)
+        key_column    最後に書いた時刻と同じ時刻の行はこの列の値で重複を除く(約定ID)
+        replace_last  最後に書いた時刻と同じ時刻の行はその行を書き換える(更新された足)
+        最後に書いた時刻より前の行は追記しない(再起動後に同じ約定・足を二重に書かない)
+        """
+        self.path = os.path.join(root, table, product_id.replace('/', '_'))
+        self.time_column = time_column
+        self.declared = dtypes
+        self.dtypes = {}
+        self.key_column = key_column
+        self.replace_last = replace_last
+        self.lock = threading.Lock()
+        self.files = {}
+        self.day = None
+        self.last_time = None
+        # 最後に書いた時刻の行のkey_columnの値
+        self.last_keys = set()
+        days = self.days()
+        if len(days):
+            data = self.read_day(days[-1], [time_column, key_column])
+            t = data[time_column]
+            if len(t):
+                self.last_time = int(t[-1])
+                if key_column is not None:
+                    self.last_keys = set(data[key_column][np.searchsorted(t, self.last_time, 'left'):].tolist())
+
+    def dtype(self, name):
+        if name not in self.dtypes:
+            dtype = self.declared(name) if callable(self.declared) else self.declared.get(name)
+            if dtype is None:
+                raise ValueError('dtype of column {0} is not declared'.format(name))
+            self.dtypes[name] = np.dtype(dtype)
+        return self.dtypes[name]
+
+    def days(self):
+        """データのある日(エポックからの日数)"""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(day_number(d) for d in os.listdir(self.path) if len(d) == 8 and d.isdigit())
+
+    def day_columns(self, day):
+        """その日の列名→(パス, dtype)"""
+        columns = {}
+        for path in glob.glob(os.path.join(self.path, day_name(day), '*.*')):
+            name, dtype = os.path.basename(path).rsplit('.', 1)
+            columns[name] = (path, np.dtype(dtype))
+        return columns
+
+    def day_rows(self, columns):
+        return min((os.path.getsize(path) // dtype.itemsize for path, dtype in columns.values()), default=0)
+
+    def read_day(self, day, names=None):
+        columns = self.day_columns(day)
+        rows = self.day_rows(columns)
+        return {name:read_column(path, dtype, rows) for name, (path, dtype) in columns.items()
+            if names is None or name in names}
+
+    def read(self, start_ns=None, end_ns=None, columns=None):
+        """start_ns <= 時刻 < end_ns の行を列名→numpy配列で返す(1日分ならmemmapの一部をそのまま返す)"""
+        if columns is not None and self.time_column not in columns:
+            columns = list(columns) + [self.time_column]
+        days = self.days()
+        if start_ns is not None:
+            days = [d for d in days if d >= start_ns // DAY_NS]
+        if end_ns is not None:
+            days = [d for d in days if d <= (end_ns - 1) // DAY_NS]
+        parts = []
+        for day in days:
+            data = self.read_day(day, columns)
+            t = data[self.time_column]
+            lo = 0 if start_ns is None else np.searchsorted(t, start_ns, 'left')
+            hi = len(t) if end_ns is None else np.searchsorted(t, end_ns, 'left')
+            if hi > lo:
+                parts.append({name:col[lo:hi] for name, col in data.items()})
+        if len(parts) == 0:
+            return dotdict()
+        if len(parts) == 1:
+            return dotdict(parts[0])
+        return dotdict({name:np.concatenate([p[name] for p in parts if name in p]) for name in parts[-1]})
+
+    def open_day(self, day, names):
+        if self.day != day:
+            self.close()
+            os.makedirs(os.path.join(self.path, day_name(day)), exist_ok=True)
+            # 書き込み途中で止まった列は短い列に揃える
+            existing = self.day_columns(day)
+            rows = self.day_rows(existing)
+            for path, dtype in existing.values():
+                if os.path.getsize(path) > rows * dtype.itemsize:
+                    os.truncate(path, rows * dtype.itemsize)
+            self.day = day
+            self.rows = rows
+        for name in names:
+            if name not in self.files:
+                path = os.path.join(self.path, day_name(day), name + '.' + self.dtype(name).str[1:])
+                if self.rows and not os.path.exists(path):
+                    raise ValueError('column {0} is not in {1}'.format(name, os.path.dirname(path)))
+                self.files[name] = open(path, 'ab')
+
+    def append(self, columns):
+        """列名→配列(同じ長さ. 時刻の列の順)を追記する"""
+        with self.lock:
+            columns = {name:np.asarray(values) for name, values in columns.items()}
+            for name in columns:
+                self.dtype(name)
+            t = columns[self.time_column].astype('i8', copy=False)
+            if len(t) > 1 and np.any(t[1:] < t[:-1]):
+                raise ValueError('rows are not sorted by {0}'.format(self.time_column))
+            written = 0
+            if self.last_time is not None:
+                start = np.searchsorted(t, self.last_time, 'left')
+                end = np.searchsorted(t, self.last_time, 'right')
+                if end > start and self.replace_last:
+                    # 同じ時刻の最後の行で最後に書いた行を書き換える
+                    self.replace_row(columns, end - 1)
+                    written += 1
+                    start = end
+                if start > 0 or (end > start and self.key_column is not None):
+                    keep = np.arange(start, len(t))
+                    if end > start and self.key_column is not None:
+                        keys = columns[self.key_column][start:end].tolist()
+                        keep = keep[np.array([k not in self.last_keys for k in keys] + [True] * (len(t) - end), bool)]
+                    columns = {name:values[keep] for name, values in columns.items()}
+                    t = t[keep]
+            if len(t) == 0:
+                return written
+            days = t // DAY_NS
+            cuts = [0] + (np.flatnonzero(np.diff(days)) + 1).tolist() + [len(t)]
+            for lo, hi in zip(cuts[:-1], cuts[1:]):
+                self.open_day(int(days[lo]), columns.keys())
+                for name, values in columns.items():
+                    self.files[name].write(np.ascontiguousarray(values[lo:hi], self.dtypes[name]).tobytes())
+                self.rows += hi - lo
+            for f in self.files.values():
+                f.flush()
+            if self.key_column is not None:
+                keys = columns[self.key_column][np.searchsorted(t, t[-1], 'left'):].tolist()
+                if t[-1] == self.last_time:
+                    self.last_keys.update(keys)
+                else:
+                    self.last_keys = set(keys)
+            self.last_time = int(t[-1])
+            return written + len(t)
+
+    def replace_row(self, columns, i):
+        """最後に書いた行をcolumnsのi行目で書き換える"""
+        self.open_day(self.last_time // DAY_NS, columns.keys())
+        for name, values in columns.items():
+            dtype = self.dtypes[name]
+            with open(self.files[name].name, 'r+b') as f:
+                f.seek((self.rows - 1) * dtype.itemsize)
+                f.write(np.ascontiguousarray(values[i:i + 1], dtype).tobytes())
+
+    def append_row(self, row):
+        return self.append({name:[value] for name, value in row.items()})
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.day = None
+
+def execution_columns(data):
+    """受信単位の約定(dictのリスト または ExecutionColumns)をストアの列にする"""
+    if not isinstance(data, ExecutionColumns):
+        data = ExecutionColumns.from_dicts(data)
+    n = len(data)
+    return {
+        'id': np.frombuffer(data.id, 'i8'),
+        'exec_ns': np.frombuffer(data.exec_ns, 'i8'),
+        'price': np.frombuffer(data.price, 'f8'),
+        'size': np.frombuffer(data.size, 'f8'),
+        'side': np.frombuffer(data.side, 'i1'),
+        'receved_at': np.full(n, data.receved_at or 0, 'i8'),
+        'buy_child_order_acceptance_id': np.array(data.buy_child_order_acceptance_id, 'S32'),
+        'sell_child_order_acceptance_id': np.array(data.sell_child_order_acceptance_id, 'S32'),
+    }
+
+def ohlcv_dtype(name):
+    """足の列のdtype(OHLCVColumnsと同じ)"""
+    return 'i8' if name in INT_COLUMNS else 'f8'
+
+def execution_store(root, product_id):
+    return ColumnStore(root, 'executions', product_id, 'exec_ns', EXECUTION_DTYPES, key_column='id')
+
+def ohlcv_store(root, product_id, table='ohlcv', time_column='created_at'):
+    return ColumnStore(root, table, product_id, time_column, ohlcv_dtype, replace_last=True)
+
+def stored_messages(root, product_id, start_ns, end_ns=None):
+    """ストアからstart_ns以降に約定した約定を受信単位(get_executions(chained=False)と同じ形)で返す"""
+    e = execution_store(root, product_id).read(start_ns, end_ns)
+    if len(e) == 0 or len(e.id) == 0:
+        return []
+    exec_date = [d[:27] + 'Z' for d in np.datetime_as_string(e.exec_ns.astype('datetime64[ns]'), unit='ns').tolist()]
+    side = [{1:'BUY', -1:'SELL'}.get(s, '') for s in e.side.tolist()]
+    price = e.price.tolist()
+    size = e.size.tolist()
+    buy_id = [s.decode() for s in e.buy_child_order_acceptance_id.tolist()]
+    sell_id = [s.decode() for s in e.sell_child_order_acceptance_id.tolist()]
+    receved_at = e.receved_at.tolist()
+    # 受信時刻が変わる所で受信単位に分ける
+    cuts = [0] + (np.flatnonzero(np.diff(e.receved_at)) + 1).tolist() + [len(receved_at)]
+    messages = []
+    for lo, hi in zip(cuts[:-1], cuts[1:]):
+        message = [{'id':i, 'side':side[k], 'price':price[k], 'size':size[k], 'exec_date':exec_date[k],
+            'buy_child_order_acceptance_id':buy_id[k], 'sell_child_order_acceptance_id':sell_id[k]}
+            for k, i in zip(range(lo, hi), e.id[lo:hi].tolist())]
+        message[-1]['receved_at'] = receved_at[hi - 1]
+        message[-1]['bucket_size'] = hi - lo
+        messages.append(message)
+    return messages
+
+class ExecutionRecorder:
+    """Streamingで受信した約定履歴をストアに追記する(StreamRecorderと同じく書き込みは記録スレッドで行う)"""
+
+    def __init__(self, root, product_ids, flush_interval=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.flush_interval = flush_interval
+        self.stores = {lightning_channel(p, 'executions'):execution_store(root, p) for p in product_ids}
+        self.pending = deque()
+        self.running = False
+        self.records = 0
+
+    def put(self, channel, message):
+        if channel in self.stores:
+            self.pending.append((channel, message))
+
+    def attach(self, streaming):
+        streaming.recorders.append(self)
+        return self
+
+    def start(self):
+        self.logger.info('Start ExecutionRecorder ' + self.root)
+        self.running = True
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.running:
+            self.logger.info('Stop ExecutionRecorder ({0} executions)'.format(self.records))
+            self.running = False
+            self.thread.join()
+            self.flush()
+            for store in self.stores.values():
+                store.close()
+
+    def run_loop(self):
+        while self.running:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def flush(self):
+        n = len(self.pending)
+        if n == 0:
+            return
+        # チャンネル毎にまとめて書き込む
+        batches = {}
+        for _ in range(n):
+            channel, message = self.pending.popleft()
+            if len(message):
+                batches.setdefault(channel, []).append(execution_columns(message))
+        for channel, batch in batches.items():
+            columns = {name:np.concatenate([b[name] for b in batch]) for name in EXECUTION_DTYPES}
+            self.records += self.stores[channel].append(columns)
+
+
+if __name__ == "__main__":
+    import json
+    import shutil
+    import tempfile
+    import argparse
+    from time import time
+
+    parser = argparse.ArgumentParser(description="store: read a day of executions vs JSON parsing")
+    parser.add_argument("--executions", dest='executions', type=int, default=1000000, help='executions per day')
+    parser.add_argument("--repeat", dest='repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # 1日分の約定(受信単位は平均3約定)
+    n = args.executions
+    rng = np.random.default_rng(1)
+    day0 = 17822 * DAY_NS
+    exec_ns = day0 + np.sort(rng.integers(0, DAY_NS, n))
+    cols = {
+        'id': np.arange(n, dtype='i8') + 500000000,
+        'exec_ns': exec_ns,
+        'price': 700000 + np.cumsum(rng.integers(-50, 51, n)).astype('f8'),
+        'size': np.round(rng.exponential(0.05, n), 8),
+        'side': rng.choice(np.array([1, -1], 'i1'), n),
+        'receved_at': exec_ns + 50000000,
+        'buy_child_order_acceptance_id': np.array(['JRF20181018-000000-{0:06d}'.format(i % 1000000) for i in range(n)], 'S32'),
+        'sell_child_order_acceptance_id': np.array(['JRF20181018-000000-{0:06d}'.format((i * 7) % 1000000) for i in range(n)], 'S32'),
+    }
+    cols['receved_at'] = cols['receved_at'] - cols['receved_at'] % 150000000
+
+    root = tempfile.mkdtemp()
+    try:
+        store = execution_store(root, 'FX_BTC_JPY')
+        start = time()
+        for lo in range(0, n, 10000):
+            store.append({k:v[lo:lo + 10000] for k, v in cols.items()})
+        store.close()
+        print('append      {0:9.1f}ms ({1} executions)'.format((time() - start) * 1000, n))
+
+        def bench(name, func):
+            best = None
+            for _ in range(args.repeat):
+                start = time()
+                result = func()
+                elapsed = time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('{0:<11} {1:9.1f}ms'.format(name, best * 1000))
+            return result
+
+        store = execution_store(root, 'FX_BTC_JPY')
+        day = bench('read day', lambda: store.read(day0, day0 + DAY_NS))
+        assert np.array_equal(day.price, cols['price']) and np.array_equal(day.id, cols['id'])
+        hour = bench('read 1 hour', lambda: store.read(day0 + 12 * 3600 * 1000000000, day0 + 13 * 3600 * 1000000000))
+        assert np.all(np.diff(hour.exec_ns) >= 0) and len(hour.id) > 0
+        bench('sum volume', lambda: float(store.read(day0, day0 + DAY_NS, ['size']).size.sum()))
+
+        # 比較: 同じ約定をJSON(1行1受信単位)から読む
+        messages = stored_messages(root, 'FX_BTC_JPY', day0)
+        assert sum(len(m) for m in messages) == n
+        path = os.path.join(root, 'day.jsonl')
+        with open(path, 'w') as f:
+            for m in messages:
+                f.write(json.dumps(m, separators=(',',':')) + '\n')
+
+        def read_json():
+            with open(path) as f:
+                return [json.loads(line) for line in f]
+        bench('json',  read_json)
+        bench('messages', lambda: stored_messages(root, 'FX_BTC_JPY', day0))
+    finally:
+        shutil.rmtree(root)
@@ -8,9 +8,15 @@ import logging
 import logging.config
 import pandas as pd
 from .streaming import Streaming
-from .ohlcvbuilder import OHLCVBuilder
+from .hub import HubStreaming
+from .ohlcvbuilder import OHLCVBuilder, MultiOHLCVBuilder, ActivityOHLCVBuilder, AlignedOHLCVBuilder
+from .recorder import StreamRecorder
+from .store import ExecutionRecorder, ohlcv_store
+from .warmstart import warm_start
+from .memo import cache as indicator_cache
+from .indicatorgraph import IndicatorGraph
 from .exchange import Exchange
-from .utils import dotdict, stop_watch
+from .utils import dotdict, stop_watch, time_ns
 from math import fsum
 
 class Strategy:
@@ -36,12 +42,57 @@ class Strategy:
         # 動作タイミング
         self.settings.interval = interval
         self.settings.timeframe = 60
+        # 複数時間足(例: [1, 5, 60]. 設定するとohlcvは時間足→OHLCVのdictになる)
+        self.settings.timeframes = None
+        # 約定回数・出来高・売買代金で区切る足('tick' / 'volume' / 'notional' と bar_size)
+        self.settings.bar_type = None
+        self.settings.bar_size = 0
 
         # OHLCV生成オプション
         self.settings.max_ohlcv_size = 1000
         self.settings.use_lazy_ohlcv = False
+        # 約定時刻で区切り、区間の終わりからohlcv_grace秒は遅れて届いた約定を足し込む(確定前の足はconfirmed=0)
+        self.settings.use_aligned_ohlcv = False
+        self.settings.ohlcv_grace = 2.0
         self.settings.disable_create_ohlcv = False
         self.settings.disable_rich_ohlcv = False
+        # 追加で集計する列('vwap', 'stdev', 'market_order_delay')
+        self.settings.ohlcv_extras = []
+        # OHLCVの列を渡した指標を足が変わるまで使い回す(strategy.indicator_cache.statsにヒット数)
+        self.settings.indicator_cache = False
+
+        # 起動時に過去の約定から足を作る(store_dirのストアかrecord_dirの記録、足りない分はREST API)
+        # warm_start_seconds=0なら足の本数分. REST APIのページ数上限・並列数. 記録の受信がwarm_start_gap秒以上空いた所もRESTで埋める
+        self.settings.warm_start = False
+        self.settings.warm_start_seconds = 0
+        self.settings.warm_start_max_pages = 60
+        self.settings.warm_start_workers = 4
+        self.settings.warm_start_gap = 60
+
+        # 約定履歴を列形式で受信する
+        self.settings.execution_columns = False
+
+        # ストリームのバッファサイズ(トピック毎)・溢れた約定履歴をディスクに退避するか
+        self.settings.stream_capacity = {'executions': 10000}
+        self.settings.stream_spill = False
+
+        # ストリームの接続方式('socketio' or 'jsonrpc')・再接続待ちの最小/最大(秒)
+        self.settings.stream_transport = 'socketio'
+        self.settings.stream_reconnect_delay = (0.5, 30)
+
+        # マーケットデータハブ(python -m flyerbots.hub)のソケット. 設定すると取引所に直接接続しない
+        self.settings.stream_hub = None
+
+        # 注文状態監視に板差分も使う(板を購読し、差分で更新された価格帯の注文だけ板と照合して取消を判定する)
+        self.settings.monitor_board = False
+
+        # 再接続で欠落した約定履歴をREST APIで補完する(再接続毎にREST APIを呼ぶ. ハブ・記録データ再生では行わない)
+        self.settings.stream_backfill = False
+
+        # ストリーム記録(保存先ディレクトリ)
+        self.settings.record_dir = None
+        # 約定履歴・確定した足の列形式ストア(保存先ディレクトリ)
+        self.settings.store_dir = None
 
         # その為
         self.settings.show_last_n_orders = 0
@@ -54,6 +105,9 @@ class Strategy:
         self.risk.max_position_size = 1.0
         self.risk.max_num_of_orders = 1
 
+        # 指標の依存グラフ(yoursetupでadd、yourlogicでupdate(ohlcv))
+        self.indicators = IndicatorGraph()
+
         # ログ設定
         self.logger = logging.getLogger(__name__)
 
@@ -243,54 +297,135 @@ class Strategy:
         # 注文
         self.order(myid, side, qty, limit, stop, time_in_force, minute_to_expire, symbol, limit_mask)
 
-    def setup(self):
+    def setup(self, streaming=None):
         # 実行中フラグセット
         self.running = True
 
         # 高頻度取引？
         self.hft = self.settings.interval < 3
 
+        # ストリーミング(記録データ再生時はReplayStreamingを渡す)
+        if streaming is None:
+            streaming = HubStreaming(self.settings.stream_hub) if self.settings.stream_hub else Streaming()
+        self.streaming = streaming
+        self.streaming.execution_columns = self.settings.execution_columns
+        self.streaming.capacity.update(self.settings.stream_capacity)
+        self.streaming.spill = self.settings.stream_spill
+        if not self.streaming.offline and not self.settings.stream_hub:
+            self.streaming.transport = self.settings.stream_transport
+            self.streaming.reconnect_delay_min, self.streaming.reconnect_delay_max = self.settings.stream_reconnect_delay
+
         # 取引所セットアップ
         self.exchange = Exchange(apiKey=self.settings.apiKey, secret=self.settings.secret)
-        if self.settings.use_lightning:
+        if self.settings.use_lightning and not self.streaming.offline:
             self.exchange.enable_lightning_api(
                 self.settings.lightning_userid,
                 self.settings.lightning_password)
-        self.exchange.start()
-
-        # ストリーミング開始
-        self.streaming = Streaming()
-        self.streaming.start()
+        self.exchange.start(offline=self.streaming.offline)
+        if self.settings.stream_backfill and not self.streaming.offline and not isinstance(self.streaming, HubStreaming):
+            self.streaming.enable_backfill(self.exchange.fetch_executions)
+
+        # ストリーム購読
+        if self.settings.record_dir:
+            self.recorder = StreamRecorder(self.settings.record_dir).attach(self.streaming).start()
+        if self.settings.store_dir and not self.streaming.offline:
+            self.execution_recorder = ExecutionRecorder(self.settings.store_dir, [self.settings.symbol]).attach(self.streaming).start()
         self.ep = self.streaming.get_endpoint(self.settings.symbol, ['ticker', 'executions'])
-        self.ep.wait_for(['ticker'])
 
         # SFD計算用に現物価格も購読
         self.fx_btc = (self.settings.symbol == 'FX_BTC_JPY')
         if self.fx_btc:
             self.ep_spot = self.streaming.get_endpoint('BTC/JPY', ['ticker'])
-            self.ep_spot.wait_for(['ticker'])
 
         # ohlcvビルダー作成
-        self.ohlcvbuilder = OHLCVBuilder(
-            maxlen=self.settings.max_ohlcv_size,
-            timeframe=self.settings.timeframe,
-            disable_rich_ohlcv=self.settings.disable_rich_ohlcv)
+        if self.settings.timeframes:
+            self.ohlcvbuilder = MultiOHLCVBuilder(
+                self.settings.timeframes,
+                maxlen=self.settings.max_ohlcv_size,
+                disable_rich_ohlcv=self.settings.disable_rich_ohlcv,
+                extras=self.settings.ohlcv_extras)
+        elif self.settings.bar_type:
+            self.ohlcvbuilder = ActivityOHLCVBuilder(
+                maxlen=self.settings.max_ohlcv_size,
+                bar_type=self.settings.bar_type,
+                bar_size=self.settings.bar_size,
+                disable_rich_ohlcv=self.settings.disable_rich_ohlcv,
+                extras=self.settings.ohlcv_extras)
+        elif self.settings.use_aligned_ohlcv:
+            self.ohlcvbuilder = AlignedOHLCVBuilder(
+                maxlen=self.settings.max_ohlcv_size,
+                timeframe=self.settings.timeframe,
+                grace=self.settings.ohlcv_grace,
+                disable_rich_ohlcv=self.settings.disable_rich_ohlcv,
+                extras=self.settings.ohlcv_extras)
+        else:
+            self.ohlcvbuilder = OHLCVBuilder(
+                maxlen=self.settings.max_ohlcv_size,
+                timeframe=self.settings.timeframe,
+                disable_rich_ohlcv=self.settings.disable_rich_ohlcv,
+                extras=self.settings.ohlcv_extras)
+        if self.settings.store_dir:
+            if self.settings.timeframes:
+                for tf, builder in self.ohlcvbuilder.builders.items():
+                    builder.store = ohlcv_store(self.settings.store_dir, self.settings.symbol, 'ohlcv_{0}'.format(tf))
+            else:
+                self.ohlcvbuilder.store = ohlcv_store(self.settings.store_dir, self.settings.symbol,
+                    time_column='opened_at' if self.settings.use_aligned_ohlcv else 'created_at')
 
         # 約定履歴・板差分から注文状態監視
-        if 0:
+        book = None
+        if self.settings.monitor_board:
+            book = self.streaming.get_order_book(self.settings.symbol)
             ep = self.streaming.get_endpoint(self.settings.symbol, ['executions', 'board'])
         else:
             ep = self.streaming.get_endpoint(self.settings.symbol, ['executions'])
-        self.exchange.start_monitoring(ep)
+        self.exchange.start_monitoring(ep, book)
         self.monitoring_ep = ep
 
+        # 指標のメモ化
+        self.indicator_cache = indicator_cache
+        self.indicator_cache.enabled = bool(self.settings.indicator_cache)
+
         # 売買ロジックセットアップ
         if self.yoursetup:
             self.yoursetup(self)
 
-    def start(self):
+        # ストリーミング開始(購読が揃ってから開始する)
+        self.streaming.start()
+        self.ep.wait_for(['ticker'])
+        if self.fx_btc:
+            self.ep_spot.wait_for(['ticker'])
+
+        # 受信を始めてから過去の約定で足を作る(重複した約定はEndpointで捨てる)
+        if self.settings.warm_start and not self.settings.disable_create_ohlcv and not self.streaming.offline:
+            self.warm_start()
+
+    def warm_start(self):
+        seconds = self.settings.warm_start_seconds
+        if not seconds:
+            maxlen = self.settings.max_ohlcv_size
+            if self.settings.timeframes:
+                seconds = max(self.settings.timeframes) * maxlen
+            elif self.settings.bar_type:
+                seconds = 3600
+            elif self.settings.use_lazy_ohlcv or self.settings.use_aligned_ohlcv:
+                seconds = self.settings.timeframe * maxlen
+            else:
+                seconds = max(self.settings.interval, 1) * maxlen
+        try:
+            last_id = warm_start(self.ohlcvbuilder, self.exchange.fetch_executions, self.settings.symbol,
+                time_ns() - int(seconds * 1000000000), self.settings.record_dir,
+                interval=self.settings.interval, lazy=self.settings.use_lazy_ohlcv,
+                max_pages=self.settings.warm_start_max_pages, workers=self.settings.warm_start_workers,
+                store_dir=self.settings.store_dir, gap=self.settings.warm_start_gap)
+            if last_id is not None:
+                self.ep.skip_execution_id = last_id
+        except Exception as e:
+            self.logger.warning(type(e).__name__ + ": {0}".format(e))
+
+    def start(self, streaming=None):
         self.logger.info("Start Trading")
-        self.setup()
+        self.setup(streaming)
 
         def async_inverval(func, interval, parallels):
             next_exec_time = 0
@@ -324,8 +459,9 @@ class Strategy:
         once = True
         self.sfd = dotdict()
         self.sfd.detected = False
+        last_stream_state = {}
 
-        while True:
+        while self.streaming.running:
             self.interval = self.settings.interval
 
             try:
@@ -382,6 +518,16 @@ class Strategy:
                         if not self.hft:
                             self.logger.info("REST API: {0} ({1:.1f}ms)".format(self.api_state, self.api_avg_response_time*1000))
 
+                    # ストリーム滞留状況
+                    self.stream_state = self.ep.stats()
+                    if not self.hft:
+                        for channel, st in self.stream_state.items():
+                            # 欠落・退避・滞留が増えた時だけ表示する
+                            last = (st.dropped, st.spilled, st.high_water)
+                            if last != last_stream_state.get(channel) and (st.dropped or st.spilled or st.high_water*2 >= st.capacity):
+                                self.logger.info("STREAM: {0} backlog {backlog}/{capacity} high {high_water} dropped {dropped} spilled {spilled}".format(channel, **st))
+                            last_stream_state[channel] = last
+
                 # 価格データ取得
                 ticker, executions, ohlcv = dotdict(self.ep.get_ticker()), None, None
 
@@ -389,7 +535,13 @@ class Strategy:
                 if self.settings.disable_create_ohlcv:
                     executions = self.ep.get_executions()
                 else:
-                    if self.settings.use_lazy_ohlcv:
+                    if self.settings.timeframes:
+                        ohlcv = self.ohlcvbuilder.create_ohlcv(self.ep.get_executions(chained=False))
+                    elif self.settings.bar_type:
+                        ohlcv = self.ohlcvbuilder.create_ohlcv(self.ep.get_executions())
+                    elif self.settings.use_aligned_ohlcv:
+                        ohlcv = self.ohlcvbuilder.create_ohlcv(self.ep.get_executions(chained=False))
+                    elif self.settings.use_lazy_ohlcv:
                         ohlcv = self.ohlcvbuilder.create_lazy_ohlcv(self.ep.get_executions(chained=False))
                     else:
                         ohlcv = self.ohlcvbuilder.create_boundary_ohlcv(self.ep.get_executions())
@@ -441,9 +593,15 @@ class Strategy:
                 errorWait = time() + 1
 
         self.logger.info("Stop Trading")
+        if self.settings.indicator_cache:
+            self.logger.info("INDICATOR CACHE: hits {hits} extends {extends} misses {misses} bypass {bypass}".format(**self.indicator_cache.stats))
         # 停止
         self.running = False
         # ストリーミング停止
         self.streaming.stop()
+        if self.settings.record_dir:
+            self.recorder.stop()
+        if self.settings.store_dir and not self.streaming.offline:
+            self.execution_recorder.stop()
         # 取引所停止
         self.exchange.stop()
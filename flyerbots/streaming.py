@@ -1,26 +1,26 @@
 # -*- coding: utf-8 -*-
 import threading
 import logging
+import pickle
+import tempfile
 import json
+import random
 import websocket
 import socketio
 from time import sleep
 from datetime import datetime
-from .utils import dotdict, stop_watch
+from .utils import dotdict, stop_watch, time_ns, parse_exec_date_ns, ns_to_datetime
+from .executions import ExecutionColumns, parse_executions_frame
+from .backfill import ExecutionBackfill
+from .orderbook import OrderBook
+from . import fastjson
 from itertools import chain
 from collections import deque, defaultdict
 from functools import partial
+from bisect import bisect_right
 
 def parse_exec_date(exec_date):
-    exec_date = exec_date.rstrip('Z')+'0000000'
-    return datetime(
-        int(exec_date[0:4]),
-        int(exec_date[5:7]),
-        int(exec_date[8:10]),
-        int(exec_date[11:13]),
-        int(exec_date[14:16]),
-        int(exec_date[17:19]),
-        int(exec_date[20:26]))
+    return ns_to_datetime(parse_exec_date_ns(exec_date))
 
 def parse_order_ref_id(order_ref_id):
     return datetime(
@@ -38,8 +38,16 @@ def lightning_channels(product_id, topics):
 def lightning_channel(product_id, topic):
     return 'lightning_' + topic + '_' + product_id.replace('/','_')
 
+def lightning_topic(channel):
+    for topic in ['board_snapshot', 'board', 'ticker', 'executions']:
+        if channel.startswith('lightning_' + topic + '_'):
+            return topic
+    return channel
+
 class Streaming:
 
+    offline = False
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.ws = None
@@ -49,27 +57,59 @@ class Streaming:
         self.endpoints = []
         self.connected = False
         self.callbacks = defaultdict(list)
-
-    def ws_on_message(self, message):
-        message = json.loads(message)
+        self.recorders = []
+        self.buffers = {}
+        # 接続方式('socketio' or 'jsonrpc')と接続先
+        self.transport = 'socketio'
+        self.sio_url = 'https://io.lightstream.bitflyer.com'
+        self.ws_url = 'wss://ws.lightstream.bitflyer.com/json-rpc'
+        # 再接続待ち(指数バックオフ+ジッター)
+        self.reconnect_delay_min = 0.5
+        self.reconnect_delay_max = 30
+        self.reconnect_jitter = 0.5
+        self.reconnect_attempts = 0
+        # 再接続の計測(接続から各チャンネルの最初のメッセージまで)
+        self.connects = 0
+        self.connected_at = None
+        self.disconnected_at = None
+        self.restore_elapsed = 0
+        self.first_message_pending = set()
+        self.reconnect_stats = defaultdict(lambda: dotdict(reconnects=0, first_message=0, first_message_max=0, blind=0, blind_max=0))
+        # トピック毎のバッファサイズ・溢れた約定履歴をディスクに退避するか
+        self.capacity = {}
+        self.default_capacity = 1000
+        self.spill = False
+        # 約定履歴を列形式(ExecutionColumns)で受け取る
+        self.execution_columns = False
+        # 約定履歴の欠落補完(チャンネル毎)
+        self.backfill_fetch = None
+        self.backfills = {}
+        # 板情報(商品毎に共有)
+        self.order_books = {}
+
+    def ws_on_message(self, *args):
+        # websocket-clientのバージョンによって先頭にWebSocketAppが渡される
+        message = args[-1]
+        if self.execution_columns:
+            # 約定履歴はdictを作らずに列へ展開する
+            parsed = parse_executions_frame(message)
+            if parsed is not None:
+                self.on_data(*parsed)
+                return
+        message = fastjson.loads(message)
         if message["method"] == "channelMessage":
             channel = message["params"]["channel"]
             message = message["params"]["message"]
             self.on_data(channel,message)
 
-    def ws_on_error(self, error):
-        self.logger.info(error)
+    def ws_on_error(self, *args):
+        self.logger.info(args[-1])
 
-    def ws_on_close(self):
-        self.logger.info('disconnected')
-        self.connected = False
+    def ws_on_close(self, *args):
+        self.on_disconnected()
 
-    def ws_on_open(self):
-        self.logger.info('connected')
-        self.connected = True
-        if len(self.subscribed_channels):
-            for channel in self.subscribed_channels:
-                self.ws_subscribe(channel)
+    def ws_on_open(self, *args):
+        self.on_connected()
 
     def ws_subscribe(self,channel):
         self.ws.send(json.dumps({'method': 'subscribe', 'params': {'channel': channel}}))
@@ -80,7 +120,7 @@ class Streaming:
     def ws_run_loop(self):
         while self.running:
             try:
-                self.ws = websocket.WebSocketApp("wss://ws.lightstream.bitflyer.com/json-rpc",
+                self.ws = websocket.WebSocketApp(self.ws_url,
                     on_message=self.ws_on_message,
                     on_error=self.ws_on_error,
                     on_close=self.ws_on_close)
@@ -89,21 +129,16 @@ class Streaming:
             except Exception as e:
                 self.logger.exception(e)
             if self.running:
-                sleep(5)
+                sleep(self.reconnect_delay())
 
     def sio_on_data(self, channel, data):
         self.on_data(channel,data)
 
-    def sio_on_disconnect(self):
-        self.logger.info('disconnected')
-        self.connected = False
+    def sio_on_disconnect(self, *args):
+        self.on_disconnected()
 
     def sio_on_connect(self):
-        self.logger.info('connected')
-        self.connected = True
-        if len(self.subscribed_channels):
-            for channel in self.subscribed_channels:
-                self.sio_subscribe(channel)
+        self.on_connected()
 
     def sio_subscribe(self,channel):
         self.sio.on(channel,partial(self.sio_on_data,channel))
@@ -115,46 +150,145 @@ class Streaming:
     def sio_run_loop(self):
         while self.running:
             try:
-                self.sio = socketio.Client(reconnection=True, reconnection_attempts=0, reconnection_delay=1, reconnection_delay_max=30)
+                # 再接続はws_run_loopと同じくこのループで行う
+                self.sio = socketio.Client(reconnection=False, json=fastjson)
                 self.sio.on('connect', self.sio_on_connect)
                 self.sio.on('disconnect', self.sio_on_disconnect)
-                self.sio.connect('https://io.lightstream.bitflyer.com', transports = ['websocket'])
-                self.sio.wait()
+                self.sio.connect(self.sio_url, transports = ['websocket'])
+                # Client.wait()は切断後に1秒待つのでengineioの終了を直接待つ
+                self.sio.eio.wait()
             except Exception as e:
                 self.logger.exception(e)
             if self.running:
-                sleep(5)
+                sleep(self.reconnect_delay())
 
-    def on_data(self,channel,data):
-        if isinstance(data,list):
-            data[-1]['receved_at'] = datetime.utcnow()
+    def on_connected(self):
+        self.logger.info('connected')
+        self.connected = True
+        self.connects += 1
+        self.connected_at = time_ns()
+        # 購読を復元し、各チャンネルの最初のメッセージまでの時間を計る
+        self.first_message_pending = set(self.subscribed_channels)
+        for backfill in self.backfills.values():
+            backfill.reconnected()
+        for channel in self.subscribed_channels:
+            self.subscribe(channel)
+        self.restore_elapsed = (time_ns() - self.connected_at) / 1000000000
+        if not self.first_message_pending:
+            self.on_recovered()
+
+    def on_disconnected(self):
+        if self.connected:
+            self.logger.info('disconnected')
+            self.connected = False
+            # 接続直後に切られた場合は最初の切断から計る
+            if self.disconnected_at is None:
+                self.disconnected_at = time_ns()
+
+    def on_recovered(self):
+        # 全チャンネルの受信を確認してからバックオフを戻す(接続直後に切られる場合の連続再接続を防ぐ)
+        self.reconnect_attempts = 0
+        self.disconnected_at = None
+
+    def on_first_message(self, channel, receved_at):
+        self.first_message_pending.discard(channel)
+        if self.disconnected_at is not None:
+            self.record_reconnect(channel, receved_at)
+        if not self.first_message_pending:
+            self.on_recovered()
+
+    def record_reconnect(self, channel, receved_at):
+        st = self.reconnect_stats[channel]
+        st.reconnects += 1
+        st.first_message = (receved_at - self.connected_at) / 1000000000
+        st.first_message_max = max(st.first_message_max, st.first_message)
+        st.blind = (receved_at - self.disconnected_at) / 1000000000
+        st.blind_max = max(st.blind_max, st.blind)
+        self.logger.info('RECONNECT: {0} first message {1:.3f}s blind {2:.3f}s'.format(channel, st.first_message, st.blind))
+
+    def reconnect_delay(self):
+        delay = min(self.reconnect_delay_max, self.reconnect_delay_min * (2 ** self.reconnect_attempts))
+        self.reconnect_attempts += 1
+        return delay * (1 - self.reconnect_jitter * random.random())
+
+    def on_data(self,channel,data,receved_at=None):
+        if self.execution_columns and isinstance(data,list) and channel.startswith('lightning_executions_'):
+            data = ExecutionColumns.from_dicts(data)
+        receved_at = receved_at or time_ns()
+        if channel in self.first_message_pending:
+            self.on_first_message(channel, receved_at)
+        if isinstance(data,ExecutionColumns):
+            data.receved_at = receved_at
+        elif isinstance(data,list):
+            data[-1]['receved_at'] = receved_at
             data[-1]['bucket_size'] = len(data)
+        backfill = self.backfills.get(channel)
+        if backfill is not None:
+            backfill.put(data)
+        else:
+            self.dispatch(channel,data)
+
+    def dispatch(self,channel,data):
+        for rec in self.recorders:
+            rec.put(channel,data)
         for cb in self.callbacks[channel]:
             cb(channel,data)
 
+    def enable_backfill(self, fetch):
+        """再接続時に欠落した約定履歴をfetch(product_code, before, after, count)で補完する"""
+        self.backfill_fetch = fetch
+        for channel in self.subscribed_channels:
+            self.add_backfill(channel)
+
+    def add_backfill(self, channel):
+        if self.backfill_fetch is not None and channel not in self.backfills and lightning_topic(channel) == 'executions':
+            backfill = self.backfills[channel] = ExecutionBackfill(channel, self.backfill_fetch, partial(self.dispatch, channel))
+            backfill.columns = self.execution_columns
+
     def get_endpoint(self, product_id='FX_BTC_JPY', topics=['ticker', 'executions']):
         ep = self.get_endpoint_for_channels(lightning_channels(product_id,topics))
         ep.product_id = product_id
         return ep
 
     def get_endpoint_for_channels(self, channels):
-        ep = Streaming.Endpoint(self.logger)
+        ep = self.Endpoint(self.logger)
         self.endpoints.append(ep)
         for channel in channels:
-            self.subscribe_channel(channel,ep.put)
+            ep.attach(self.get_channel_buffer(channel))
         return ep
 
+    def get_order_book(self, product_id='FX_BTC_JPY'):
+        """board_snapshot/boardで更新される板情報(同じ商品は共有)"""
+        book = self.order_books.get(product_id)
+        if book is None:
+            book = self.order_books[product_id] = OrderBook(product_id)
+            for channel in lightning_channels(product_id, ['board_snapshot', 'board']):
+                self.subscribe_channel(channel, book.put)
+        return book
+
+    def get_channel_buffer(self, channel):
+        # 同じチャンネルを購読するEndpointはバッファを共有する
+        buf = self.buffers.get(channel)
+        if buf is None:
+            topic = lightning_topic(channel)
+            capacity = self.capacity.get(topic, self.default_capacity)
+            spill = self.spill and topic == 'executions'
+            buf = self.buffers[channel] = Streaming.ChannelBuffer(channel, capacity, spill)
+            self.subscribe_channel(channel,buf.put)
+        return buf
+
     def subscribe_channel(self, channel, callback):
         self.callbacks[channel].append(callback)
         if channel not in self.subscribed_channels:
+            self.add_backfill(channel)
             if self.connected:
                 self.subscribe(channel)
             self.subscribed_channels.append(channel)
 
     def start(self):
-        self.logger.info('Start Streaming')
+        self.logger.info('Start Streaming ({0})'.format(self.transport))
         self.running = True
-        if 1:
+        if self.transport == 'socketio':
             self.subscribe = self.sio_subscribe
             self.disconnect = self.sio_disconnect
             self.thread = threading.Thread(target=self.sio_run_loop)
@@ -173,22 +307,159 @@ class Streaming:
             for ep in self.endpoints:
                 ep.shutdown()
 
+    class SpillFile:
+        """リングバッファから溢れたメッセージの退避先"""
+
+        def __init__(self):
+            self.file = tempfile.TemporaryFile()
+            self.index = {}
+
+        def __len__(self):
+            return len(self.index)
+
+        def __contains__(self, seq):
+            return seq in self.index
+
+        def write(self, seq, message):
+            payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+            self.file.seek(0, 2)
+            self.index[seq] = (self.file.tell(), len(payload))
+            self.file.write(payload)
+
+        def read(self, seq):
+            offset, length = self.index[seq]
+            self.file.seek(offset)
+            return pickle.loads(self.file.read(length))
+
+        def discard(self, until):
+            # 退避は古い順に行うので先頭から消す
+            for seq in list(self.index):
+                if seq >= until:
+                    break
+                del self.index[seq]
+            if len(self.index) == 0:
+                self.file.seek(0)
+                self.file.truncate()
+
+    class ChannelBuffer:
+        """チャンネル毎のリングバッファ
+
+        複数のEndpointが同じバッファをそれぞれのカーソルで読み出す.
+        更新時はこのチャンネルを待っているEndpointだけを起こす.
+        spill=Trueの場合、未読のまま上書きされるメッセージはディスクに退避する.
+        """
+
+        def __init__(self, channel, capacity=1000, spill=False):
+            self.channel = channel
+            self.capacity = capacity
+            self.buffer = [None] * capacity
+            self.seq = 0
+            self.latest = None
+            self.lock = threading.Lock()
+            self.subscribers = []
+            self.spill = Streaming.SpillFile() if spill else None
+            self.spilled = 0
+
+        def put(self, channel, message):
+            with self.lock:
+                oldest = self.seq - self.capacity
+                if self.spill is not None and oldest >= 0:
+                    # 読み終わっていない購読者がいれば上書き前に退避する
+                    for ep in self.subscribers:
+                        if ep.cursors[channel] <= oldest:
+                            self.spill.write(oldest, self.buffer[self.seq % self.capacity])
+                            self.spilled += 1
+                            break
+                self.buffer[self.seq % self.capacity] = message
+                self.seq += 1
+                self.latest = message
+            for ep in self.subscribers:
+                ep.notify(channel)
+
+        def read(self, cursor):
+            """cursor以降のメッセージ・次のカーソル・読めなかった数を返す"""
+            with self.lock:
+                seq = self.seq
+                start = max(cursor, seq - self.capacity)
+                lost = start - cursor
+                spilled = []
+                if lost and self.spill is not None:
+                    spilled = [self.spill.read(s) for s in range(cursor, start) if s in self.spill]
+                    lost -= len(spilled)
+                if start == seq:
+                    return spilled, seq, lost
+                i = start % self.capacity
+                j = seq % self.capacity
+                if i < j:
+                    data = self.buffer[i:j]
+                else:
+                    data = self.buffer[i:] + self.buffer[:j]
+            return spilled + data if spilled else data, seq, lost
+
+        def release(self):
+            """全購読者が読み終えた退避メッセージを破棄する"""
+            if self.spill is not None and len(self.spill):
+                with self.lock:
+                    self.spill.discard(min(ep.cursors[self.channel] for ep in self.subscribers))
+
     class Endpoint:
 
         def __init__(self, logger):
             self.logger = logger
             self.cond = threading.Condition()
-            self.data = defaultdict(lambda:deque(maxlen=1000))
-            self.latest = defaultdict(lambda:None)
+            self.buffers = {}
+            self.cursors = {}
+            # チャンネル毎の待機中のスレッド数
+            self.waiting = defaultdict(int)
+            self.dropped = defaultdict(int)
+            self.high_water = defaultdict(int)
             self.closed = False
             self.suspend_count = 0
             self.product_id = ''
+            # この約定IDまでは読み捨てる(過去の約定で足を作った後の重複除去)
+            self.skip_execution_id = None
+
+        def attach(self, buffer):
+            with self.cond:
+                self.buffers[buffer.channel] = buffer
+                self.cursors[buffer.channel] = buffer.seq
+            buffer.subscribers.append(self)
+
+        def buffer(self, channel):
+            buf = self.buffers.get(channel)
+            if buf is None:
+                buf = Streaming.ChannelBuffer(channel)
+                self.attach(buf)
+            return buf
 
         def put(self, channel, message):
+            self.buffer(channel).put(channel, message)
+
+        def notify(self, channel):
+            # 待機中のチャンネル以外では起こさない
             with self.cond:
-                self.data[channel].append(message)
-                self.latest[channel] = message
-                self.cond.notify_all()
+                if self.waiting.get(channel):
+                    self.cond.notify_all()
+
+        def watch(self, channels):
+            """channelsを待機中にする(self.condを取って呼ぶ)"""
+            for channel in channels:
+                self.waiting[channel] += 1
+
+        def unwatch(self, channels):
+            """watchしたchannelsを待機中から外す(他のスレッドが待っているチャンネルは残す)"""
+            for channel in channels:
+                count = self.waiting[channel] - 1
+                if count > 0:
+                    self.waiting[channel] = count
+                else:
+                    del self.waiting[channel]
+
+        def available(self, channel):
+            buf = self.buffers.get(channel)
+            if buf is None:
+                return 0
+            return min(buf.seq - self.cursors[channel], buf.capacity)
 
         def suspend(self, flag):
             with self.cond:
@@ -202,8 +473,7 @@ class Streaming:
             channels = lightning_channels(product_id or self.product_id, topics)
             for channel in channels:
                 while True:
-                    data = self.data[channel]
-                    if len(data) or self.closed:
+                    if self.available(channel) or self.closed:
                         break
                     else:
                         self.logger.info('Waiting for stream data...')
@@ -211,21 +481,25 @@ class Streaming:
 
         def wait_any(self, topics=[], timeout=None, product_id=None):
             channels = lightning_channels(product_id or self.product_id, topics)
+            if len(channels)==0:
+                channels = list(self.buffers.keys())
             result = True
             with self.cond:
-                while True:
-                    available = 0
-                    if self.suspend_count == 0:
-                        for channel in channels:
-                            available = available + len(self.data[channel])
-                    if available or self.closed:
-                        break
-                    else:
-                        if self.cond.wait(timeout) == False:
-                            result = False
-                            break
-                        if len(channels)==0:
+                self.watch(channels)
+                try:
+                    while True:
+                        available = 0
+                        if self.suspend_count == 0:
+                            for channel in channels:
+                                available = available + self.available(channel)
+                        if available or self.closed:
                             break
+                        else:
+                            if self.cond.wait(timeout) == False:
+                                result = False
+                                break
+                finally:
+                    self.unwatch(channels)
             return result
 
         def shutdown(self):
@@ -234,44 +508,89 @@ class Streaming:
                 self.cond.notify_all()
 
         def get_channel_data(self, channel, blocking, timeout):
-            with self.cond:
-                if blocking:
-                    while True:
-                        if len(self.data[channel]) or self.closed:
-                            break
-                        else:
-                            if self.cond.wait(timeout) == False:
+            buf = self.buffer(channel)
+            if blocking:
+                with self.cond:
+                    self.watch([channel])
+                    try:
+                        while True:
+                            if self.available(channel) or self.closed:
                                 break
-                data = list(self.data[channel])
-                self.data[channel].clear()
+                            else:
+                                if self.cond.wait(timeout) == False:
+                                    break
+                    finally:
+                        self.unwatch([channel])
+            data, self.cursors[channel], dropped = buf.read(self.cursors[channel])
+            backlog = len(data) + dropped
+            if backlog > self.high_water[channel]:
+                self.high_water[channel] = backlog
+            if dropped:
+                self.dropped[channel] += dropped
+            buf.release()
             return data
 
+        def stats(self):
+            """チャンネル毎の滞留数・最大滞留数・欠落数・退避数"""
+            stats = dotdict()
+            for channel, buf in self.buffers.items():
+                stats[channel] = dotdict(
+                    capacity=buf.capacity,
+                    backlog=buf.seq - self.cursors[channel],
+                    high_water=self.high_water[channel],
+                    dropped=self.dropped[channel],
+                    spilled=buf.spilled)
+            return stats
+
+        def get_latest(self, channel):
+            buf = self.buffers.get(channel)
+            return buf.latest if buf is not None else None
+
         def get_ticker(self, blocking=False, timeout=None, product_id=None):
             channel = lightning_channel(product_id or self.product_id, 'ticker')
             self.get_channel_data(channel, blocking, timeout)
-            return self.latest[channel]
+            return self.get_latest(channel)
 
         def get_tickers(self,blocking=False, timeout=None, product_id=None):
             channel = lightning_channel(product_id or self.product_id, 'ticker')
             return self.get_channel_data(channel, blocking, timeout)
 
-        def get_executions(self, blocking=False, timeout=None, product_id=None, chained=True):
+        def get_executions(self, blocking=False, timeout=None, product_id=None, chained=True, columns=False):
             channel = lightning_channel(product_id or self.product_id, 'executions')
             data = self.get_channel_data(channel, blocking, timeout)
+            if self.skip_execution_id is not None:
+                data = self.skip_executions(data)
+            if columns:
+                return ExecutionColumns.concat(data)
             if not chained:
                 return data
             return list(chain.from_iterable(data))
 
+        def skip_executions(self, data):
+            skip_id = self.skip_execution_id
+            result = []
+            for message in data:
+                ids = message.id if isinstance(message, ExecutionColumns) else [e['id'] for e in message]
+                start = bisect_right(ids, skip_id)
+                if start == len(ids):
+                    continue
+                if start:
+                    message = message.tail(start) if isinstance(message, ExecutionColumns) else message[start:]
+                else:
+                    # 重複がなくなったら以降は確認しない
+                    self.skip_execution_id = None
+                result.append(message)
+            return result
+
         def get_board_snapshot(self, blocking=False, timeout=None, product_id=None):
             channel = lightning_channel(product_id or self.product_id, 'board_snapshot')
             self.get_channel_data(channel, blocking, timeout)
-            return self.latest[channel]
+            return self.get_latest(channel)
 
         def get_boards(self, blocking=False, timeout=None, product_id=None):
             channel = lightning_channel(product_id or self.product_id, 'board')
             return self.get_channel_data(channel, blocking, timeout)
 
-
 if __name__ == "__main__":
     import argparse
 
@@ -4,9 +4,55 @@ import time
 import json
 import os.path
 import logging
+import calendar
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+try:
+    from time import time_ns, monotonic_ns
+except ImportError:
+    # Python3.6互換
+    def time_ns():
+        return int(time.time() * 1000000000)
+
+    def monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+
+EPOCH = datetime(1970, 1, 1)
+
+epoch_ns_cache = {}
+
+def parse_exec_date_ns(exec_date):
+    """exec_date(2018-10-18T08:00:00.1234567Z)をエポックナノ秒に変換"""
+    # 同じ秒の約定が続くので秒までの部分はキャッシュする
+    prefix = exec_date[:19]
+    sec = epoch_ns_cache.get(prefix)
+    if sec is None:
+        if len(epoch_ns_cache) > 4096:
+            epoch_ns_cache.clear()
+        sec = epoch_ns_cache[prefix] = calendar.timegm((
+            int(exec_date[0:4]), int(exec_date[5:7]), int(exec_date[8:10]),
+            int(exec_date[11:13]), int(exec_date[14:16]), int(exec_date[17:19]))) * 1000000000
+    frac = exec_date[20:29].rstrip('Z')
+    return sec + int((frac + '00000000')[:9]) if frac else sec
+
+def parse_order_ref_id_ns(order_ref_id):
+    """受付ID(JRF20181018-080000-123456)の時刻をエポックナノ秒に変換(parse_order_ref_idと同じ解釈)"""
+    prefix = order_ref_id[3:18]
+    sec = epoch_ns_cache.get(prefix)
+    if sec is None:
+        if len(epoch_ns_cache) > 4096:
+            epoch_ns_cache.clear()
+        sec = epoch_ns_cache[prefix] = calendar.timegm((
+            int(order_ref_id[3:7]), int(order_ref_id[7:9]), int(order_ref_id[9:11]),
+            int(order_ref_id[12:14]), int(order_ref_id[14:16]), int(order_ref_id[16:18]))) * 1000000000
+    return sec + int(order_ref_id[19:]) * 1000
+
+def ns_to_datetime(ns):
+    """エポックナノ秒をdatetime(UTC)に変換"""
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
     def __getattr__(self, attr):
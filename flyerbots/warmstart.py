@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+起動時のOHLCV事前作成(ウォームスタート)
+
+過去の約定をEndpoint.get_executions(chained=False)と同じ形(受信単位の約定のリスト)に揃えて
+OHLCVBuilder.prefillに渡し、起動前から動いていた場合と同じ足を作る.
+約定はストア(store_dir)かStreamRecorderの記録(record_dir)から読み、ない(足りない)分はREST API(getexecutions)で取得する.
+足りない分は記録の前(記録がstart_nsより後から始まる場合)・途中(受信の間隔がgap秒を超える所)・後の3つ.
+
+    ストア・記録   受信時刻・受信単位がそのまま分かる
+    REST   受信単位は同じexec_dateの約定、受信時刻はexec_dateとみなす
+
+RESTは1ページ目の約定IDと時刻から開始位置のIDを見積もり、ID範囲を分けて並列にページングする.
+リクエストはExchangeのAPIトークン(5分500リクエスト)を通るので、並列にしても制限は超えない.
+"""
+import os
+import logging
+import concurrent.futures
+from .recorder import segment_path, list_segments, read_records
+from .streaming import lightning_channel
+from .store import stored_messages
+from .utils import parse_exec_date_ns
+
+logger = logging.getLogger(__name__)
+
+def cached_messages(root, product_id, start_ns):
+    """StreamRecorderの記録からstart_ns以降に受信した約定を受信単位で返す"""
+    channel = lightning_channel(product_id, 'executions')
+    first = segment_path(root, channel, start_ns)
+    messages = []
+    for path in list_segments(root, channel):
+        # start_nsより前の時間のセグメントは読まない
+        if path < first:
+            continue
+        for mono_ns, wall_ns, message in read_records(path):
+            if wall_ns < start_ns or len(message) == 0:
+                continue
+            message[-1]['receved_at'] = wall_ns
+            message[-1]['bucket_size'] = len(message)
+            messages.append(message)
+    return messages
+
+def rest_messages(executions):
+    """RESTの約定(古い順)を同じexec_date毎の受信単位にまとめる"""
+    messages = []
+    message = []
+    for e in executions:
+        if len(message) and message[-1]['exec_date'] != e['exec_date']:
+            messages.append(close_message(message))
+            message = []
+        message.append(e)
+    if len(message):
+        messages.append(close_message(message))
+    return messages
+
+def close_message(message):
+    message[-1]['receved_at'] = parse_exec_date_ns(message[-1]['exec_date'])
+    message[-1]['bucket_size'] = len(message)
+    return message
+
+def fetch_range(fetch, product_code, after, before, count, max_pages):
+    """after < id < before の約定を新しい順にページングする. (約定, 範囲を取り切ったか, ページ数)"""
+    executions = []
+    for pages in range(1, max_pages + 1):
+        page = fetch(product_code, before, after, count)
+        executions.extend(e for e in page if after < e['id'] < before)
+        if len(page) < count:
+            return executions, True, pages
+        before = min(e['id'] for e in page)
+        if before <= after + 1:
+            return executions, True, pages
+    return executions, False, max_pages
+
+def fetch_history(fetch, product_code, start_ns, after=0, before=None, count=500, max_pages=60, workers=4):
+    """start_ns以降(かつafter<ID<before)の約定を古い順で返す(max_pagesで足りない場合は新しい側から取れた分)"""
+    page = fetch(product_code, before, after or None, count)
+    executions = [e for e in page if e['id'] > after and (before is None or e['id'] < before)]
+    if len(page) < count or parse_exec_date_ns(page[-1]['exec_date']) <= start_ns:
+        return finish(executions, start_ns)
+    budget = max_pages - 1
+    newest, oldest = page[0], page[-1]
+    newest_ns = parse_exec_date_ns(newest['exec_date'])
+    oldest_ns = parse_exec_date_ns(oldest['exec_date'])
+    before = oldest['id']
+    # IDは全商品共通の連番なので、1ページの範囲からID/秒と約定1件あたりのIDを見積もり、
+    # start_nsの約定IDの少し手前(ページ数の上限で取れる所まで)から並列に取得する
+    ids_per_ns = (newest['id'] - oldest['id']) / max(newest_ns - oldest_ns, 1)
+    ids_per_execution = (newest['id'] - oldest['id']) / max(len(page) - 1, 1)
+    lo = int(before - ids_per_ns * (oldest_ns - start_ns) * 1.1)
+    lo = max(lo, int(before - ids_per_execution * count * budget * 0.8), after)
+    n = min(workers, budget)
+    if n > 1 and lo < before - 1:
+        # 範囲iは bounds[i+1] <= id < bounds[i]
+        bounds = [before - (before - lo) * i // n for i in range(n + 1)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(fetch_range, fetch, product_code, max(bounds[i + 1] - 1, after), bounds[i], count, budget // n)
+                for i in range(n)]
+            results = [f.result() for f in futures]
+        for chunk, complete, pages in results:
+            executions.extend(chunk)
+            budget -= pages
+            if not complete:
+                # 取り切れなかった範囲より古い約定は欠落があるので使わない
+                logger.info('WARMSTART: page limit reached')
+                return finish(executions, start_ns)
+        before = lo
+        oldest_ns = min(parse_exec_date_ns(e['exec_date']) for e in executions)
+    # 見積もりが足りなかった場合は続きを順に取得する
+    while oldest_ns > start_ns and budget > 0 and before > after + 1:
+        page = fetch(product_code, before, after or None, count)
+        budget -= 1
+        executions.extend(e for e in page if after < e['id'] < before)
+        if len(page) < count:
+            break
+        before = min(e['id'] for e in page)
+        oldest_ns = parse_exec_date_ns(page[-1]['exec_date'])
+    if oldest_ns > start_ns and budget <= 0:
+        logger.info('WARMSTART: page limit reached')
+    return finish(executions, start_ns)
+
+def finish(executions, start_ns):
+    executions = {e['id']:e for e in executions if parse_exec_date_ns(e['exec_date']) >= start_ns}
+    return [executions[k] for k in sorted(executions.keys())]
+
+def find_gaps(messages, start_ns, gap_ns):
+    """記録の欠落を(位置, after, before)で返す. 記録の前(start_nsから最初の受信まで)はafter=0、途中は受信の間隔がgap_nsを超える所"""
+    gaps = []
+    if messages[0][-1]['receved_at'] - start_ns > gap_ns:
+        gaps.append((0, 0, messages[0][0]['id']))
+    for i in range(1, len(messages)):
+        if messages[i][-1]['receved_at'] - messages[i - 1][-1]['receved_at'] > gap_ns:
+            after, before = messages[i - 1][-1]['id'], messages[i][0]['id']
+            if after + 1 < before:
+                gaps.append((i, after, before))
+    return gaps
+
+def warm_start(builder, fetch, product_id, start_ns, record_dir=None, interval=0, lazy=False, max_pages=60, workers=4, store_dir=None, gap=60):
+    """builderに過去の約定から足を作り、使った最後の約定IDを返す"""
+    messages = []
+    if store_dir and os.path.isdir(store_dir):
+        messages = stored_messages(store_dir, product_id, start_ns)
+    elif record_dir and os.path.isdir(record_dir):
+        messages = cached_messages(record_dir, product_id, start_ns)
+    after = messages[-1][-1]['id'] if len(messages) else 0
+    cached = len(messages)
+    if fetch is not None:
+        product_code = product_id.replace('/', '_')
+        if len(messages):
+            # 記録の前と途中の欠落をRESTで埋める(欠落したまま作ると空の足や約定の足りない足になる)
+            filled = []
+            last = 0
+            for i, lo, hi in find_gaps(messages, start_ns, int(gap * 1000000000)):
+                filled.extend(messages[last:i])
+                last = i
+                if lo == 0:
+                    executions = fetch_history(fetch, product_code, start_ns, 0, hi, max_pages=max_pages, workers=workers)
+                else:
+                    executions, complete, pages = fetch_range(fetch, product_code, lo, hi, 500, max_pages)
+                    if not complete:
+                        logger.info('WARMSTART: page limit reached')
+                    executions = finish(executions, start_ns)
+                filled.extend(rest_messages(executions))
+            filled.extend(messages[last:])
+            messages = filled
+        # 記録の後(記録がなければstart_ns以降)をRESTで補う
+        executions = fetch_history(fetch, product_code, start_ns, after, max_pages=max_pages, workers=workers)
+        messages.extend(rest_messages(executions))
+    builder.prefill(messages, interval, lazy)
+    logger.info('WARMSTART: {0} messages ({1} cached, {2} REST)'.format(len(messages), cached, len(messages) - cached))
+    return messages[-1][-1]['id'] if len(messages) else None
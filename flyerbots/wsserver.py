@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+ローカル検証用のRealtime APIサーバ
+
+bitFlyer Lightning Realtime APIの購読と配信だけを真似る.
+/json-rpc はJSON-RPC 2.0(subscribe / channelMessage)、
+/socket.io/ はwebsocketトランスポートのみのSocket.IO(Engine.IO v4)として応答する.
+記録データの再生や任意のメッセージ配信、接続の強制切断でストリーミングクライアントをオフラインで試験・計測する.
+
+    server = StandInServer().start()
+    streaming.ws_url = server.url
+    streaming.sio_url = server.sio_url
+    server.publish('lightning_ticker_FX_BTC_JPY', {...})
+    server.kill_connections()
+"""
+import json
+import uuid
+import asyncio
+import threading
+import logging
+import websockets
+from time import sleep, monotonic
+from .replay import merge_records
+
+def channel_message(channel, message):
+    return json.dumps({'jsonrpc':'2.0','method':'channelMessage',
+        'params':{'channel':channel,'message':message}}, separators=(',',':'))
+
+def sio_event(channel, message):
+    return '42' + json.dumps([channel, message], separators=(',',':'))
+
+class StandInServer:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        # 接続毎の(購読チャンネル, フレーム生成関数)
+        self.clients = {}
+        self.sent = 0
+        self.refuse_until = 0
+
+    @property
+    def url(self):
+        return 'ws://{0}:{1}/json-rpc'.format(self.host, self.port)
+
+    @property
+    def sio_url(self):
+        return 'http://{0}:{1}'.format(self.host, self.port)
+
+    async def handler(self, ws, path=None):
+        path = path or ws.request.path
+        if monotonic() < self.refuse_until:
+            # 停止中(接続を受け付けてすぐに閉じる)
+            await ws.close(1013)
+            return
+        subscribed = set()
+        try:
+            if path.startswith('/socket.io/'):
+                self.clients[ws] = (subscribed, sio_event)
+                await self.sio_session(ws, subscribed)
+            else:
+                self.clients[ws] = (subscribed, channel_message)
+                await self.jsonrpc_session(ws, subscribed)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.pop(ws, None)
+
+    async def jsonrpc_session(self, ws, subscribed):
+        async for frame in ws:
+            request = json.loads(frame)
+            if request.get('method') == 'subscribe':
+                subscribed.add(request['params']['channel'])
+                if 'id' in request:
+                    await ws.send(json.dumps({'jsonrpc':'2.0','id':request['id'],'result':True}))
+
+    async def sio_session(self, ws, subscribed):
+        sid = uuid.uuid4().hex
+        await ws.send('0' + json.dumps({'sid':sid, 'upgrades':[], 'pingInterval':25000, 'pingTimeout':20000, 'maxPayload':1000000}))
+        async for frame in ws:
+            if frame == '2':
+                await ws.send('3')
+            elif frame.startswith('40'):
+                await ws.send('40' + json.dumps({'sid':sid}))
+            elif frame.startswith('42'):
+                event = json.loads(frame[2:])
+                if event[0] == 'subscribe':
+                    subscribed.add(event[1])
+            elif frame.startswith('41') or frame == '1':
+                break
+
+    async def broadcast(self, channel, message):
+        frames = {}
+        for ws, (subscribed, encode) in list(self.clients.items()):
+            if channel in subscribed:
+                frame = frames.get(encode)
+                if frame is None:
+                    frame = frames[encode] = encode(channel, message)
+                try:
+                    await ws.send(frame)
+                    self.sent += 1
+                except websockets.ConnectionClosed:
+                    pass
+
+    async def broadcast_many(self, messages, interval=0):
+        """(channel, message)の列を配信する(interval秒間隔, 0なら待ちなし)"""
+        for channel, message in messages:
+            await self.broadcast(channel, message)
+            if interval:
+                await asyncio.sleep(interval)
+            elif self.sent % 100 == 0:
+                await asyncio.sleep(0)
+
+    async def replay(self, root, speed=1.0, channels=None):
+        """StreamRecorderの記録を受信時刻の間隔で配信する(speed=0なら待ちなし)"""
+        base_ns = None
+        started = monotonic()
+        for wall_ns, mono_ns, channel, message in merge_records(root, channels):
+            if speed:
+                if base_ns is None:
+                    base_ns = wall_ns
+                wait = (wall_ns - base_ns) / 1000000000 / speed - (monotonic() - started)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await self.broadcast(channel, message)
+
+    def run(self, coro):
+        """サーバスレッドでコルーチンを実行する(concurrent.futures.Futureを返す)"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def publish(self, channel, message):
+        return self.run(self.broadcast(channel, message))
+
+    def kill_connections(self, abort=True, refuse=0):
+        """全ての接続を切断する
+
+        abort=True   クローズハンドシェイクなしでTCPを切る(回線断)
+        abort=False  クローズフレームを送って閉じる(サーバ側の切断)
+        refuse       切断後、指定秒数は新しい接続を受け付けない(メンテナンス等)
+        """
+        async def kill():
+            self.refuse_until = monotonic() + refuse
+            clients = list(self.clients.keys())
+            for ws in clients:
+                if abort:
+                    ws.transport.abort()
+                else:
+                    await ws.close(1001)
+            return len(clients)
+        return self.run(kill()).result()
+
+    def subscribers(self, channel):
+        return sum(1 for subscribed, _ in list(self.clients.values()) if channel in subscribed)
+
+    def wait_for_subscribers(self, channels, count=1, timeout=10):
+        limit = monotonic() + timeout
+        while monotonic() < limit:
+            if all(self.subscribers(c) >= count for c in channels):
+                return True
+            sleep(0.01)
+        return False
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        async def serve():
+            return await websockets.serve(self.handler, self.host, self.port)
+
+        def server_main():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(serve())
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=server_main)
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        self.logger.info('Start StandInServer ' + self.url)
+        return self
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            await self.server.wait_closed()
+        self.run(shutdown()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.logger.info('Stop StandInServer')
+
+
+def measure_reconnect(transports=('socketio', 'jsonrpc'), kills=5, abort=True, refuse=0, interval=0.01):
+    """接続を切断してから各チャンネルのメッセージが再び届くまでの時間(見えない時間)を計る"""
+    from .streaming import Streaming
+
+    channels = ['lightning_ticker_FX_BTC_JPY', 'lightning_executions_FX_BTC_JPY']
+    server = StandInServer().start()
+    stop = threading.Event()
+
+    def feed():
+        i = 0
+        while not stop.is_set():
+            server.publish(channels[0], {'product_code':'FX_BTC_JPY', 'ltp':1000000.0+i})
+            server.publish(channels[1], [{'id':i, 'side':'BUY', 'price':1000000.0+i, 'size':0.01}])
+            i += 1
+            sleep(interval)
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    results = {}
+    for transport in transports:
+        streaming = Streaming()
+        streaming.transport = transport
+        streaming.ws_url = server.url
+        streaming.sio_url = server.sio_url
+        for channel in channels:
+            streaming.subscribe_channel(channel, lambda channel, data: None)
+        streaming.start()
+        server.wait_for_subscribers(channels)
+        for n in range(kills):
+            sleep(0.5)
+            server.kill_connections(abort, refuse)
+            limit = monotonic() + 60
+            while any(streaming.reconnect_stats[c].reconnects <= n for c in channels) and monotonic() < limit:
+                sleep(0.01)
+        streaming.stop()
+        results[transport] = {c:streaming.reconnect_stats[c] for c in channels}
+        server.wait_for_subscribers(channels, count=0)
+
+    stop.set()
+    feeder.join()
+    server.stop()
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--dir", dest='dir', type=str, default='capture')
+    parser.add_argument("--port", dest='port', type=int, default=8765)
+    parser.add_argument("--speed", dest='speed', type=float, default=1.0)
+    parser.add_argument("--measure_reconnect", dest='measure_reconnect', type=int, default=0, help='kill connections N times per transport and report blind time')
+    parser.add_argument("--graceful", dest='graceful', action='store_true', help='close with close frame instead of aborting TCP')
+    parser.add_argument("--refuse", dest='refuse', type=float, default=0, help='refuse new connections for N seconds after kill')
+    args = parser.parse_args()
+
+    if args.measure_reconnect:
+        logging.basicConfig(level=logging.WARNING)
+        results = measure_reconnect(kills=args.measure_reconnect, abort=not args.graceful, refuse=args.refuse)
+        for transport, stats in results.items():
+            for channel, st in stats.items():
+                print('{0:<9} {1:<32} reconnects {reconnects} first message {first_message:.3f}s (max {first_message_max:.3f}s) blind {blind:.3f}s (max {blind_max:.3f}s)'.format(
+                    transport, channel, **st))
+        raise SystemExit
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = StandInServer(port=args.port).start()
+    while True:
+        try:
+            server.run(server.replay(args.dir, args.speed)).result()
+        except (KeyboardInterrupt, SystemExit):
+            break
+    server.stop()
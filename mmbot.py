@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import datetime
 from flyerbots.strategy import Strategy
+from flyerbots.replay import ReplayStreaming
 from flyerbots.indicator import *
 from math import floor, ceil
 
@@ -152,6 +153,11 @@ if __name__ == "__main__":
         pdb.Pdb().set_trace(frame)
     signal.signal(signal.SIGUSR1, handle_pdb)
 
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--replay", dest='replay', type=str, default=None, help='capture directory')
+    parser.add_argument("--speed", dest='speed', type=float, default=1.0)
+    args = parser.parse_args()
+
     logging.config.dictConfig(settings.loggingConf('mmbot.log'))
     logger = logging.getLogger("mmbot")
 
@@ -160,4 +166,4 @@ if __name__ == "__main__":
     strategy.settings.secret = settings.secret
     strategy.settings.show_last_n_orders = 10
     strategy.risk.max_position_size = 0.05
-    strategy.start()
+    strategy.start(ReplayStreaming(args.replay, args.speed) if args.replay else None)
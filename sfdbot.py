@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 from flyerbots.strategy import Strategy
-from flyerbots.streaming import parse_exec_date
-from datetime import datetime, timedelta
+from flyerbots.utils import time_ns, parse_exec_date_ns
 from math import ceil
 from collections import deque
 
@@ -19,19 +18,18 @@ class SFDBot:
         spot_executions = self.spot_ep.get_executions()
         if len(spot_executions):
             e = spot_executions[-1]
-            e['exec_date'] = parse_exec_date(e['exec_date'])
+            e['exec_ns'] = parse_exec_date_ns(e['exec_date'])
             self.spot_q.append(e)
         if len(self.spot_q)<2:
             return
 
-        dt = datetime.utcnow()
+        now = time_ns()
         spot_available = len(spot_executions)
         spot = self.spot_q[-1]
         spot2 = self.spot_q[-2]
         spot_ltp = spot['price']
         spot_ltp2 = spot2['price']
-        spot_exec_date = spot['exec_date']
-        spot_past_time = (dt - spot_exec_date).total_seconds()
+        spot_past_time = (now - spot['exec_ns']) / 1000000000
 
         self.spot_ltp_q.append(spot_ltp)
         ltp_list = list(self.spot_ltp_q)
@@ -2,6 +2,7 @@
 from datetime import datetime, time
 from math import sqrt
 from flyerbots.strategy import Strategy
+from flyerbots.replay import ReplayStreaming
 from flyerbots.indicator import *
 
 no_trade_time_range = [
@@ -110,6 +111,11 @@ if __name__ == "__main__":
     import logging
     import logging.config
 
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--replay", dest='replay', type=str, default=None, help='capture directory')
+    parser.add_argument("--speed", dest='speed', type=float, default=1.0)
+    args = parser.parse_args()
+
     logging.config.dictConfig(settings.loggingConf('simple_market_maker.log'))
     logger = logging.getLogger("simple_market_maker")
 
@@ -118,4 +124,4 @@ if __name__ == "__main__":
     strategy.settings.secret = settings.secret
     strategy.settings.max_ohlcv_size = 600
     strategy.risk.max_position_size = 0.2
-    strategy.start()
+    strategy.start(ReplayStreaming(args.replay, args.speed) if args.replay else None)